@@ -0,0 +1,313 @@
+#!/usr/bin/python
+"""
+Load-test harness for Mantrid's request path.
+
+Starts a real balancer and a stub keep-alive backend as subprocesses on
+loopback, then drives each action (proxy, static, empty) at every payload
+size with a number of concurrent clients. Reports throughput, latency
+percentiles and the balancer's memory use as JSON, so results from two
+releases can be compared by a script.
+
+Run from the top of the source tree:
+
+    python benchmarks/loadtest.py --clients 50 --requests 5000 --payloads 0,1024,65536
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import eventlet
+from eventlet.green import socket
+from mantrid.client import MantridClient
+from mantrid.framing import SocketReader, parse_head, wants_keepalive
+
+source_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+class CountingSink(object):
+    "Stands in for a socket and just counts what is sent to it."
+
+    def __init__(self):
+        self.size = 0
+
+    def sendall(self, data):
+        self.size += len(data)
+
+
+def serve_backend(port):
+    """
+    Runs the stub backend: an HTTP/1.1 keep-alive server that answers
+    GET /<size> with a body of that many bytes.
+    """
+    bodies = {}
+
+    def handle(sock, address):
+        reader = SocketReader(sock)
+        try:
+            while True:
+                head = reader.read_head()
+                if head is None:
+                    break
+                words, headers = parse_head(head)
+                size = int(words[1].strip("/") or 0)
+                if size not in bodies:
+                    bodies[size] = "HTTP/1.1 200 OK\r\nContent-Length: %i\r\n\r\n%s" % (size, "x" * size)
+                sock.sendall(bodies[size])
+        except (socket.error, ValueError):
+            pass
+        sock.close()
+
+    eventlet.serve(eventlet.listen(("127.0.0.1", port), backlog=1024), handle, concurrency=10000)
+
+
+def rss_kb(pid):
+    "Returns the resident memory of a process and its children, in kB"
+    pids = [pid]
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open("/proc/%s/stat" % entry) as fh:
+                    if int(fh.read().rsplit(")", 1)[1].split()[1]) == pid:
+                        pids.append(int(entry))
+            except (IOError, IndexError, ValueError):
+                continue
+    total = 0
+    for child in pids:
+        try:
+            with open("/proc/%i/status" % child) as fh:
+                for line in fh:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except IOError:
+            continue
+    return total
+
+
+def wait_for_port(port, timeout=10):
+    "Waits until something is listening on the port"
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            eventlet.connect(("127.0.0.1", port)).close()
+            return
+        except socket.error:
+            eventlet.sleep(0.1)
+    raise RuntimeError("Nothing started listening on port %i" % port)
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def request(port, host, path, conn, keepalive):
+    """
+    Makes one request, reusing conn if given. Returns the response size
+    and the connection if it can be used again (or None).
+    """
+    if conn is None:
+        conn = eventlet.connect(("127.0.0.1", port))
+    conn.sendall("GET %s HTTP/1.1\r\nHost: %s\r\n%s\r\n" % (
+        path,
+        host,
+        "" if keepalive else "Connection: close\r\n",
+    ))
+    reader = SocketReader(conn)
+    head = reader.read_head()
+    if head is None:
+        raise socket.error("Connection closed before a response")
+    words, headers = parse_head(head)
+    if words[1] != "200":
+        raise socket.error("Got a %s response" % words[1])
+    sink = CountingSink()
+    delimited = reader.relay_body(headers, sink)
+    if keepalive and delimited and wants_keepalive(words[0], headers) and not reader.buffer:
+        return sink.size, conn
+    conn.close()
+    return sink.size, None
+
+
+def run_scenario(port, host, path, clients, requests, keepalive):
+    "Drives the balancer with concurrent clients and returns the results"
+    latencies = []
+    state = {"left": requests, "errors": 0, "bytes": 0}
+
+    def client():
+        conn = None
+        while state['left'] > 0:
+            state['left'] -= 1
+            start = time.time()
+            try:
+                size, conn = request(port, host, path, conn, keepalive)
+            except socket.error:
+                state['errors'] += 1
+                conn = None
+                continue
+            latencies.append(time.time() - start)
+            state['bytes'] += size
+        if conn is not None:
+            conn.close()
+
+    pool = eventlet.GreenPool(clients)
+    start = time.time()
+    for i in range(clients):
+        pool.spawn(client)
+    pool.waitall()
+    duration = time.time() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": state['errors'],
+        "seconds": round(duration, 3),
+        "requests_per_second": round(len(latencies) / duration, 1),
+        "megabytes_per_second": round(state['bytes'] / duration / 1048576, 2),
+        "latency_ms": dict(
+            (name, round(percentile(latencies, fraction) * 1000, 3) if latencies else None)
+            for name, fraction in [("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0)]
+        ),
+    }
+
+
+def measure_idle_connections(port, pid, count):
+    "Opens idle connections to see how much memory each one costs"
+    before = rss_kb(pid)
+    conns = []
+    for i in range(count):
+        conn = eventlet.connect(("127.0.0.1", port))
+        # Half a request head, so the balancer has to hold on to it
+        conn.sendall("GET / HTTP/1.1\r\n")
+        conns.append(conn)
+    eventlet.sleep(1)
+    after = rss_kb(pid)
+    for conn in conns:
+        conn.close()
+    return {
+        "connections": count,
+        "rss_kb_before": before,
+        "rss_kb_after": after,
+        "rss_kb_per_connection": round((after - before) / float(count), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test a local Mantrid")
+    parser.add_argument("--clients", type=int, default=50, help="Concurrent clients (default 50)")
+    parser.add_argument("--requests", type=int, default=5000, help="Requests per scenario (default 5000)")
+    parser.add_argument("--payloads", default="0,1024,65536", help="Comma-separated response sizes in bytes")
+    parser.add_argument("--actions", default="proxy,static,empty", help="Comma-separated actions to test")
+    parser.add_argument("--keepalive", action="store_true", help="Use keep-alive to the balancer and backends")
+    parser.add_argument("--splice", action="store_true", help="Turn on splice() relaying")
+    parser.add_argument("--workers", type=int, default=1, help="Balancer worker processes (default 1)")
+    parser.add_argument("--idle-connections", type=int, default=500, help="Idle connections for the memory test (0 to skip)")
+    parser.add_argument("--port", type=int, default=38000, help="First of four ports to use (default 38000)")
+    parser.add_argument("--output", default=None, help="Write the JSON results here instead of stdout")
+    parser.add_argument("--serve-backend", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve_backend:
+        serve_backend(args.serve_backend)
+        return
+    # Make room for lots of client sockets
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    port, management_port, backend_port = args.port, args.port + 1, args.port + 2
+    payloads = [int(size) for size in args.payloads.split(",")]
+    actions = args.actions.split(",")
+    # Configuration, state and static pages all go in a scratch directory
+    scratch = tempfile.mkdtemp(prefix="mantrid-loadtest-")
+    static_dir = os.path.join(scratch, "static")
+    os.mkdir(static_dir)
+    for size in payloads:
+        with open(os.path.join(static_dir, "bench-%i.http" % size), "w") as fh:
+            fh.write("HTTP/1.0 200 OK\r\nContent-Length: %i\r\n\r\n%s" % (size, "x" * size))
+    config_file = os.path.join(scratch, "mantrid.conf")
+    with open(config_file, "w") as fh:
+        fh.write("\n".join([
+            "bind = 127.0.0.1:%i" % port,
+            "bind_management = 127.0.0.1:%i" % management_port,
+            "state_file = %s" % os.path.join(scratch, "state.json"),
+            "static_dir = %s/" % static_dir,
+            "uid = 0",
+            "gid = 0",
+            "client_keepalive = %s" % ("true" if args.keepalive else "false"),
+            "splice = %s" % ("true" if args.splice else "false"),
+            "workers = %i" % args.workers,
+        ]) + "\n")
+    devnull = open(os.devnull, "w")
+    backend = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve-backend", str(backend_port)],
+        stdout=devnull,
+        stderr=devnull,
+    )
+    balancer = subprocess.Popen(
+        [sys.executable, "-m", "mantrid.loadbalancer", "-c", config_file],
+        cwd=source_dir,
+        stdout=devnull,
+        stderr=devnull,
+    )
+    try:
+        wait_for_port(backend_port)
+        wait_for_port(management_port)
+        wait_for_port(port)
+        client = MantridClient("http://127.0.0.1:%i" % management_port)
+        report = {
+            "config": {
+                "clients": args.clients,
+                "requests": args.requests,
+                "keepalive": args.keepalive,
+                "splice": args.splice,
+                "workers": args.workers,
+            },
+            "rss_kb_start": rss_kb(balancer.pid),
+            "results": [],
+        }
+        for action in actions:
+            for size in payloads:
+                host = "%s-%i.bench" % (action, size)
+                if action == "proxy":
+                    details = ["proxy", {"backends": [["127.0.0.1", backend_port]], "keepalive": args.keepalive}, False]
+                elif action == "static":
+                    details = ["static", {"type": "bench-%i" % size}, False]
+                elif action == "empty":
+                    if size:
+                        continue
+                    details = ["empty", {"code": 200}, False]
+                else:
+                    raise ValueError("Unknown action %s" % action)
+                client.set(host, details)
+                # Give worker processes a moment to hear about the change
+                eventlet.sleep(0.2 if args.workers > 1 else 0)
+                result = run_scenario(port, host, "/%i" % size, args.clients, args.requests, args.keepalive)
+                result.update({
+                    "action": action,
+                    "payload": size,
+                    "rss_kb": rss_kb(balancer.pid),
+                })
+                report['results'].append(result)
+        if args.idle_connections:
+            report['idle_connections'] = measure_idle_connections(port, balancer.pid, args.idle_connections)
+    finally:
+        balancer.terminate()
+        backend.terminate()
+        balancer.wait()
+        backend.wait()
+        shutil.rmtree(scratch, ignore_errors=True)
+    output = json.dumps(report, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(output + "\n")
+    else:
+        print output
+
+
+if __name__ == "__main__":
+    main()
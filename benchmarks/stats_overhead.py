@@ -0,0 +1,93 @@
+#!/usr/bin/python
+"""
+Micro-benchmark of the per-request stats accounting: the dict-based
+counters and __getattr__ socket wrapper Mantrid used to have, against
+HostStats and the slotted StatsSocket.
+
+Run from the top of the source tree:
+
+    python benchmarks/stats_overhead.py [iterations]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mantrid.host_stats import HostStats
+from mantrid.stats_socket import StatsSocket
+
+
+class GetattrStatsSocket(object):
+    "The old StatsSocket, which forwarded everything through __getattr__."
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def __getattr__(self, attr):
+        return getattr(self.sock, attr)
+
+    def recv(self, length):
+        recvd = self.sock.recv(length)
+        self.bytes_received += len(recvd)
+        return recvd
+
+
+class NullSocket(object):
+    "Socket stand-in whose calls cost as little as possible."
+
+    def recv(self, length):
+        return "x"
+
+    def fileno(self):
+        return 0
+
+
+def dict_accounting(stats, host, sock, started):
+    "What Balancer.handle_request used to do for every request"
+    stats_dict = stats.setdefault(host, {})
+    stats_dict['open_requests'] = stats_dict.get('open_requests', 0) + 1
+    stats_dict['open_requests'] -= 1
+    stats_dict['completed_requests'] = stats_dict.get('completed_requests', 0) + 1
+    stats_dict['bytes_sent'] = stats_dict.get('bytes_sent', 0) + sock.bytes_sent - started
+    stats_dict['bytes_received'] = stats_dict.get('bytes_received', 0) + sock.bytes_received - started
+
+
+def slot_accounting(stats, host, sock, started):
+    "What it does now, given the HostStats its action already holds"
+    stats.open_requests += 1
+    stats.open_requests -= 1
+    stats.completed_requests += 1
+    stats.bytes_sent += sock.bytes_sent - started
+    stats.bytes_received += sock.bytes_received - started
+
+
+def best_of(statement, number, repeat=5):
+    "Returns the best time per call, in nanoseconds"
+    return min(timeit.repeat(statement, number=number, repeat=repeat)) / number * 1e9
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    old_sock = GetattrStatsSocket(NullSocket())
+    new_sock = StatsSocket(NullSocket())
+    stats_dict = {}
+    host_stats = HostStats()
+    results = [
+        ("accounting, dicts", best_of(lambda: dict_accounting(stats_dict, "ep.io", old_sock, 0), number)),
+        ("accounting, HostStats", best_of(lambda: slot_accounting(host_stats, "ep.io", new_sock, 0), number)),
+        ("fileno(), __getattr__", best_of(lambda: old_sock.fileno(), number)),
+        ("fileno(), forwarded", best_of(lambda: new_sock.fileno(), number)),
+        ("recv(), old wrapper", best_of(lambda: old_sock.recv(1), number)),
+        ("recv(), slotted", best_of(lambda: new_sock.recv(1), number)),
+        ("record latency", best_of(lambda: host_stats.total.record(0.0123), number)),
+    ]
+    for name, nanoseconds in results:
+        print "%-25s %8.1f ns" % (name, nanoseconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,23 +3,76 @@ Contains Mantrid's built-in actions.
 """
 
 import errno
+import itertools
 import os
 import random
+import time
 import eventlet
 from eventlet.green import socket
+from eventlet.timeout import Timeout
 from httplib import responses
 from .socketmeld import SocketMelder
+from .framing import SocketReader, HeadParser, Headers, FramingError, BodyTooLarge, parse_head, rewrite_head, content_length, is_chunked, wants_keepalive
+
+
+class ConnectTimeout(Exception):
+    "Raised when a backend takes longer than connect_timeout to accept"
+
+
+class RequestTimeout(Exception):
+    "Raised when a proxied request runs for longer than request_timeout"
+
+
+def boolean(value):
+    "Reads a boolean action option; the CLI sends every option as a string."
+    if isinstance(value, basestring):
+        return value.lower() in ("true", "yes", "on", "1")
+    return bool(value)
 
 
 class Action(object):
     "Base action. Doesn't do anything."
 
+    stats = None
+
     def __init__(self, balancer, host, matched_host):
         self.host = host
         self.balancer = balancer
         self.matched_host = matched_host
 
-    def handle(self, sock, read_data, path, headers):
+    def for_host(self, host):
+        "Returns this action (or a shallow copy of it) bound to the given host."
+        if host == self.host:
+            return self
+        action = self.__class__.__new__(self.__class__)
+        action.__dict__.update(self.__dict__)
+        action.host = host
+        return action
+
+    def host_stats(self):
+        "Returns the HostStats for our matched host, looking it up only once"
+        if self.stats is None:
+            self.stats = self.balancer.host_stats(self.matched_host)
+        return self.stats
+
+    @classmethod
+    def kwargs_errors(cls, kwargs):
+        """
+        Validates the options for this action in a host entry.
+        Returns an error string, or None if they are valid.
+        """
+        return None
+
+    def handle(self, sock, read_data, path, headers, keep_alive=False, body_offset=None, reader=None):
+        """
+        Handles the request. keep_alive says the client wants to send more
+        requests on this connection; actions that fully read the request
+        and send a delimited response may return True to allow that.
+        headers is the request's parsed Headers, and body_offset (if
+        known) is where the head ends in read_data. reader is the client
+        connection's SocketReader, which any unread body is taken from so
+        that a pipelined request after it stays buffered.
+        """
         raise NotImplementedError("You must use an Action subclass")
 
 
@@ -31,11 +84,12 @@ class Empty(Action):
     def __init__(self, balancer, host, matched_host, code):
         super(Empty, self).__init__(balancer, host, matched_host)
         self.code = code
+        self.response = "HTTP/1.0 %s %s\r\nConnection: close\r\nContent-length: 0\r\n\r\n" % (self.code, responses.get(self.code, "Unknown"))
 
-    def handle(self, sock, read_data, path, headers):
+    def handle(self, sock, read_data, path, headers, keep_alive=False, body_offset=None, reader=None):
         "Sends back a static error page."
         try:
-            sock.sendall("HTTP/1.0 %s %s\r\nConnection: close\r\nContent-length: 0\r\n\r\n" % (self.code, responses.get(self.code, "Unknown")))
+            sock.sendall(self.response)
         except socket.error, e:
             if e.errno != errno.EPIPE:
                 raise
@@ -46,36 +100,52 @@ class Static(Action):
 
     type = None
 
+    # Pages read from disk, keyed by (static_dir, type). Each is a list of
+    # [path, mtime, data, next_check]; files are only stat()ed again once
+    # next_check has passed, and only reread if their mtime has changed.
+    pages = {}
+    recheck_interval = 1
+
     def __init__(self, balancer, host, matched_host, type=None):
         super(Static, self).__init__(balancer, host, matched_host)
         if type is not None:
             self.type = type
 
-    # Try to get sendfile() using ctypes; otherwise, fall back
-    try:
-        import ctypes
-        _sendfile = ctypes.CDLL("libc.so.6").sendfile
-        _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_long, ctypes.c_size_t]
-        _sendfile.restype = ctypes.c_ssize_t
-    except Exception:
-        _sendfile = None
-
-    def handle(self, sock, read_data, path, headers):
+    @classmethod
+    def reload(cls):
+        "Forgets all loaded pages, so they are read from disk again."
+        cls.pages.clear()
+
+    def page(self):
+        "Returns the contents of our page, from memory where possible."
+        key = (self.balancer.static_dir, self.type)
+        page = self.pages.get(key)
+        now = time.time()
+        if page is not None and page[3] > now:
+            return page[2]
+        # Find the correct file
+        for path in [
+            os.path.join(self.balancer.static_dir, "%s.http" % self.type),
+            os.path.join(os.path.dirname(__file__), "static", "%s.http" % self.type),
+        ]:
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            break
+        else:
+            raise IOError("No static page called %s" % self.type)
+        if page is None or page[0] != path or page[1] != mtime:
+            with open(path) as fh:
+                page = self.pages[key] = [path, mtime, fh.read(), 0]
+        page[3] = now + self.recheck_interval
+        return page[2]
+
+    def handle(self, sock, read_data, path, headers, keep_alive=False, body_offset=None, reader=None):
         "Sends back a static error page."
         assert self.type is not None
         try:
-            # Get the correct file
-            try:
-                fh = open(os.path.join(self.balancer.static_dir, "%s.http" % self.type))
-            except IOError:
-                fh = open(os.path.join(os.path.dirname(__file__), "static", "%s.http" % self.type))
-            # Send it, using sendfile if poss. (no fileno() means we're probably using mock sockets)
-            try:
-                self._sendfile(sock.fileno(), fh.fileno(), 0, os.fstat(fh.fileno()).st_size)
-            except (TypeError, AttributeError):
-                sock.sendall(fh.read())
-            # Close the file and socket
-            fh.close()
+            sock.sendall(self.page())
             sock.close()
         except socket.error, e:
             if e.errno != errno.EPIPE:
@@ -102,21 +172,22 @@ class Redirect(Action):
     def __init__(self, balancer, host, matched_host, redirect_to):
         super(Redirect, self).__init__(balancer, host, matched_host)
         self.redirect_to = redirect_to
+        # Render everything but the path up front, for each protocol
+        template = "HTTP/1.0 302 Found\r\nLocation: %s/"
+        if "://" not in self.redirect_to:
+            self.http_prefix = template % ("http://%s" % self.redirect_to).rstrip("/")
+            self.https_prefix = template % ("https://%s" % self.redirect_to).rstrip("/")
+        else:
+            self.http_prefix = self.https_prefix = template % self.redirect_to.rstrip("/")
 
-    def handle(self, sock, read_data, path, headers):
+    def handle(self, sock, read_data, path, headers, keep_alive=False, body_offset=None, reader=None):
         "Sends back a static error page."
-        if "://" not in self.redirect_to:
-            destination = "http%s://%s" % (
-                "s" if headers.get('X-Forwarded-Protocol', headers.get('X-Forwarded-Proto', "")).lower() in ("https", "ssl") else "",
-                self.redirect_to
-            )
+        if headers.get('X-Forwarded-Protocol', headers.get('X-Forwarded-Proto', "")).lower() in ("https", "ssl"):
+            prefix = self.https_prefix
         else:
-            destination = self.redirect_to
+            prefix = self.http_prefix
         try:
-            sock.sendall("HTTP/1.0 302 Found\r\nLocation: %s/%s\r\n\r\n" % (
-                destination.rstrip("/"),
-                path.lstrip("/"),
-            ))
+            sock.sendall(prefix + path.lstrip("/") + "\r\n\r\n")
         except socket.error, e:
             if e.errno != errno.EPIPE:
                 raise
@@ -127,8 +198,29 @@ class Proxy(Action):
 
     attempts = 1
     delay = 1
-
-    def __init__(self, balancer, host, matched_host, backends, attempts=None, delay=None):
+    keepalive = False
+    strategy = "random"
+    strategies = ("random", "round_robin", "least_conn", "weighted", "power_of_two")
+
+    max_body_size = None
+    max_connections = None
+    # Timeouts default to the balancer's settings
+    connect_timeout = None
+    idle_timeout = None
+    request_timeout = None
+    timeouts = ("connect_timeout", "idle_timeout", "request_timeout")
+
+    # Hop-by-hop headers we replace when talking keep-alive to backends
+    hop_headers = ("connection", "keep-alive", "proxy-connection")
+    # Idempotent methods (RFC 7231 4.2.2), which can be resent if a
+    # reused connection turns out to have been closed
+    retry_methods = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+    bad_gateway_response = "HTTP/1.0 502 Bad Gateway\r\nConnection: close\r\nContent-length: 0\r\n\r\n"
+    bad_request_response = "HTTP/1.0 400 Bad Request\r\nConnection: close\r\nContent-length: 0\r\n\r\n"
+    continue_response = "HTTP/1.1 100 Continue\r\n\r\n"
+    too_large_response = "HTTP/1.0 413 Request Entity Too Large\r\nConnection: close\r\nContent-length: 0\r\n\r\n"
+
+    def __init__(self, balancer, host, matched_host, backends, attempts=None, delay=None, keepalive=None, strategy=None, max_failures=None, backoff=None, health_check=None, max_body_size=None, max_connections=None, connect_timeout=None, idle_timeout=None, request_timeout=None):
         super(Proxy, self).__init__(balancer, host, matched_host)
         self.backends = backends
         assert self.backends
@@ -136,27 +228,409 @@ class Proxy(Action):
             self.attempts = int(attempts)
         if delay is not None:
             self.delay = float(delay)
-
-    def handle(self, sock, read_data, path, headers):
-        "Sends back a static error page."
-        for i in range(self.attempts):
+        if keepalive is not None:
+            self.keepalive = boolean(keepalive)
+        if strategy is not None:
+            if strategy not in self.strategies:
+                raise ValueError("Unknown strategy %s" % strategy)
+            self.strategy = strategy
+        if max_body_size is not None:
+            self.max_body_size = int(max_body_size)
+        if max_connections is not None:
+            self.max_connections = int(max_connections)
+        if connect_timeout is not None:
+            self.connect_timeout = float(connect_timeout)
+        if idle_timeout is not None:
+            self.idle_timeout = float(idle_timeout)
+        if request_timeout is not None:
+            self.request_timeout = float(request_timeout)
+        # Backends are [host, port] or [host, port, weight]
+        self.states = [balancer.backend(tuple(backend[:2])) for backend in backends]
+        self.weights = [float(backend[2]) if len(backend) > 2 else 1.0 for backend in backends]
+        # max_failures, backoff and health_check are applied to the shared
+        # backend state by the balancer, from all the rules using it
+        # Shared with any copies made by for_host
+        self.counter = itertools.count()
+
+    @classmethod
+    def health_settings(cls, kwargs):
+        """
+        Returns the (max_failures, backoff, probe_interval) a rule's options
+        ask for its backends to have, with None for those not set.
+        """
+        settings = []
+        for name, convert in [("max_failures", int), ("backoff", float), ("health_check", float)]:
+            try:
+                settings.append(convert(kwargs[name]))
+            except (KeyError, TypeError, ValueError):
+                settings.append(None)
+        return tuple(settings)
+
+    @classmethod
+    def kwargs_errors(cls, kwargs):
+        backends = kwargs.get("backends")
+        if not backends or not isinstance(backends, list):
+            return "host_backends_invalid"
+        for backend in backends:
+            if not isinstance(backend, list) or len(backend) not in (2, 3):
+                return "host_backends_invalid"
+            if not isinstance(backend[1], int):
+                return "host_backends_invalid"
+            if len(backend) == 3 and (not isinstance(backend[2], (int, float)) or backend[2] <= 0):
+                return "host_backend_weight_invalid"
+        strategy = kwargs.get("strategy", cls.strategy)
+        if strategy not in cls.strategies:
+            return "host_strategy_invalid:%s" % strategy
+        for name in ("max_body_size", "max_connections"):
+            try:
+                if int(kwargs.get(name, 0)) < 0:
+                    return "host_%s_invalid" % name
+            except (TypeError, ValueError):
+                return "host_%s_invalid" % name
+        for name, convert, minimum in [("max_failures", int, 1), ("backoff", float, 0), ("health_check", float, 0.1)]:
+            try:
+                if name in kwargs and convert(kwargs[name]) < minimum:
+                    return "host_%s_invalid" % name
+            except (TypeError, ValueError):
+                return "host_%s_invalid" % name
+        for name in cls.timeouts:
+            try:
+                if float(kwargs.get(name, 0)) < 0:
+                    return "host_%s_invalid" % name
+            except (TypeError, ValueError):
+                return "host_%s_invalid" % name
+        return None
+
+    def choose_backend(self, exclude=()):
+        """
+        Picks the Backend to send the next request to, using our strategy.
+        Backends that are down or in exclude are skipped unless there is
+        nothing else left to try.
+        """
+        states = self.states
+        candidates = [i for i, state in enumerate(states) if state.up and state not in exclude]
+        if not candidates:
+            candidates = [i for i, state in enumerate(states) if state not in exclude] or range(len(states))
+        if len(candidates) == 1:
+            return states[candidates[0]]
+        if self.strategy == "round_robin":
+            return states[candidates[self.counter.next() % len(candidates)]]
+        elif self.strategy == "least_conn":
+            # Start at a random point so ties are spread out
+            offset = random.randrange(len(candidates))
+            return min(
+                (states[i] for i in candidates[offset:] + candidates[:offset]),
+                key = lambda state: state.in_flight,
+            )
+        elif self.strategy == "weighted":
+            point = random.uniform(0, sum(self.weights[i] for i in candidates))
+            for i in candidates:
+                point -= self.weights[i]
+                if point <= 0:
+                    return states[i]
+            return states[candidates[-1]]
+        elif self.strategy == "power_of_two":
+            first, second = random.sample(candidates, 2)
+            if states[first].in_flight * self.weights[second] <= states[second].in_flight * self.weights[first]:
+                return states[first]
+            return states[second]
+        return states[random.choice(candidates)]
+
+    def timeout(self, name):
+        "Returns one of our timeouts in seconds, or None for no timeout"
+        value = getattr(self, name)
+        if value is None:
+            value = getattr(self.balancer, name)
+        return value or None
+
+    def handle(self, sock, read_data, path, headers, keep_alive=False, body_offset=None, reader=None):
+        "Proxies the request to a backend."
+        started = time.time()
+        # Shed requests over this host's limit (which counts this one)
+        if self.max_connections and self.host_stats().open_requests > self.max_connections:
+            self.host_stats().shed_requests += 1
+            action = Static(self.balancer, self.host, self.matched_host, type="overloaded")
+            return action.handle(sock, read_data, path, headers)
+        bytes_sent = getattr(sock, "bytes_sent", 0)
+        timer = Timeout(self.timeout("request_timeout"), RequestTimeout)
+        try:
+            return self.proxy(sock, read_data, path, headers, keep_alive, started, body_offset, reader)
+        except (RequestTimeout, socket.timeout), e:
+            if isinstance(e, RequestTimeout):
+                self.host_stats().request_timeouts += 1
+            else:
+                self.host_stats().idle_timeouts += 1
+            # Only send the timeout page if the response hasn't started
+            if getattr(sock, "bytes_sent", 0) == bytes_sent:
+                action = Static(self.balancer, self.host, self.matched_host, type="timeout")
+                action.handle(sock, read_data, path, headers)
+            return False
+        finally:
+            timer.cancel()
+
+    def proxy(self, sock, read_data, path, headers, keep_alive, started, body_offset=None, reader=None):
+        """
+        Does the work of handle(), which puts the request_timeout
+        around it.
+        """
+        # Refuse bodies we know are too large before going any further
+        max_body_size = self.max_body_size
+        if max_body_size is None:
+            max_body_size = self.balancer.max_body_size
+        chunked = is_chunked(headers)
+        if max_body_size and not chunked:
             try:
-                server_sock = eventlet.connect(
-                    tuple(random.choice(self.backends)),
-                )
-            except socket.error:
+                length = content_length(headers)
+            except FramingError:
+                length = None
+            if length is not None and length > max_body_size:
+                sock.sendall(self.too_large_response)
+                return False
+        # Requests we can delimit go over a connection we can reuse; the
+        # rest are melded through and close the client connection after.
+        # Chunked bodies are always delimited, so they can be size-limited.
+        request = (self.keepalive or keep_alive or chunked) and self.parse_request(read_data, headers, body_offset)
+        if request:
+            request['max_body_size'] = max_body_size
+            request['started'] = started
+            request['reader'] = reader
+        tried = []
+        for i in range(self.attempts):
+            if i:
                 eventlet.sleep(self.delay)
-                continue
-            # Function to help track data usage
-            def send_onwards(data):
-                server_sock.sendall(data)
-                return len(data)
+            backend = self.choose_backend(tried)
+            tried.append(backend)
+            backend.in_flight += 1
+            backend.requests += 1
+            try:
+                if request:
+                    pool = self.balancer.backend_pool
+                    try:
+                        with Timeout(self.timeout("connect_timeout"), ConnectTimeout):
+                            conn = pool.get(backend.address) if self.keepalive else pool.connect(backend.address)
+                    except ConnectTimeout:
+                        self.host_stats().connect_timeouts += 1
+                        backend.record_failure()
+                        continue
+                    except socket.error:
+                        backend.record_failure()
+                        continue
+                    backend.record_success()
+                    try:
+                        return self.relay(sock, conn, request, keep_alive, backend)
+                    except socket.error, e:
+                        if e.errno != errno.EPIPE:
+                            raise
+                    return
+                try:
+                    with Timeout(self.timeout("connect_timeout"), ConnectTimeout):
+                        server_sock = eventlet.connect(backend.address)
+                except ConnectTimeout:
+                    self.host_stats().connect_timeouts += 1
+                    backend.record_failure()
+                    continue
+                except socket.error:
+                    backend.record_failure()
+                    continue
+                backend.record_success()
+                # Function to help track data usage
+                def send_onwards(data):
+                    server_sock.sendall(data)
+                    return len(data)
+                melder = SocketMelder(sock, server_sock, self.balancer.splice, self.timeout("idle_timeout"))
+                try:
+                    size = send_onwards(read_data)
+                    size += melder.run()
+                except socket.error, e:
+                    if e.errno != errno.EPIPE:
+                        raise
+                if melder.first_byte is not None:
+                    self.record_ttfb(backend, melder.first_byte - started)
+                if melder.timed_out:
+                    raise socket.timeout("timed out")
+                return
+            finally:
+                backend.in_flight -= 1
+        # None of the attempts got through
+        action = Static(self.balancer, self.host, self.matched_host, type="timeout")
+        return action.handle(sock, read_data, path, headers)
+
+    def parse_request(self, read_data, headers=None, body_offset=None):
+        """
+        Works out where the request in read_data ends, so the backend
+        connection can be reused afterwards. Returns None for requests
+        that have to be melded through instead (upgrades, and 100-continue
+        with a Content-Length, which was checked against the limit already).
+        If the balancer has already parsed the head, pass its Headers and
+        body_offset; only the hop-by-hop headers are then rewritten.
+        """
+        if body_offset is not None and isinstance(headers, Headers):
+            first_line = read_data[:read_data.index("\n") + 1]
+            body = read_data[body_offset:]
+        else:
+            parser = HeadParser()
+            try:
+                if not parser.feed(read_data):
+                    return None
+            except FramingError:
+                return None
+            first_line, headers, body = parser.first_line, parser.headers, parser.rest()
+        words = first_line.split()
+        if len(words) < 2 or words[0].upper() == "CONNECT":
+            return None
+        if "upgrade" in headers:
+            return None
+        # Chunked bodies are streamed from whatever was read so far
+        chunked = "transfer-encoding" in headers
+        expect_continue = False
+        if "expect" in headers:
+            # Chunked bodies have to come through us to be size-limited,
+            # so we tell the client to go ahead ourselves
+            if not chunked or headers['expect'].lower() != "100-continue":
+                return None
+            expect_continue = True
+        if chunked:
+            if not is_chunked(headers):
+                return None
+            length = 0
+        else:
             try:
-                size = send_onwards(read_data)
-                size += SocketMelder(sock, server_sock).run()
-            except socket.error, e:
-                if e.errno != errno.EPIPE:
+                length = content_length(headers) or 0
+            except FramingError:
+                return None
+            body = body[:length]
+        for name in self.hop_headers + ("expect", ):
+            del headers[name]
+        headers['Connection'] = "keep-alive" if self.keepalive else "close"
+        return {
+            "method": words[0].upper(),
+            "head": first_line + headers.render(),
+            "body": body,
+            "remaining": length - len(body),
+            "chunked": chunked,
+            "expect_continue": expect_continue,
+        }
+
+    def record_ttfb(self, backend, duration):
+        "Records how long a backend took to start responding"
+        backend.ttfb.record(duration)
+        self.host_stats().ttfb.record(duration)
+
+    def relay(self, sock, conn, request, keep_alive=False, backend=None):
+        """
+        Sends the request down a backend connection and relays the response
+        back, returning the connection to the pool if it is still usable.
+        Returns True if the client connection can carry another request.
+        """
+        pool = self.balancer.backend_pool
+        if request['chunked']:
+            payload = request['head']
+        else:
+            payload = request['head'] + request['body']
+        # Reads and writes are one after another here, so a timeout on
+        # each socket operation is the idle timeout
+        idle_timeout = self.timeout("idle_timeout")
+        sock.settimeout(idle_timeout)
+        conn.sock.settimeout(idle_timeout)
+        # Until the response head is sent, failures can still be reported
+        responded = False
+        try:
+            response = None
+            if conn.reused and not request['remaining'] and not request['chunked']:
+                # The backend may have closed this connection just as we
+                # picked it; if it did so before sending anything, nothing
+                # was lost, so retry on a new one. A timeout means the
+                # backend is just slow, and may well be running the request.
+                server = SocketReader(conn.sock)
+                try:
+                    conn.sock.sendall(payload)
+                    response = server.read_head()
+                except socket.timeout:
                     raise
+                except socket.error, e:
+                    if e.errno not in (errno.ECONNRESET, errno.EPIPE) or server.buffer:
+                        raise
+                if response is None:
+                    address = conn.address
+                    conn.sock.close()
+                    conn = None
+                    # The backend may still have acted on it, so only
+                    # requests that are safe to repeat are sent again
+                    if request['method'] not in self.retry_methods:
+                        sock.sendall(self.bad_gateway_response)
+                        return False
+                    try:
+                        with Timeout(self.timeout("connect_timeout"), ConnectTimeout):
+                            conn = pool.connect(address)
+                    except ConnectTimeout:
+                        self.host_stats().connect_timeouts += 1
+                        sock.sendall(self.bad_gateway_response)
+                        return False
+                    except socket.error:
+                        sock.sendall(self.bad_gateway_response)
+                        return False
+                    conn.sock.settimeout(idle_timeout)
+            if response is None:
+                conn.sock.sendall(payload)
+                try:
+                    if request['chunked']:
+                        if request['expect_continue'] and not request['body']:
+                            sock.sendall(self.continue_response)
+                        SocketReader(sock, request['body']).relay_chunked(conn.sock, request.get('max_body_size'))
+                    elif request['remaining']:
+                        # Read the rest through the client's own reader, so
+                        # anything sent after the body is kept for next time
+                        (request.get('reader') or SocketReader(sock)).relay_exact(request['remaining'], conn.sock)
+                except BodyTooLarge:
+                    raise
+                except FramingError:
+                    # The client's body was cut short or badly chunked
+                    sock.sendall(self.bad_request_response)
+                    return False
+                server = SocketReader(conn.sock)
+                response = server.read_head()
+            if response is not None and backend is not None:
+                self.record_ttfb(backend, time.time() - request['started'])
+            # Skip interim responses
+            while True:
+                if response is None:
+                    raise FramingError("Backend closed the connection")
+                words, headers = parse_head(response)
+                if len(words) < 2:
+                    raise FramingError("Invalid status line")
+                if not words[1].startswith("1"):
+                    break
+                response = server.read_head()
+            # Only keep the client around if it'll know where this response ends
+            no_body = request['method'] == "HEAD" or words[1] in ("204", "304")
+            keep_alive = keep_alive and (no_body or is_chunked(headers) or "content-length" in headers)
+            responded = True
+            sock.sendall(rewrite_head(response, self.hop_headers, [("Connection", "keep-alive" if keep_alive else "close")]))
+            reusable = no_body or server.relay_body(headers, sock)
+            if reusable and self.keepalive and wants_keepalive(words[0], headers) and not server.buffer:
+                pool.release(conn)
+                conn = None
+            return keep_alive
+        except BodyTooLarge:
+            # Only request bodies are limited, so no response has started
+            sock.sendall(self.too_large_response)
+            return False
+        except (FramingError, socket.error), e:
+            # Timeouts are reported by handle(), and other errors are
+            # passed on; a backend that closed or reset the connection
+            # before responding gets the client a 502
+            if isinstance(e, socket.error) and (responded or e.errno not in (errno.ECONNRESET, errno.EPIPE)):
+                raise
+            if not responded:
+                try:
+                    sock.sendall(self.bad_gateway_response)
+                except socket.error:
+                    pass
+            return False
+        finally:
+            sock.settimeout(None)
+            if conn is not None:
+                conn.sock.close()
 
 
 class Spin(Action):
@@ -166,7 +640,7 @@ class Spin(Action):
     """
 
     timeout = 120
-    check_interval = 1
+    check_interval = 10
 
     def __init__(self, balancer, host, matched_host, timeout=None, check_interval=None):
         super(Spin, self).__init__(balancer, host, matched_host)
@@ -175,15 +649,20 @@ class Spin(Action):
         if check_interval is not None:
             self.check_interval = int(check_interval)
 
-    def handle(self, sock, read_data, path, headers):
+    def handle(self, sock, read_data, path, headers, keep_alive=False, body_offset=None, reader=None):
         "Just waits, and checks for other actions to replace us"
-        for i in range(self.timeout // self.check_interval):
-            # Sleep first
-            eventlet.sleep(self.check_interval)
+        deadline = time.time() + self.timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            # The balancer wakes us as soon as our rule might have changed;
+            # check_interval is just a fallback
+            self.balancer.wait_for_change(self.host, min(remaining, self.check_interval))
             # Check for another action
             action = self.balancer.resolve_host(self.host)
             if not isinstance(action, Spin):
-                return action.handle(sock, read_data, path, headers)
+                return action.handle(sock, read_data, path, headers, keep_alive, body_offset, reader)
         # OK, nothing happened, so give up.
         action = Static(self.balancer, self.host, self.matched_host, type="timeout")
         return action.handle(sock, read_data, path, headers)
@@ -0,0 +1,111 @@
+import time
+import logging
+import eventlet
+from eventlet.green import socket
+from eventlet.greenpool import GreenPool
+from eventlet.timeout import Timeout
+from .histogram import Histogram
+
+
+class Backend(object):
+    """
+    Live state for one backend server, shared by every rule that
+    proxies to it.
+    """
+
+    __slots__ = [
+        "address", "in_flight", "requests", "failures", "total_failures", "down_until",
+        "max_failures", "backoff", "probe_interval", "next_probe", "ttfb",
+    ]
+
+    def __init__(self, address):
+        self.address = address
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.total_failures = 0
+        self.down_until = 0
+        self.next_probe = 0
+        self.ttfb = Histogram()
+        self.configure([])
+
+    def configure(self, settings):
+        """
+        Applies the health settings of the rules using this backend, given
+        as (max_failures, backoff, probe_interval) with None where a rule
+        doesn't set one. Where rules disagree, the strictest setting wins.
+        """
+        max_failures = [setting[0] for setting in settings if setting[0] is not None]
+        backoffs = [setting[1] for setting in settings if setting[1] is not None]
+        probe_intervals = [setting[2] for setting in settings if setting[2] is not None]
+        self.max_failures = min(max_failures) if max_failures else 3
+        self.backoff = max(backoffs) if backoffs else 10
+        self.probe_interval = min(probe_intervals) if probe_intervals else None
+
+    @property
+    def up(self):
+        return self.down_until <= time.time()
+
+    def record_success(self):
+        "Notes a successful connection, bringing the backend back up."
+        if self.down_until:
+            logging.info("Backend %s:%s is up" % self.address)
+        self.failures = 0
+        self.down_until = 0
+
+    def record_failure(self):
+        """
+        Notes a failed connection. After max_failures in a row, the
+        backend is taken out of selection for backoff seconds.
+        """
+        self.failures += 1
+        self.total_failures += 1
+        if self.failures >= self.max_failures:
+            if self.up:
+                logging.warning("Backend %s:%s is down after %i failures" % (self.address + (self.failures, )))
+            self.down_until = time.time() + self.backoff
+
+    def to_dict(self):
+        return {
+            "up": self.up,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "total_failures": self.total_failures,
+            "ttfb": self.ttfb.to_dict(),
+        }
+
+
+class HealthChecker(object):
+    """
+    Periodically probes backends that have a probe_interval set, by
+    opening (and closing) a TCP connection to them. Failed probes count
+    towards taking a backend down; a successful one brings it back up.
+    """
+
+    tick = 1
+    probe_timeout = 2
+
+    def __init__(self, balancer):
+        self.balancer = balancer
+        self.probes = GreenPool(100)
+
+    def probe(self, backend):
+        try:
+            with Timeout(self.probe_timeout):
+                sock = eventlet.connect(backend.address)
+        except (socket.error, Timeout):
+            backend.record_failure()
+        else:
+            sock.close()
+            backend.record_success()
+
+    def loop(self):
+        "Spawns probes for backends that are due one."
+        while self.balancer.running:
+            eventlet.sleep(self.tick)
+            now = time.time()
+            for backend in self.balancer.backends.values():
+                if backend.probe_interval and backend.next_probe <= now:
+                    backend.next_probe = now + backend.probe_interval
+                    self.probes.spawn_n(self.probe, backend)
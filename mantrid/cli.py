@@ -1,4 +1,5 @@
 import sys
+import json
 from .client import MantridClient
 
 
@@ -50,10 +51,12 @@ class MantridCli(object):
                 action = "%s<%s>" % (
                     details[0],
                     ",".join(
-                        "%s:%s" % (host, port)
-                        for host, port in details[1]['backends']
+                        ":".join(str(bit) for bit in backend)
+                        for backend in details[1]['backends']
                     )
                 )
+                if "strategy" in details[1]:
+                    action += "[%s]" % details[1]['strategy']
             elif details[0] == "static":
                 action = "%s<%s>" % (
                     details[0],
@@ -114,7 +117,7 @@ class MantridCli(object):
         # Expand some options from text to datastructure
         if "backends" in options:
             options['backends'] = [
-                (lambda x: (x[0], int(x[1])))(bit.split(":", 1))
+                (lambda x: [x[0], int(x[1])] + [float(w) for w in x[2:]])(bit.split(":", 2))
                 for bit in options['backends'].split(",")
             ]
         # Set!
@@ -123,6 +126,30 @@ class MantridCli(object):
             [action, options, subdoms.lower() == "true"]
         )
     
+    def action_patch(self, filename=None):
+        "Sets and deletes several hostnames at once, from a JSON file (or - for stdin)"
+        usage = "patch <file|->"
+        if filename is None:
+            sys.stderr.write("You must supply a file of changes.\n")
+            sys.stderr.write("Usage: %s\n" % usage)
+            sys.exit(1)
+        try:
+            if filename == "-":
+                changes = json.load(sys.stdin)
+            else:
+                with open(filename) as fh:
+                    changes = json.load(fh)
+        except (IOError, ValueError), e:
+            sys.stderr.write("Cannot read changes from %s: %s\n" % (filename, e))
+            sys.exit(1)
+        if not isinstance(changes, dict):
+            sys.stderr.write("The file must contain an object with 'set' and/or 'delete' keys.\n")
+            sys.exit(1)
+        self.client.patch(
+            changes.get("set", {}),
+            changes.get("delete", []),
+        )
+    
     def action_delete(self, hostname):
         "Deletes the hostname from the LB."
         self.client.delete(
@@ -131,13 +158,20 @@ class MantridCli(object):
     
     def action_stats(self, hostname=None):
         "Shows stats (possibly limited by hostname)"
-        format = "%-35s %-11s %-11s %-11s %-11s"
-        print format % ("HOST", "OPEN", "COMPLETED", "BYTES IN", "BYTES OUT")
-        for host, details in sorted(self.client.stats(hostname).items()):
+        format = "%-35s %-11s %-11s %-11s %-11s %-9s %-9s %-9s"
+        print format % ("HOST", "OPEN", "COMPLETED", "BYTES IN", "BYTES OUT", "P50 MS", "P99 MS", "TTFB P99")
+        stats = self.client.stats(hostname)
+        if hostname:
+            stats = {hostname: stats}
+        for host, details in sorted(stats.items()):
+            latency = details.get("latency", {})
             print format % (
                 host,
                 details.get("open_requests", 0),
                 details.get("completed_requests", 0),
                 details.get("bytes_received", 0),
                 details.get("bytes_sent", 0),
+                latency.get("total", {}).get("p50_ms", "-"),
+                latency.get("total", {}).get("p99_ms", "-"),
+                latency.get("ttfb", {}).get("p99_ms", "-"),
             )
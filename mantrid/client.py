@@ -2,8 +2,10 @@ try:
     import eventlet
     httplib2 = eventlet.import_patched("httplib2")
 except ImportError:
+    eventlet = None
     import httplib2
 import json
+import urllib
 
 
 class MantridClient(object):
@@ -13,17 +15,27 @@ class MantridClient(object):
 
     def __init__(self, base_url):
         self.base_url = base_url.rstrip("/")
+        # Http objects (and so connections) not in use by a request right
+        # now; each keeps its connection to the server open between calls
+        self.idle_http = []
 
     def _request(self, path, method, body=None):
         "Base request function"
-        h = httplib2.Http()
+        return self._request_with_headers(path, method, body)[1]
+
+    def _request_with_headers(self, path, method, body=None):
+        "Makes a request, returning the response headers and decoded body"
+        h = self.idle_http.pop() if self.idle_http else httplib2.Http()
         resp, content = h.request(
             self.base_url + path,
             method,
             body = json.dumps(body),
         )
+        # Not reached if the request failed partway, so broken
+        # connections are never reused
+        self.idle_http.append(h)
         if resp['status'] == "200":
-            return json.loads(content)
+            return resp, json.loads(content)
         else:
             raise IOError(
                 "Got %s reponse from server (%s)" % (
@@ -32,14 +44,47 @@ class MantridClient(object):
                 )
             )
     
-    def get_all(self):
-        "Returns all endpoints"
-        return self._request("/hostname/", "GET")
+    def _paged_request(self, path, prefix=None, page_size=None):
+        "Fetches a listing a page at a time, returning it all as one dict"
+        query = {}
+        if prefix:
+            query['prefix'] = prefix
+        if page_size:
+            query['limit'] = page_size
+        result = {}
+        while True:
+            resp, page = self._request_with_headers(
+                path + ("?" + urllib.urlencode(query) if query else ""),
+                "GET",
+            )
+            result.update(page)
+            if not resp.get("x-next-cursor"):
+                return result
+            query['cursor'] = resp['x-next-cursor']
+
+    def get_all(self, prefix=None, page_size=None):
+        "Returns all endpoints (or those starting with prefix)"
+        return self._paged_request("/hostname/", prefix, page_size)
     
     def set_all(self, data):
         "Sets all endpoints"
         return self._request("/hostname/", "PUT", data)
     
+    def patch(self, set_hosts=None, delete_hosts=None):
+        "Sets and deletes several endpoints in one change"
+        return self._request("/hostname/", "PATCH", {
+            "set": set_hosts or {},
+            "delete": delete_hosts or [],
+        })
+    
+    def batch(self):
+        """
+        Returns a Batch, which collects set() and delete() calls and sends
+        them as a single change. Use it as a context manager to send them
+        at the end of the block.
+        """
+        return Batch(self)
+    
     def set(self, hostname, entry):
         "Sets endpoint for a single hostname"
         return self._request("/hostname/%s/" % hostname, "PUT", entry)
@@ -48,8 +93,125 @@ class MantridClient(object):
         "Deletes a single hostname"
         return self._request("/hostname/%s/" % hostname, "DELETE")
 
-    def stats(self, hostname=None):
+    def watch(self, since=None, timeout=30):
+        """
+        Generator that yields each change to the hosts table as it
+        happens, as a dict with the new "generation", "hosts" (the changed
+        entries, with None for deleted ones) and "reset", which is true
+        when "hosts" is the full table instead. Starts with the full table
+        unless since, a generation already seen, is given.
+        """
+        if since is None:
+            since = -1
+        while True:
+            result = self._request("/watch/?%s" % urllib.urlencode({
+                "since": since,
+                "timeout": timeout,
+            }), "GET")
+            if result['generation'] == since and not result['reset']:
+                # Timed out with nothing new; ask again
+                continue
+            since = result['generation']
+            yield result
+
+    def stats(self, hostname=None, prefix=None, page_size=None):
         if hostname:
             return self._request("/stats/%s/" % hostname, "GET")
         else:
-            return self._request("/stats/", "GET")
+            return self._paged_request("/stats/", prefix, page_size)
+
+    def balancer_stats(self):
+        "Returns stats about the balancer itself"
+        return self._request("/balancer/", "GET")
+
+
+class Batch(object):
+    """
+    Collects set and delete calls and sends them in one PATCH. Later
+    calls for a hostname replace earlier ones.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.set_hosts = {}
+        self.delete_hosts = set()
+
+    def __len__(self):
+        return len(self.set_hosts) + len(self.delete_hosts)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.send()
+
+    def set(self, hostname, entry):
+        "Sets endpoint for a single hostname"
+        self.delete_hosts.discard(hostname)
+        self.set_hosts[hostname] = entry
+
+    def delete(self, hostname):
+        "Deletes a single hostname"
+        self.set_hosts.pop(hostname, None)
+        self.delete_hosts.add(hostname)
+
+    def send(self):
+        "Sends the changes collected so far, if there are any"
+        if not len(self):
+            return None
+        result = self.client.patch(self.set_hosts, sorted(self.delete_hosts))
+        self.set_hosts = {}
+        self.delete_hosts = set()
+        return result
+
+
+class MultiClient(object):
+    """
+    Makes the same calls to several balancers at once. Each call returns
+    {base_url: result}, with the exception raised in place of the result
+    for any balancer it failed on.
+    """
+
+    def __init__(self, base_urls, concurrency=20):
+        self.clients = [MantridClient(base_url) for base_url in base_urls]
+        self.concurrency = concurrency
+
+    def _fan_out(self, method_name, *args, **kwargs):
+        "Calls the method on every balancer's client, concurrently if possible"
+        def call(client):
+            try:
+                return client.base_url, getattr(client, method_name)(*args, **kwargs)
+            except (IOError, httplib2.HttpLib2Error), e:
+                return client.base_url, e
+        if eventlet is None:
+            return dict(map(call, self.clients))
+        pool = eventlet.GreenPool(self.concurrency)
+        return dict(pool.imap(call, self.clients))
+
+    def get_all(self, prefix=None, page_size=None):
+        "Returns all endpoints (or those starting with prefix)"
+        return self._fan_out("get_all", prefix, page_size)
+
+    def set_all(self, data):
+        "Sets all endpoints"
+        return self._fan_out("set_all", data)
+
+    def patch(self, set_hosts=None, delete_hosts=None):
+        "Sets and deletes several endpoints in one change"
+        return self._fan_out("patch", set_hosts, delete_hosts)
+
+    def batch(self):
+        "Returns a Batch that sends its changes to every balancer"
+        return Batch(self)
+
+    def set(self, hostname, entry):
+        "Sets endpoint for a single hostname"
+        return self._fan_out("set", hostname, entry)
+
+    def delete(self, hostname):
+        "Deletes a single hostname"
+        return self._fan_out("delete", hostname)
+
+    def stats(self, hostname=None, prefix=None, page_size=None):
+        return self._fan_out("stats", hostname, prefix, page_size)
@@ -0,0 +1,344 @@
+"""
+Helpers for finding the boundaries of HTTP/1.x messages on a socket,
+so bodies can be relayed without closing the connection afterwards.
+"""
+
+import re
+
+
+class FramingError(ValueError):
+    "Raised when a message cannot be delimited (bad head, bad chunk, early EOF)."
+    pass
+
+
+class HeadTooLarge(FramingError):
+    "Raised when a message head has too many headers, or is too long."
+    pass
+
+
+class BodyTooLarge(FramingError):
+    "Raised when a streamed body goes over its size limit."
+    pass
+
+
+head_end_regex = re.compile(r"\r?\n\r?\n")
+# Just hex digits; int(x, 16) would also take signs, "0x" and spaces
+chunk_size_regex = re.compile(r"^[0-9A-Fa-f]+$")
+
+
+def split_head(data):
+    """
+    Splits data into (head, rest) at the first blank line.
+    Returns None if the head is not complete yet.
+    """
+    match = head_end_regex.search(data)
+    if match is None:
+        return None
+    return data[:match.end()], data[match.end():]
+
+
+def parse_head(head):
+    """
+    Parses a message head into (first_line_words, headers), where headers
+    maps lowercased names to values. Repeated headers are joined with commas.
+    """
+    lines = head.splitlines()
+    words = lines[0].split(None, 2)
+    headers = {}
+    for line in lines[1:]:
+        if ":" not in line:
+            continue
+        name, value = line.split(":", 1)
+        name = name.strip().lower()
+        value = value.strip()
+        if name in headers:
+            headers[name] = "%s, %s" % (headers[name], value)
+        else:
+            headers[name] = value
+    return words, headers
+
+
+def rewrite_head(head, remove=(), add=()):
+    """
+    Returns head with every header named in remove (lowercase) dropped
+    and the (name, value) pairs in add appended.
+    """
+    lines = head.splitlines()
+    out = [lines[0]]
+    for line in lines[1:]:
+        if not line:
+            continue
+        if line.split(":", 1)[0].strip().lower() in remove:
+            continue
+        out.append(line)
+    for name, value in add:
+        out.append("%s: %s" % (name, value))
+    out.append("\r\n")
+    return "\r\n".join(out)
+
+
+def content_length(headers):
+    "Returns the Content-Length from parsed headers, or None if absent."
+    value = headers.get("content-length")
+    if value is None:
+        return None
+    try:
+        length = int(value)
+    except ValueError:
+        raise FramingError("Invalid Content-Length: %r" % value)
+    if length < 0:
+        raise FramingError("Invalid Content-Length: %r" % value)
+    return length
+
+
+def is_chunked(headers):
+    "Says if the final transfer coding in parsed headers is chunked."
+    codings = headers.get("transfer-encoding", "")
+    return codings.split(",")[-1].strip().lower() == "chunked"
+
+
+def wants_keepalive(version, headers):
+    "Says if the sender of a message is happy to reuse its connection."
+    tokens = [token.strip().lower() for token in headers.get("connection", "").split(",")]
+    if "close" in tokens:
+        return False
+    if version.upper() == "HTTP/1.0":
+        return "keep-alive" in tokens
+    return True
+
+
+class Headers(object):
+    """
+    Case-insensitive view over the raw header lines of a message head.
+    Lines are kept as they arrived; setting or deleting a header only
+    touches that header's lines, and render() joins them back up.
+    """
+
+    __slots__ = ["lines", "index"]
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.index = {}
+        for position, line in enumerate(lines):
+            name = line.split(":", 1)[0].strip().lower()
+            self.index.setdefault(name, []).append(position)
+
+    def get(self, name, default=None):
+        "Returns the header's value, with repeats joined by commas"
+        positions = self.index.get(name.lower())
+        if not positions:
+            return default
+        return ", ".join(self.lines[position].split(":", 1)[1].strip() for position in positions)
+
+    def __contains__(self, name):
+        return bool(self.index.get(name.lower()))
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        "Replaces every existing header of this name with a single one"
+        self.__delitem__(name)
+        self.index[name.lower()] = [len(self.lines)]
+        self.lines.append("%s: %s\r\n" % (name, value))
+
+    def __delitem__(self, name):
+        for position in self.index.pop(name.lower(), []):
+            self.lines[position] = ""
+
+    def render(self):
+        "Returns the header lines, ending with the blank line"
+        return "".join(self.lines) + "\r\n"
+
+
+class HeadParser(object):
+    """
+    Parses a message head incrementally as data is fed in, line by line
+    on a single bytearray, so a head that is too large or has too many
+    headers is refused before it has all arrived.
+    """
+
+    def __init__(self, max_size=65536, max_headers=100):
+        self.max_size = max_size
+        self.max_headers = max_headers
+        self.buffer = bytearray()
+        self.position = 0
+        self.first_line = None
+        self.lines = []
+        self.headers = None
+
+    def feed(self, data):
+        """
+        Adds data and parses any complete lines. Returns True once the
+        blank line ending the head has been seen.
+        """
+        buffer = self.buffer
+        buffer.extend(data)
+        while True:
+            end = buffer.find("\n", self.position)
+            if end == -1:
+                if len(buffer) > self.max_size:
+                    raise HeadTooLarge("Message head too large")
+                return False
+            line = str(buffer[self.position:end + 1])
+            self.position = end + 1
+            if self.position > self.max_size:
+                raise HeadTooLarge("Message head too large")
+            if self.first_line is None:
+                # Blank lines before a request are allowed (RFC 7230 3.5)
+                if line.strip():
+                    self.first_line = line
+            elif line == "\r\n" or line == "\n":
+                self.headers = Headers(self.lines)
+                return True
+            elif line[0] in " \t" or ":" not in line:
+                # Folded header values are refused rather than unfolded
+                raise FramingError("Invalid header line: %r" % line)
+            elif line.index(":") == 0 or line[line.index(":") - 1] in " \t":
+                # No whitespace is allowed before the colon (RFC 7230 3.2.4)
+                raise FramingError("Invalid header name: %r" % line)
+            else:
+                self.lines.append(line)
+                if len(self.lines) > self.max_headers:
+                    raise HeadTooLarge("Too many headers")
+
+    @property
+    def words(self):
+        "The words of the first line (method, path and version for requests)"
+        return self.first_line.split()
+
+    def rest(self):
+        "Returns any data fed in after the end of the head"
+        return str(self.buffer[self.position:])
+
+
+class SocketReader(object):
+    """
+    Buffered reader over a socket that knows how long HTTP messages are.
+    Anything read past the end of a message stays in the buffer.
+    """
+
+    chunk_size = 32768
+
+    def __init__(self, sock, data=""):
+        self.sock = sock
+        self.buffer = data
+
+    def fill(self):
+        "Reads more data into the buffer. Returns False on EOF."
+        data = self.sock.recv(self.chunk_size)
+        if not data:
+            return False
+        self.buffer += data
+        return True
+
+    def read_head(self, max_size=65536):
+        """
+        Reads up to and including the blank line ending a message head.
+        Returns None if the connection closes before any data arrives.
+        """
+        while True:
+            split = split_head(self.buffer)
+            if split is not None:
+                head, self.buffer = split
+                return head
+            if len(self.buffer) > max_size:
+                raise FramingError("Message head too large")
+            if not self.fill():
+                if not self.buffer:
+                    return None
+                raise FramingError("Connection closed inside message head")
+
+    def read_parsed_head(self, max_size=65536, max_headers=100):
+        """
+        Reads a message head through a HeadParser, returning the parser.
+        Returns None if the connection closes before any data arrives.
+        """
+        parser = HeadParser(max_size, max_headers)
+        data, self.buffer = self.buffer, ""
+        while not parser.feed(data):
+            data = self.sock.recv(self.chunk_size)
+            if not data:
+                if not parser.buffer:
+                    return None
+                raise FramingError("Connection closed inside message head")
+        self.buffer = parser.rest()
+        return parser
+
+    def read_line(self, max_size=4096):
+        "Reads a single CRLF-terminated line, including the terminator."
+        while True:
+            index = self.buffer.find("\n")
+            if index != -1:
+                line, self.buffer = self.buffer[:index + 1], self.buffer[index + 1:]
+                return line
+            if len(self.buffer) > max_size:
+                raise FramingError("Line too long")
+            if not self.fill():
+                raise FramingError("Connection closed inside line")
+
+    def relay_exact(self, length, out_sock):
+        "Relays exactly length bytes to out_sock."
+        while length > 0:
+            if not self.buffer and not self.fill():
+                raise FramingError("Connection closed with %i bytes left" % length)
+            data, self.buffer = self.buffer[:length], self.buffer[length:]
+            out_sock.sendall(data)
+            length -= len(data)
+
+    def relay_chunked(self, out_sock, max_size=None):
+        """
+        Relays a chunked body, including its trailers, to out_sock.
+        Raises BodyTooLarge once the body goes over max_size bytes.
+        """
+        total = 0
+        while True:
+            line = self.read_line()
+            size = line.split(";", 1)[0].strip()
+            if not chunk_size_regex.match(size):
+                raise FramingError("Invalid chunk size line: %r" % line)
+            size = int(size, 16)
+            total += size
+            if max_size and total > max_size:
+                raise BodyTooLarge("Chunked body over %i bytes" % max_size)
+            out_sock.sendall(line)
+            if size == 0:
+                break
+            # Chunk data plus its trailing CRLF
+            self.relay_exact(size + 2, out_sock)
+        # Trailers, up to the final blank line
+        while True:
+            line = self.read_line()
+            out_sock.sendall(line)
+            if not line.strip():
+                break
+
+    def relay_until_close(self, out_sock):
+        "Relays everything until the connection closes."
+        if self.buffer:
+            out_sock.sendall(self.buffer)
+            self.buffer = ""
+        while True:
+            data = self.sock.recv(self.chunk_size)
+            if not data:
+                break
+            out_sock.sendall(data)
+
+    def relay_body(self, headers, out_sock, length=None):
+        """
+        Relays a body framed by the parsed headers, or of a known length.
+        Returns False if the body could only be delimited by closing.
+        """
+        if length is None and is_chunked(headers):
+            self.relay_chunked(out_sock)
+            return True
+        if length is None:
+            length = content_length(headers)
+        if length is None:
+            self.relay_until_close(out_sock)
+            return False
+        self.relay_exact(length, out_sock)
+        return True
@@ -0,0 +1,63 @@
+from .histogram import Histogram
+
+
+class HostStats(object):
+    """
+    Counters and latency histograms for one matched host. Actions keep a
+    reference to theirs, so recording a request is just attribute updates.
+    """
+
+    __slots__ = ["open_requests", "completed_requests", "bytes_sent", "bytes_received", "shed_requests", "connect_timeouts", "idle_timeouts", "request_timeouts", "total", "ttfb"]
+
+    counters = ("open_requests", "completed_requests", "bytes_sent", "bytes_received", "shed_requests", "connect_timeouts", "idle_timeouts", "request_timeouts")
+
+    def __init__(self, counts=None):
+        self.reset()
+        if counts:
+            self.update(counts)
+
+    def reset(self):
+        "Zeroes everything (apart from requests still open)"
+        self.open_requests = getattr(self, "open_requests", 0)
+        self.completed_requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.shed_requests = 0
+        self.connect_timeouts = 0
+        self.idle_timeouts = 0
+        self.request_timeouts = 0
+        self.total = Histogram()
+        self.ttfb = Histogram()
+
+    def update(self, counts):
+        "Sets the counters from a dict of them"
+        for name in self.counters:
+            setattr(self, name, counts.get(name, 0))
+
+    def counts(self):
+        "Returns the counters as a dict, as saved in the state file"
+        return dict((name, getattr(self, name)) for name in self.counters)
+
+    def copy(self):
+        "Returns a copy, much more cheaply than to_dict()"
+        stats = HostStats.__new__(HostStats)
+        stats.open_requests = self.open_requests
+        stats.completed_requests = self.completed_requests
+        stats.bytes_sent = self.bytes_sent
+        stats.bytes_received = self.bytes_received
+        stats.shed_requests = self.shed_requests
+        stats.connect_timeouts = self.connect_timeouts
+        stats.idle_timeouts = self.idle_timeouts
+        stats.request_timeouts = self.request_timeouts
+        stats.total = self.total.copy()
+        stats.ttfb = self.ttfb.copy()
+        return stats
+
+    def to_dict(self):
+        "Returns the counters and raw latency histograms as plain dicts"
+        stats = self.counts()
+        stats['latency'] = {
+            "total": self.total.to_dict(),
+            "ttfb": self.ttfb.to_dict(),
+        }
+        return stats
@@ -2,19 +2,32 @@ import eventlet
 import errno
 import logging
 import traceback
-import mimetools
 import resource
 import json
 import os
+import struct
 import sys
+import time
 import argparse
-from eventlet import wsgi
+from collections import deque
+from eventlet import wsgi, tpool
+from eventlet.event import Event
+from eventlet.semaphore import Semaphore
 from eventlet.green import socket
+from eventlet.timeout import Timeout
 from .actions import Unknown, Proxy, Empty, Static, Redirect, NoHosts, Spin
 from .config import SimpleConfig
 from .management import ManagementApp
 from .stats_socket import StatsSocket
 from .greenbody import GreenBody
+from .router import HostRouter
+from .lru import LRUCache
+from .pool import ConnectionPool
+from .framing import SocketReader, FramingError, HeadTooLarge, content_length, is_chunked, wants_keepalive
+from .workers import WorkerSupervisor
+from .replication import Replicator
+from .backends import Backend, HealthChecker
+from .host_stats import HostStats
 
 
 class Balancer(object):
@@ -24,6 +37,10 @@ class Balancer(object):
 
     nofile = 102400
     save_interval = 10
+    reap_interval = 5
+    max_head_size = 65536
+    max_headers = 100
+    changelog_size = 10000
     action_mapping = {
         "proxy": Proxy,
         "empty": Empty,
@@ -34,7 +51,7 @@ class Balancer(object):
         "no_hosts": NoHosts,
     }
 
-    def __init__(self, external_addresses, internal_addresses, management_addresses, state_file, uid=None, gid=65535, static_dir="/etc/mantrid/static/"):
+    def __init__(self, external_addresses, internal_addresses, management_addresses, state_file, uid=None, gid=65535, static_dir="/etc/mantrid/static/", host_cache_size=10000, backend_max_idle=8, backend_max_age=60, client_keepalive=False, keepalive_timeout=30, splice=False, workers=1, max_body_size=0, max_connections=0, header_timeout=30, connect_timeout=10, idle_timeout=300, request_timeout=0, replicate_from=None):
         """
         Constructor.
 
@@ -48,9 +65,54 @@ class Balancer(object):
         self.internal_addresses = internal_addresses
         self.management_addresses = management_addresses
         self.state_file = state_file
+        self.journal_file = state_file and state_file + ".journal"
+        self.journal = None
+        self.journal_entries = []
+        # Changes waiting for the journal writer, as (generation, line),
+        # with None for the line when the whole table was replaced
+        self.journal_queue = []
+        self.journal_event = Event()
+        self.journal_lock = Semaphore()
+        self.saved_generation = 0
         self.uid = uid
         self.gid = gid
         self.static_dir = static_dir
+        self.generation = 0
+        self.dirty = False
+        self.host_cache = LRUCache(host_cache_size)
+        self.backend_pool = ConnectionPool(backend_max_idle, backend_max_age)
+        self.backends = {}
+        # Which backends each proxy rule uses, and the health settings each
+        # backend gets from each rule, as {address: {hostname: settings}}
+        self.host_backends = {}
+        self.backend_settings = {}
+        self.stats = {}
+        self.client_keepalive = client_keepalive
+        self.keepalive_timeout = keepalive_timeout
+        self.splice = splice
+        self.workers = workers
+        self.max_body_size = max_body_size
+        self.max_connections = max_connections
+        self.open_connections = 0
+        self.shed_connections = 0
+        self.header_timeout = header_timeout
+        self.header_timeouts = 0
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self.request_timeout = request_timeout
+        self.replicate_from = replicate_from
+        self.replicator = None
+        self.listeners = []
+        self.overloaded = Static(self, None, "overloaded", type="overloaded")
+        self.supervisor = None
+        # Requests waiting for a host's rule to change, as
+        # {host: [Event, number waiting]}
+        self.host_waiters = {}
+        # Recent changes to the hosts table, as (generation, change), and
+        # an event fired (and replaced) on each one, for watchers
+        self.changelog = deque(maxlen=self.changelog_size)
+        self.generation_event = Event()
+        self.hosts = {}
 
     @classmethod
     def main(cls):
@@ -70,11 +132,6 @@ class Balancer(object):
         ))
         sh.setLevel(logging.DEBUG)
         logger.addHandler(sh)
-        # Check they have root access
-        try:
-            resource.setrlimit(resource.RLIMIT_NOFILE, (cls.nofile, cls.nofile))
-        except (ValueError, resource.error):
-            logging.warning("Cannot raise resource limits (run as root/change ulimits)")
         # Load settings from the config file
         if args.config is None:
             if os.path.exists("/etc/mantrid/mantrid.conf"):
@@ -86,6 +143,12 @@ class Balancer(object):
         else:
             logging.info("Using configuration file %s" % args.config)
         config = SimpleConfig(args.config)
+        # Check they have root access
+        nofile = config.get_int("nofile", cls.nofile)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (nofile, nofile))
+        except (ValueError, resource.error):
+            logging.warning("Cannot raise resource limits (run as root/change ulimits)")
         balancer = cls(
             config.get_all_addresses("bind", set([(("::", 80), socket.AF_INET6)])),
             config.get_all_addresses("bind_internal"),
@@ -94,11 +157,25 @@ class Balancer(object):
             config.get_int("uid", 4321),
             config.get_int("gid", 4321),
             config.get("static_dir", "/etc/mantrid/static/"),
+            config.get_int("host_cache_size", 10000),
+            config.get_int("backend_max_idle", 8),
+            config.get_int("backend_max_age", 60),
+            config.get("client_keepalive", "false").lower() == "true",
+            config.get_int("keepalive_timeout", 30),
+            config.get("splice", "false").lower() == "true",
+            config.get_int("workers", 1),
+            config.get_int("max_body_size", 0),
+            config.get_int("max_connections", 0),
+            config.get_int("header_timeout", 30),
+            config.get_int("connect_timeout", 10),
+            config.get_int("idle_timeout", 300),
+            config.get_int("request_timeout", 0),
+            config.get("replicate_from", None),
         )
         balancer.run()
 
     def load(self):
-        "Loads the state from the state file"
+        "Loads the state from the state file, then replays the journal"
         try:
             if os.path.getsize(self.state_file) <= 1:
                 raise IOError("File is empty.")
@@ -106,21 +183,363 @@ class Balancer(object):
                 state = json.load(fh)
                 assert isinstance(state, dict)
                 self.hosts = state['hosts']
-                self.stats = state['stats']
-            for key in self.stats:
-                self.stats[key]['open_requests'] = 0
+                self.stats = dict(
+                    (host, HostStats(counts))
+                    for host, counts in state['stats'].items()
+                )
+                self.generation = state.get('generation', 0)
+            self.saved_generation = self.generation
+            for stats in self.stats.values():
+                stats.open_requests = 0
         except (IOError, OSError):
             # There is no state file; start empty.
             self.hosts = {}
             self.stats = {}
+            self.generation = 0
+        # Loading the table went through hosts_changed with the wrong
+        # generations; watchers will have to start from a full table
+        self.changelog.clear()
+        self.dirty = self.replay_journal()
+
+    def replay_journal(self):
+        """
+        Applies the journal entries newer than the loaded snapshot.
+        Returns True if any were applied.
+        """
+        if not self.journal_file or not os.path.exists(self.journal_file):
+            return False
+        replayed = 0
+        with open(self.journal_file) as fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A partly-written last entry from a crash; ignore it.
+                    logging.warning("Ignoring incomplete journal entry in %s" % self.journal_file)
+                    break
+                generation, change = entry[0], entry[1:]
+                if generation <= self.generation:
+                    continue
+                if change[0] == "set":
+                    self.set_host(change[1], change[2])
+                elif change[0] == "delete":
+                    self.delete_host(change[1])
+                elif change[0] == "patch":
+                    self.patch_hosts(change[1], change[2])
+                elif change[0] == "replace":
+                    self.hosts = change[1]
+                self.generation = generation
+                replayed += 1
+        if replayed:
+            logging.info("Replayed %i journal entries" % replayed)
+        return bool(replayed)
+
+    def _get_hosts(self):
+        return self._hosts
+
+    def _set_hosts(self, hosts):
+        self._hosts = hosts
+        self.router = HostRouter(self, hosts)
+        self.hosts_changed(["replace", hosts])
+
+    hosts = property(_get_hosts, _set_hosts, doc="""
+        The hosts table. Assigning to it recompiles the routing table;
+        single entries should be changed via set_host and delete_host.
+    """)
+
+    def set_host(self, hostname, details):
+        "Adds or replaces a single entry in the hosts table"
+        self._hosts[hostname] = details
+        self.router.add(hostname, details)
+        self.hosts_changed(["set", hostname, details])
+
+    def delete_host(self, hostname):
+        "Removes a single entry from the hosts table, if it exists"
+        if self._hosts.pop(hostname, None) is not None:
+            self.router.remove(hostname)
+            self.hosts_changed(["delete", hostname])
+
+    def patch_hosts(self, set_hosts, delete_hosts):
+        """
+        Applies a batch of changes to the hosts table as a single change:
+        set_hosts maps hostnames to their new entries, and delete_hosts
+        lists hostnames to remove.
+        """
+        for hostname in delete_hosts:
+            if self._hosts.pop(hostname, None) is not None:
+                self.router.remove(hostname)
+        for hostname, details in set_hosts.items():
+            self._hosts[hostname] = details
+            self.router.add(hostname, details)
+        self.hosts_changed(["patch", set_hosts, delete_hosts])
+
+    def hosts_changed(self, change):
+        """
+        Called after every change to the hosts table. Moves it on to a
+        new generation, marks it as needing saving and, if the journal is
+        open, queues the change for the journal writer.
+        """
+        self.generation += 1
+        self.dirty = True
+        self.changelog.append((self.generation, change))
+        event, self.generation_event = self.generation_event, Event()
+        event.send(self.generation)
+        self.wake_waiters(change)
+        self.configure_backends(change)
+        if self.journal is not None:
+            # A replaced table is saved as a snapshot instead
+            if change[0] == "replace":
+                line = None
+            else:
+                line = json.dumps([self.generation] + change) + "\n"
+            self.journal_queue.append((self.generation, line))
+            if not self.journal_event.ready():
+                self.journal_event.send()
+
+    def wait_for_change(self, host, timeout=None):
+        """
+        Parks the calling greenthread until a change to the hosts table
+        might have changed what host resolves to, or until the timeout.
+        Returns True if it was woken by a change.
+        """
+        waiter = self.host_waiters.get(host)
+        if waiter is None:
+            waiter = self.host_waiters[host] = [Event(), 0]
+        waiter[1] += 1
+        try:
+            with Timeout(timeout, False):
+                return waiter[0].wait()
+            return False
+        finally:
+            waiter[1] -= 1
+            if not waiter[1] and self.host_waiters.get(host) is waiter:
+                del self.host_waiters[host]
+
+    def wait_for_generation(self, generation, timeout=None):
+        """
+        Parks the calling greenthread until the hosts table has moved past
+        the given generation, or until the timeout.
+        Returns True if it has moved on.
+        """
+        with Timeout(timeout, False):
+            while self.generation == generation:
+                self.generation_event.wait()
+        return self.generation != generation
+
+    def changes_since(self, generation):
+        """
+        Returns the entries changed after the given generation, as
+        {hostname: current entry, or None if it was deleted}. Returns None
+        if the changelog doesn't go back that far, or the whole table was
+        replaced since, so the caller needs the full table instead.
+        """
+        if generation == self.generation:
+            return {}
+        if generation > self.generation or not self.changelog or self.changelog[0][0] > generation + 1:
+            return None
+        changed = set()
+        for entry_generation, change in self.changelog:
+            if entry_generation <= generation:
+                continue
+            if change[0] == "replace":
+                return None
+            elif change[0] == "patch":
+                changed.update(change[1])
+                changed.update(change[2])
+            else:
+                changed.add(change[1])
+        return dict((hostname, self._hosts.get(hostname)) for hostname in changed)
+
+    def wake_waiters(self, change):
+        """
+        Wakes the requests waiting in wait_for_change on hosts the change
+        could affect: the changed entry itself and its subdomains.
+        """
+        if not self.host_waiters:
+            return
+        if change[0] == "replace":
+            hosts = list(self.host_waiters)
+        else:
+            if change[0] == "patch":
+                names = list(change[1]) + list(change[2])
+            else:
+                names = [change[1]]
+            names = [name.split("://", 1)[-1] for name in names]
+            hosts = [
+                host for host in self.host_waiters
+                if any(host == name or host.endswith("." + name) for name in names)
+            ]
+        for host in hosts:
+            self.host_waiters.pop(host)[0].send(True)
+
+    def configure_backends(self, change):
+        """
+        Reapplies the health settings of the backends used by the rules a
+        change touched, so each backend follows all the live rules that
+        use it, and stops being probed once none do.
+        """
+        if change[0] == "replace":
+            hostnames = set(self.host_backends) | set(self._hosts)
+        elif change[0] == "patch":
+            hostnames = list(change[1]) + list(change[2])
+        else:
+            hostnames = [change[1]]
+        touched = set()
+        for hostname in hostnames:
+            for address in self.host_backends.pop(hostname, ()):
+                self.backend_settings[address].pop(hostname, None)
+                touched.add(address)
+            details = self._hosts.get(hostname)
+            if not details or details[0] != "proxy":
+                continue
+            settings = Proxy.health_settings(details[1])
+            addresses = set(tuple(backend[:2]) for backend in details[1].get("backends", []))
+            self.host_backends[hostname] = addresses
+            for address in addresses:
+                self.backend_settings.setdefault(address, {})[hostname] = settings
+            touched.update(addresses)
+        for address in touched:
+            users = self.backend_settings.get(address)
+            if not users:
+                self.backend_settings.pop(address, None)
+                if address not in self.backends:
+                    continue
+            self.backend(address).configure(users.values() if users else [])
+
+    def open_journal(self):
+        "Starts appending changes to the journal file"
+        self.journal = open(self.journal_file, "a")
+        self.journal_entries = []
+
+    def journal_loop(self):
+        """
+        Writes out queued journal entries as they arrive, batching up
+        whatever arrives while a write is under way.
+        """
+        while self.running:
+            self.journal_event.wait()
+            self.journal_event = Event()
+            try:
+                self.flush_journal()
+            except (IOError, OSError):
+                logging.error("Cannot write journal: %s" % traceback.format_exc())
+
+    def flush_journal(self):
+        """
+        Writes the queued journal entries in a worker thread, so the hub
+        isn't blocked. If the table was replaced, a snapshot is saved
+        instead, which covers everything queued along with it.
+        """
+        entries, self.journal_queue = self.journal_queue, []
+        entries = [entry for entry in entries if entry[0] > self.saved_generation]
+        if not entries or self.journal is None:
+            return
+        if any(line is None for generation, line in entries):
+            self.save()
+            return
+        with self.journal_lock:
+            tpool.execute(self.append_journal, "".join(line for generation, line in entries))
+            self.journal_entries.extend(entries)
+
+    def append_journal(self, lines):
+        "Appends lines to the journal file; runs in a worker thread"
+        self.journal.write(lines)
+        self.journal.flush()
+
+    def compact_journal(self, generation):
+        """
+        Rewrites the journal without the entries already saved in the
+        snapshot at the given generation. Call with journal_lock held.
+        """
+        if self.journal is None:
+            return
+        self.journal_entries = [
+            (entry_generation, line)
+            for entry_generation, line in self.journal_entries
+            if entry_generation > generation
+        ]
+        tpool.execute(self.rewrite_journal, "".join(line for entry_generation, line in self.journal_entries))
+
+    def rewrite_journal(self, lines):
+        "Replaces the journal file with just the given lines; runs in a worker thread"
+        temp_file = self.journal_file + ".tmp"
+        with open(temp_file, "w") as fh:
+            fh.write(lines)
+        os.rename(temp_file, self.journal_file)
+        self.journal.close()
+        self.journal = open(self.journal_file, "a")
+
+    def backend(self, address):
+        "Returns the shared Backend state for a (host, port) address"
+        try:
+            return self.backends[address]
+        except KeyError:
+            backend = self.backends[address] = Backend(address)
+            return backend
+
+    def backend_stats(self):
+        "Returns the state of every known backend, keyed by host:port"
+        if self.supervisor is not None:
+            return self.supervisor.backend_stats
+        return dict(
+            ("%s:%s" % backend.address, backend.to_dict())
+            for backend in self.backends.values()
+        )
+
+    def host_stats(self, host):
+        "Returns the HostStats for a matched host, creating it if needed"
+        try:
+            return self.stats[host]
+        except KeyError:
+            stats = self.stats[host] = HostStats()
+            return stats
+
+    def stats_snapshot(self, host=None):
+        """
+        Returns every host's stats as plain dicts, keyed by matched host,
+        or just the given host's. With workers, these are the totals
+        they last reported.
+        """
+        if self.supervisor is not None:
+            if host is not None:
+                return self.supervisor.host_stats.get(host, {})
+            return self.supervisor.host_stats
+        if host is not None:
+            stats = self.stats.get(host)
+            return stats.to_dict() if stats is not None else {}
+        return dict(
+            (host, stats.to_dict())
+            for host, stats in self.stats.items()
+        )
 
     def save(self):
-        "Saves the state to the state file"
-        with open(self.state_file, "w") as fh:
-            json.dump({
-                "hosts": self.hosts,
-                "stats": self.stats,
-            }, fh)
+        """
+        Saves the state to the state file. The state is copied here, but
+        encoded and written in a worker thread so the hub isn't blocked.
+        Once it is written, the journal entries it covers are dropped.
+        """
+        state = {
+            "hosts": dict(self.hosts),
+            "stats": dict((host, stats.counts()) for host, stats in self.stats.items()),
+            "generation": self.generation,
+        }
+        # Saves and journal writes take turns with the files
+        with self.journal_lock:
+            tpool.execute(self.write_state, state)
+            self.saved_generation = max(self.saved_generation, state['generation'])
+            self.compact_journal(state['generation'])
+
+    def write_state(self, state):
+        """
+        Writes out the state file atomically: the new state goes to a
+        temporary file which then replaces the old one.
+        """
+        temp_file = self.state_file + ".tmp"
+        with open(temp_file, "w") as fh:
+            json.dump(state, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(temp_file, self.state_file)
 
     def run(self):
         # First, initialise the process
@@ -135,24 +554,52 @@ class Balancer(object):
                 os.chown(state_dir, self.uid, -1)
             except OSError:
                 pass
-            try:
-                os.chown(self.state_file, self.uid, -1)
-            except OSError:
-                pass
+            for path in [self.state_file, self.journal_file]:
+                try:
+                    os.chown(path, self.uid, -1)
+                except OSError:
+                    pass
+        # With several workers, bind before forking so they all share the
+        # same listening sockets; the original process then only supervises
+        listeners = {}
+        worker = None
+        if self.workers > 1:
+            for address, family in list(self.external_addresses) + list(self.internal_addresses):
+                listeners[address, family] = self.listen(address, family)
+            self.listeners = [sock for sock in listeners.values() if sock is not None]
+            supervisor = WorkerSupervisor(self, self.workers)
+            worker = supervisor.start()
+            if worker is None:
+                self.supervisor = supervisor
+        # Only the process with the management API keeps the journal
+        if worker is None:
+            self.open_journal()
         # Then, launch the socket loops
         pool = GreenBody(
             len(self.external_addresses) +
             len(self.internal_addresses) +
             len(self.management_addresses) +
-            1
+            6
         )
-        pool.spawn(self.save_loop)
-        for address, family in self.external_addresses:
-            pool.spawn(self.listen_loop, address, family, internal=False)
-        for address, family in self.internal_addresses:
-            pool.spawn(self.listen_loop, address, family, internal=True)
-        for address, family in self.management_addresses:
-            pool.spawn(self.management_loop, address, family)
+        if worker is None:
+            pool.spawn(self.save_loop)
+            pool.spawn(self.journal_loop)
+            for address, family in self.management_addresses:
+                pool.spawn(self.management_loop, address, family)
+            if self.replicate_from:
+                self.replicator = Replicator(self, self.replicate_from)
+                pool.spawn(self.replicator.loop)
+        if self.supervisor is None:
+            pool.spawn(HealthChecker(self).loop)
+            pool.spawn(self.reap_loop)
+            for address, family in self.external_addresses:
+                pool.spawn(self.listen_loop, address, family, internal=False, sock=listeners.get((address, family)))
+            for address, family in self.internal_addresses:
+                pool.spawn(self.listen_loop, address, family, internal=True, sock=listeners.get((address, family)))
+        if worker is not None:
+            pool.spawn(supervisor.worker_loop)
+        elif self.supervisor is not None:
+            pool.spawn(self.supervisor.supervise)
         # Give the other threads a chance to open their listening sockets
         eventlet.sleep(0.5)
         # Drop to the lesser UID/GIDs, if supplied
@@ -188,21 +635,37 @@ class Balancer(object):
             logging.error(traceback.format_exc())
         # We're done
         self.running = False
+        if worker is None:
+            self.flush_journal()
+        if worker is not None:
+            os._exit(0)
+        if self.supervisor is not None:
+            self.supervisor.stop()
         logging.info("Exiting")
 
     ### Management ###
 
     def save_loop(self):
         """
-        Saves the state if it has changed.
+        Saves the state if the hosts table has changed.
         """
-        last_hash = hash(repr(self.hosts))
         while self.running:
             eventlet.sleep(self.save_interval)
-            next_hash = hash(repr(self.hosts))
-            if next_hash != last_hash:
-                self.save()
-                last_hash = next_hash
+            if self.dirty:
+                self.dirty = False
+                try:
+                    self.save()
+                except (IOError, OSError):
+                    logging.error("Cannot save state: %s" % traceback.format_exc())
+                    self.dirty = True
+
+    def reap_loop(self):
+        """
+        Closes idle backend connections that have expired.
+        """
+        while self.running:
+            eventlet.sleep(self.reap_interval)
+            self.backend_pool.reap()
 
     def management_loop(self, address, family):
         """
@@ -230,21 +693,31 @@ class Balancer(object):
 
     ### Client handling ###
 
-    def listen_loop(self, address, family, internal=False):
+    def listen(self, address, family):
         """
-        Accepts incoming connections.
+        Opens a listening socket, returning None if that isn't possible.
         """
         try:
-            sock = eventlet.listen(address, family)
+            return eventlet.listen(address, family)
         except socket.error, e:
             if e.errno == errno.EADDRINUSE:
                 logging.critical("Cannot listen on (%s, %s): already in use" % (address, family))
                 raise
             elif e.errno == errno.EACCES and address[1] <= 1024:
                 logging.critical("Cannot listen on (%s, %s) (you might need to launch as root)" % (address, family))
-                return
+                return None
             logging.critical("Cannot listen on (%s, %s): %s" % (address, family, e))
-            return
+            return None
+
+    def listen_loop(self, address, family, internal=False, sock=None):
+        """
+        Accepts incoming connections, on sock if it's already listening.
+        """
+        if sock is None:
+            sock = self.listen(address, family)
+            if sock is None:
+                return
+            self.listeners.append(sock)
         # Sleep to ensure we've dropped privileges by the time we start serving
         eventlet.sleep(0.5)
         # Start serving
@@ -253,85 +726,100 @@ class Balancer(object):
             eventlet.serve(
                 sock,
                 lambda sock, addr: self.handle(sock, addr, internal),
-                concurrency = 10000,
+                concurrency = self.accept_concurrency(),
             )
         finally:
             sock.close()
 
     def resolve_host(self, host, protocol="http"):
-        # Special case for empty hosts dict
-        if not self.hosts:
-            return NoHosts(self, host, "unknown")
-        # Check for an exact or any subdomain matches
-        bits = host.split(".")
-        for i in range(len(bits)):
-            for prefix in ["%s://" % protocol, ""]:
-                subhost = prefix + (".".join(bits[i:]))
-                if subhost in self.hosts:
-                    action, kwargs, allow_subs = self.hosts[subhost]
-                    if allow_subs or i == 0:
-                        action_class = self.action_mapping[action]
-                        return action_class(
-                            balancer = self,
-                            host = host,
-                            matched_host = subhost,
-                            **kwargs
-                        )
-        return Unknown(self, host, "unknown")
+        # Any change to the hosts table bumps the generation, which
+        # invalidates every cached lookup (including cached misses) at once
+        cache = self.host_cache
+        if cache.generation != self.generation:
+            cache.clear(self.generation)
+        key = (host, protocol)
+        try:
+            route = cache[key]
+        except KeyError:
+            route = cache[key] = self.router.lookup(host, protocol)
+        return self.router.action_for(route, host)
+
+    def accept_concurrency(self):
+        """
+        How many connections each listener will have open at once. With
+        max_connections set, there is headroom above it so the excess
+        can be accepted and shed quickly; beyond that they wait in the
+        accept queue.
+        """
+        if self.max_connections:
+            return self.max_connections * 2
+        return 10000
+
+    def accept_queue(self):
+        """
+        Returns (queued, limit) for the listening sockets' accept queues,
+        from TCP_INFO, or None where that isn't available.
+        """
+        if not hasattr(socket, "TCP_INFO"):
+            return None
+        queued = limit = 0
+        for sock in self.listeners:
+            try:
+                info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 32)
+            except socket.error:
+                return None
+            # For listening sockets, tcpi_unacked is the current queue
+            # length and tcpi_sacked its limit
+            unacked, sacked = struct.unpack("8x16xII", info[:32])
+            queued += unacked
+            limit += sacked
+        return queued, limit
+
+    def balancer_stats(self):
+        "Returns statistics about the balancer itself rather than a host"
+        stats = {
+            "generation": self.generation,
+            "host_cache_entries": len(self.host_cache),
+            "host_cache_hits": self.host_cache.hits,
+            "host_cache_misses": self.host_cache.misses,
+            "open_connections": self.open_connections,
+            "shed_connections": self.shed_connections,
+            "header_timeouts": self.header_timeouts,
+            "spinning_requests": sum(waiter[1] for waiter in self.host_waiters.values()),
+        }
+        if self.replicator is not None and self.replicator.generation is not None:
+            stats['leader_generation'] = self.replicator.generation
+        accept_queue = self.accept_queue()
+        if accept_queue is not None:
+            stats['accept_queue'], stats['accept_queue_limit'] = accept_queue
+        if self.supervisor is not None:
+            # The workers do the lookups, so report their caches instead
+            stats.update(self.supervisor.balancer_stats())
+        return stats
 
     def handle(self, sock, address, internal=False):
         """
         Handles an incoming HTTP connection.
         """
+        self.open_connections += 1
         try:
-            sock = StatsSocket(sock)
-            rfile = sock.makefile('rb', 4096)
-            # Read the first line
-            first = rfile.readline().strip("\r\n")
-            words = first.split()
-            # Ensure it looks kind of like HTTP
-            if not (2 <= len(words) <= 3):
-                sock.sendall("HTTP/1.0 400 Bad Request\r\nConnection: close\r\nContent-length: 0\r\n\r\n")
+            if self.max_connections and self.open_connections > self.max_connections:
+                # Turn it away straight away with a pre-loaded page,
+                # rather than let everyone's requests slow down
+                self.shed_connections += 1
+                self.overloaded.handle(sock, "", "/", {})
                 return
-            path = words[1]
-            # Read the headers
-            headers = mimetools.Message(rfile, 0)
-            # Work out the host
-            try:
-                host = headers['Host']
-            except KeyError:
-                host = "unknown"
-            headers['Connection'] = "close"
-            if not internal:
-                headers['X-Forwarded-For'] = address[0]
-                headers['X-Forwarded-Protocol'] = ""
-                headers['X-Forwarded-Proto'] = ""
-            # Make sure they're not using odd encodings
-            if "Transfer-Encoding" in headers:
-                sock.sendall("HTTP/1.0 411 Length Required\r\nConnection: close\r\nContent-length: 0\r\n\r\n")
-                return
-            # Match the host to an action
-            protocol = "http"
-            if headers.get('X-Forwarded-Protocol', headers.get('X-Forwarded-Proto', "")).lower() in ("ssl", "https"):
-                protocol = "https"
-            action = self.resolve_host(host, protocol)
-            # Record us as an open connection
-            stats_dict = self.stats.setdefault(action.matched_host, {})
-            stats_dict['open_requests'] = stats_dict.get('open_requests', 0) + 1
-            # Run the action
-            try:
-                rfile._rbuf.seek(0)
-                action.handle(
-                    sock = sock,
-                    read_data = first + "\r\n" + str(headers) + "\r\n" + rfile._rbuf.read(),
-                    path = path,
-                    headers = headers,
-                )
-            finally:
-                stats_dict['open_requests'] -= 1
-                stats_dict['completed_requests'] = stats_dict.get('completed_requests', 0) + 1
-                stats_dict['bytes_sent'] = stats_dict.get('bytes_sent', 0) + sock.bytes_sent
-                stats_dict['bytes_received'] = stats_dict.get('bytes_received', 0) + sock.bytes_received
+            if self.client_keepalive:
+                # Responses are written in pieces, and a keep-alive client
+                # won't close the connection to flush them
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock = StatsSocket(sock)
+            reader = SocketReader(sock)
+            # Serve requests until one of them can't leave the connection
+            # usable (or keep-alive isn't enabled)
+            first = True
+            while self.handle_request(sock, reader, address, internal, first):
+                first = False
         except socket.error, e:
             if e.errno not in (errno.EPIPE, errno.ETIMEDOUT, errno.ECONNRESET):
                 logging.error(traceback.format_exc())
@@ -343,11 +831,103 @@ class Balancer(object):
                 if e.errno != errno.EPIPE:
                     raise
         finally:
+            self.open_connections -= 1
             try:
                 sock.close()
-                rfile.close()
             except:
                 logging.error(traceback.format_exc())
 
+    def handle_request(self, sock, reader, address, internal=False, first=True):
+        """
+        Reads and handles a single HTTP request from the connection.
+        Returns True if another request may follow on the same connection.
+        """
+        bytes_sent, bytes_received = sock.bytes_sent, sock.bytes_received
+        # Read the request head. The whole head has to arrive within
+        # header_timeout, so clients can't hold connections open by
+        # trickling it in; idle keep-alive connections only get
+        # keepalive_timeout to send their next request.
+        parser = None
+        timed_out = True
+        try:
+            with Timeout((self.header_timeout if first else self.keepalive_timeout) or None, False):
+                parser = reader.read_parsed_head(self.max_head_size, self.max_headers)
+                timed_out = False
+        except HeadTooLarge:
+            sock.sendall("HTTP/1.0 431 Request Header Fields Too Large\r\nConnection: close\r\nContent-length: 0\r\n\r\n")
+            return False
+        except FramingError:
+            sock.sendall("HTTP/1.0 400 Bad Request\r\nConnection: close\r\nContent-length: 0\r\n\r\n")
+            return False
+        if timed_out and first:
+            self.header_timeouts += 1
+            sock.sendall("HTTP/1.0 408 Request Timeout\r\nConnection: close\r\nContent-length: 0\r\n\r\n")
+            return False
+        if parser is None:
+            return False
+        first_line = parser.first_line.strip("\r\n")
+        words = parser.words
+        # Ensure it looks kind of like HTTP
+        if not (2 <= len(words) <= 3):
+            sock.sendall("HTTP/1.0 400 Bad Request\r\nConnection: close\r\nContent-length: 0\r\n\r\n")
+            return False
+        path = words[1]
+        headers = parser.headers
+        started = time.time()
+        # Work out the host
+        host = headers.get("Host", "unknown")
+        keep_alive = self.client_keepalive and len(words) == 3 and wants_keepalive(words[2], headers)
+        headers['Connection'] = "close"
+        if not internal:
+            headers['X-Forwarded-For'] = address[0]
+            headers['X-Forwarded-Protocol'] = ""
+            headers['X-Forwarded-Proto'] = ""
+        # Chunked is the only transfer coding we can find the end of, and
+        # a Content-Length alongside it could be used to smuggle requests
+        if "Transfer-Encoding" in headers:
+            if not is_chunked(headers) or "Content-Length" in headers:
+                sock.sendall("HTTP/1.0 400 Bad Request\r\nConnection: close\r\nContent-length: 0\r\n\r\n")
+                return False
+            # The body is streamed straight from the socket, so whatever
+            # follows it can't be kept for a next request
+            keep_alive = False
+        # Work out which buffered data belongs to this request. On a
+        # keep-alive connection anything after its body is the next request.
+        if keep_alive:
+            try:
+                length = content_length(headers) or 0
+            except FramingError:
+                sock.sendall("HTTP/1.0 400 Bad Request\r\nConnection: close\r\nContent-length: 0\r\n\r\n")
+                return False
+            body, reader.buffer = reader.buffer[:length], reader.buffer[length:]
+        else:
+            body, reader.buffer = reader.buffer, ""
+        # Match the host to an action
+        protocol = "http"
+        if headers.get('X-Forwarded-Protocol', headers.get('X-Forwarded-Proto', "")).lower() in ("ssl", "https"):
+            protocol = "https"
+        action = self.resolve_host(host, protocol)
+        # Record us as an open connection
+        stats = action.host_stats()
+        stats.open_requests += 1
+        # Run the action
+        head = first_line + "\r\n" + headers.render()
+        try:
+            return action.handle(
+                sock = sock,
+                read_data = head + body,
+                path = path,
+                headers = headers,
+                keep_alive = keep_alive,
+                body_offset = len(head),
+                reader = reader,
+            ) is True and keep_alive
+        finally:
+            stats.open_requests -= 1
+            stats.completed_requests += 1
+            stats.bytes_sent += sock.bytes_sent - bytes_sent
+            stats.bytes_received += sock.bytes_received - bytes_received
+            stats.total.record(time.time() - started)
+
 if __name__ == "__main__":
     Balancer.main()
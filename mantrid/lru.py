@@ -0,0 +1,62 @@
+class LRUCache(object):
+    """
+    Bounded mapping that evicts the least recently used key once full.
+    Entries are tagged with a generation; calling clear() with a new
+    generation drops everything at once.
+    """
+
+    def __init__(self, size, generation=0):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.clear(generation)
+
+    def clear(self, generation=None):
+        "Empties the cache, optionally moving it to a new generation"
+        if generation is not None:
+            self.generation = generation
+        self.data = {}
+        # Circular list of [prev, next, key, value] links; the link after
+        # root is the most recently used entry, the one before it the least
+        self.root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        link = self.data.get(key)
+        if link is None:
+            # A disabled cache never holds anything, so isn't missing
+            if self.size > 0:
+                self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        # Move it to the front
+        root = self.root
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+        first = root[1]
+        link[0] = root
+        link[1] = first
+        first[0] = root[1] = link
+        return link[3]
+
+    def __setitem__(self, key, value):
+        if self.size <= 0:
+            return
+        link = self.data.get(key)
+        if link is not None:
+            link[3] = value
+            return
+        root = self.root
+        if len(self.data) >= self.size:
+            # Evict the least recently used entry
+            last = root[0]
+            del self.data[last[2]]
+            root[0] = last[0]
+            last[0][1] = root
+        first = root[1]
+        link = [root, first, key, value]
+        first[0] = root[1] = self.data[key] = link
@@ -1,5 +1,12 @@
+import bisect
+import itertools
 import json
 import re
+import urlparse
+import eventlet
+from .actions import Static
+from .histogram import summarise
+from . import metrics
 
 
 class HttpNotFound(Exception):
@@ -17,6 +24,38 @@ class HttpBadRequest(Exception):
     pass
 
 
+class RawResponse(object):
+    "A handler's response that is sent as it is, rather than as JSON."
+
+    def __init__(self, content_type, body, headers=None):
+        self.content_type = content_type
+        self.body = body
+        self.headers = headers or []
+
+
+def json_object_chunks(items, entries_per_chunk=500):
+    """
+    Encodes an iterable of (key, value) pairs as a JSON object, a chunk
+    at a time. Other greenthreads get to run between chunks, so a large
+    listing never holds up the hub.
+    """
+    chunk = ["{"]
+    first = True
+    for key, value in items:
+        if not first:
+            chunk.append(", ")
+        first = False
+        chunk.append(json.dumps(key))
+        chunk.append(": ")
+        chunk.append(json.dumps(value))
+        if len(chunk) >= entries_per_chunk * 4:
+            yield "".join(chunk)
+            chunk = []
+            eventlet.sleep(0)
+    chunk.append("}")
+    yield "".join(chunk)
+
+
 class ManagementApp(object):
     """
     Management WSGI app for the Mantrid loadbalancer.
@@ -26,9 +65,13 @@ class ManagementApp(object):
 
     host_regex = re.compile(r"^/hostname/([^/]+)/?$")
     stats_host_regex = re.compile(r"^/stats/([^/]+)/?$")
+    # Longest a watch request is held open for, in seconds
+    max_watch_timeout = 300
 
     def __init__(self, balancer):
         self.balancer = balancer
+        # Sorted keys for paginated listings, by listing name
+        self.sorted_keys_cache = {}
 
     def handle(self, environ, start_response):
         "Main entry point"
@@ -47,15 +90,47 @@ class ManagementApp(object):
         except HttpMethodNotAllowed:
             start_response('405 Method Not Allowed', [('Content-Type', 'application/json')])
             return [json.dumps({"error": "method_not_allowed"})]
-        # Dispatch to the named method
+        # A replicating balancer takes its rules from the leader alone
+        if self.balancer.replicate_from and environ['REQUEST_METHOD'].lower() != "get" and environ['PATH_INFO'].lower().startswith("/hostname/"):
+            start_response('403 Forbidden', [('Content-Type', 'application/json')])
+            return [json.dumps({"error": "replica_read_only"})]
+        # Dispatch to the named method. Only reads take a query string,
+        # so changes can still be replayed in workers from path and body.
         body = environ['wsgi.input'].read()
-        if body:
-            body = json.loads(body)
-        response = handler(
-            environ['PATH_INFO'].lower(),
-            body,
-        )
+        try:
+            if body:
+                try:
+                    body = json.loads(body)
+                except ValueError:
+                    raise HttpBadRequest("body_not_json")
+            if environ['REQUEST_METHOD'].lower() == "get":
+                response = handler(
+                    environ['PATH_INFO'].lower(),
+                    body,
+                    dict(
+                        (key, values[-1])
+                        for key, values in urlparse.parse_qs(environ.get('QUERY_STRING', "")).items()
+                    ),
+                )
+            else:
+                response = handler(
+                    environ['PATH_INFO'].lower(),
+                    body,
+                )
+        except HttpBadRequest, e:
+            start_response('400 Bad Request', [('Content-Type', 'application/json')])
+            return [json.dumps({"error": str(e)})]
+        # Replay changes in any worker processes
+        if environ['REQUEST_METHOD'].lower() != "get" and self.balancer.supervisor is not None:
+            self.balancer.supervisor.broadcast(
+                handler.__name__,
+                environ['PATH_INFO'].lower(),
+                body,
+            )
         # Send the response
+        if isinstance(response, RawResponse):
+            start_response('200 OK', [('Content-Type', response.content_type)] + response.headers)
+            return response.body
         start_response('200 OK', [('Content-Type', 'application/json')])
         return [json.dumps(response)]
 
@@ -68,16 +143,38 @@ class ManagementApp(object):
                 return self.get_all_stats
             else:
                 raise HttpMethodNotAllowed()
+        elif path == "/balancer/":
+            if method == "get":
+                return self.get_balancer_stats
+            else:
+                raise HttpMethodNotAllowed()
         elif self.stats_host_regex.match(path):
             if method == "get":
                 return self.get_single_stats
             else:
                 raise HttpMethodNotAllowed()
+        elif path == "/metrics":
+            if method == "get":
+                return self.get_metrics
+            else:
+                raise HttpMethodNotAllowed()
+        elif path == "/watch/":
+            if method == "get":
+                return self.watch
+            else:
+                raise HttpMethodNotAllowed()
+        elif path == "/static/":
+            if method == "post":
+                return self.reload_static
+            else:
+                raise HttpMethodNotAllowed()
         elif path == "/hostname/":
             if method == "get":
                 return self.get_all
             elif method == "put":
                 return self.set_all
+            elif method == "patch":
+                return self.patch_all
             else:
                 raise HttpMethodNotAllowed()
         elif self.host_regex.match(path):
@@ -111,10 +208,74 @@ class ManagementApp(object):
             return "host_kwargs_not_dict"
         if not isinstance(details[2], bool):
             return "host_match_subdomains_not_bool"
-        return None
+        return self.balancer.action_mapping[details[0]].kwargs_errors(details[1])
 
-    def get_all(self, path, body):
-        return self.balancer.hosts
+    def sorted_keys(self, name, mapping):
+        """
+        Returns the mapping's keys in order. The sort is reused until the
+        hosts table changes or the mapping's size does.
+        """
+        version = (self.balancer.generation, len(mapping))
+        cached = self.sorted_keys_cache.get(name)
+        if cached is None or cached[0] != version:
+            cached = self.sorted_keys_cache[name] = (version, sorted(mapping))
+        return cached[1]
+
+    def page(self, keys, query):
+        """
+        Picks out the page of the sorted keys that the query asks for:
+        those starting with "prefix", after "cursor", up to "limit" of them.
+        Returns the keys and the cursor for the next page (None if there
+        are no more).
+        """
+        prefix = query.get("prefix", "")
+        cursor = query.get("cursor")
+        limit = query.get("limit")
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                raise HttpBadRequest("limit_invalid")
+            if limit < 1:
+                raise HttpBadRequest("limit_invalid")
+        start = bisect.bisect_left(keys, prefix)
+        if cursor is not None:
+            start = max(start, bisect.bisect_right(keys, cursor))
+        selected = []
+        for i in xrange(start, len(keys)):
+            if not keys[i].startswith(prefix):
+                break
+            if limit is not None and len(selected) >= limit:
+                return selected, selected[-1]
+            selected.append(keys[i])
+        return selected, None
+
+    def paged_response(self, keys, query, value, finish=None):
+        """
+        Streams the requested page of keys as a JSON object, with value(key)
+        giving each entry. The next page's cursor goes in an X-Next-Cursor
+        header. Values are taken when the page is chosen, so changes made
+        while it is being sent can't make it disagree with its cursor;
+        value should be cheap, and any costly work left to finish(value),
+        which is called as the entries are sent.
+        """
+        selected, next_cursor = self.page(keys, query)
+        headers = []
+        if next_cursor is not None:
+            headers.append(("X-Next-Cursor", next_cursor.encode("utf8")))
+        items = [(key, value(key)) for key in selected]
+        if finish is not None:
+            items = ((key, finish(item)) for key, item in items)
+        return RawResponse(
+            "application/json",
+            json_object_chunks(items),
+            headers,
+        )
+
+    def get_all(self, path, body, query):
+        "Returns the hosts list, or a page of it"
+        hosts = self.balancer.hosts
+        return self.paged_response(self.sorted_keys("hosts", hosts), query, hosts.get)
 
     def set_all(self, path, body):
         "Replaces the hosts list with the provided input"
@@ -131,7 +292,7 @@ class ManagementApp(object):
         self.balancer.hosts = body
         # Clean up stats dict
         for hostname in new_hostnames - old_hostnames:
-            self.balancer.stats[hostname] = {}
+            self.balancer.host_stats(hostname).reset()
         for hostname in old_hostnames - new_hostnames:
             try:
                 del self.balancer.stats[hostname]
@@ -139,7 +300,74 @@ class ManagementApp(object):
                 pass
         return {"ok": True}
 
-    def get_single(self, path, body):
+    def patch_all(self, path, body):
+        """
+        Applies a batch of changes to the hosts list as one change. The
+        body is {"set": {hostname: rule, ...}, "delete": [hostname, ...]};
+        either can be left out. Nothing is changed unless all of it is valid.
+        """
+        if not isinstance(body, dict):
+            raise HttpBadRequest("body_not_a_dict")
+        for key in body:
+            if key not in ("set", "delete"):
+                raise HttpBadRequest("body_key_invalid:%s" % key)
+        set_hosts = body.get("set", {})
+        delete_hosts = body.get("delete", [])
+        if not isinstance(set_hosts, dict):
+            raise HttpBadRequest("set_not_a_dict")
+        if not isinstance(delete_hosts, list):
+            raise HttpBadRequest("delete_not_a_list")
+        for hostname, details in set_hosts.items():
+            error = self.host_errors(hostname, details)
+            if error:
+                raise HttpBadRequest("%s:%s" % (hostname, error))
+        for hostname in delete_hosts:
+            if not hostname or not isinstance(hostname, basestring):
+                raise HttpBadRequest("%s:hostname_invalid" % (hostname,))
+            if hostname in set_hosts:
+                raise HttpBadRequest("%s:host_set_and_deleted" % hostname)
+        # Apply, keeping the stats of hosts that are only being changed
+        new_hostnames = set(set_hosts) - set(self.balancer.hosts)
+        self.balancer.patch_hosts(set_hosts, delete_hosts)
+        for hostname in new_hostnames:
+            self.balancer.host_stats(hostname).reset()
+        for hostname in delete_hosts:
+            self.balancer.stats.pop(hostname, None)
+        return {"ok": True, "generation": self.balancer.generation}
+
+    def watch(self, path, body, query):
+        """
+        Waits until the hosts table moves past the "since" generation (or
+        "timeout" seconds pass), then returns the new generation and the
+        entries that changed, with None for deleted ones. If the changes
+        can't be worked out, "reset" is true and the full table is sent.
+        """
+        try:
+            since = int(query.get("since", -1))
+        except ValueError:
+            raise HttpBadRequest("since_invalid")
+        try:
+            timeout = min(float(query.get("timeout", 30)), self.max_watch_timeout)
+        except ValueError:
+            raise HttpBadRequest("timeout_invalid")
+        self.balancer.wait_for_generation(since, max(timeout, 0))
+        generation = self.balancer.generation
+        changes = self.balancer.changes_since(since)
+        reset = changes is None
+        if reset:
+            changes = self.balancer.hosts
+        # Take the entries now, so they match the generation even though
+        # they are sent a piece at a time
+        return RawResponse(
+            "application/json",
+            itertools.chain(
+                ['{"generation": %i, "reset": %s, "hosts": ' % (generation, json.dumps(reset))],
+                json_object_chunks(changes.items()),
+                ["}"],
+            ),
+        )
+
+    def get_single(self, path, body, query):
         host = self.host_regex.match(path).group(1)
         if host in self.balancer.hosts:
             return self.balancer.hosts[host]
@@ -151,25 +379,70 @@ class ManagementApp(object):
         error = self.host_errors(host, body)
         if error:
             raise HttpBadRequest("%s:%s" % (host, error))
-        self.balancer.hosts[host] = body
-        self.balancer.stats[host] = {}
+        self.balancer.set_host(host, body)
+        self.balancer.host_stats(host).reset()
         return {"ok": True}
 
     def delete_single(self, path, body):
         host = self.host_regex.match(path).group(1)
-        try:
-            del self.balancer.hosts[host]
-        except KeyError:
-            pass
+        self.balancer.delete_host(host)
         try:
             del self.balancer.stats[host]
         except KeyError:
             pass
         return {"ok": True}
 
-    def get_all_stats(self, path, body):
-        return self.balancer.stats
+    def summarised(self, stats):
+        "Returns a host's stats with its raw latency histograms turned into percentiles"
+        stats = dict(stats)
+        stats['latency'] = dict(
+            (name, summarise(histogram))
+            for name, histogram in stats.get('latency', {}).items()
+        )
+        return stats
+
+    def get_all_stats(self, path, body, query):
+        "Returns every host's stats, or a page of them"
+        # Worker totals are replaced, never changed, so need no copying
+        if self.balancer.supervisor is not None:
+            stats = self.balancer.supervisor.host_stats
+            copy = stats.get
+            finish = lambda counts: self.summarised(counts or {})
+        else:
+            stats = self.balancer.stats
+            copy = lambda host: stats[host].copy() if host in stats else None
+            finish = lambda host_stats: self.summarised(host_stats.to_dict() if host_stats else {})
+        return self.paged_response(
+            self.sorted_keys("stats", stats),
+            query,
+            copy,
+            finish,
+        )
+
+    def get_balancer_stats(self, path, body, query):
+        "Returns stats about the balancer itself rather than any one host"
+        return self.balancer.balancer_stats()
 
-    def get_single_stats(self, path, body):
+    def get_single_stats(self, path, body, query):
         host = self.stats_host_regex.match(path).group(1)
-        return self.balancer.stats.get(host, {})
+        stats = self.summarised(self.balancer.stats_snapshot(host))
+        # Include the health of the backends a proxy rule uses
+        details = self.balancer.hosts.get(host)
+        if details and details[0] == "proxy":
+            backend_stats = self.balancer.backend_stats()
+            stats['backends'] = {}
+            for backend in details[1].get("backends", []):
+                key = "%s:%s" % tuple(backend[:2])
+                stats['backends'][key] = dict(backend_stats.get(key, {}))
+                if "ttfb" in stats['backends'][key]:
+                    stats['backends'][key]['ttfb'] = summarise(stats['backends'][key]['ttfb'])
+        return stats
+
+    def get_metrics(self, path, body, query):
+        "Returns the stats in the Prometheus text format, rendered as it is sent"
+        return RawResponse(metrics.content_type, metrics.render(self.balancer))
+
+    def reload_static(self, path, body):
+        "Makes static pages get read from disk again"
+        Static.reload()
+        return {"ok": True}
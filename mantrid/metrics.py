@@ -0,0 +1,150 @@
+"""
+Renders the balancer's statistics in the Prometheus text exposition format.
+"""
+
+import eventlet
+from .histogram import Histogram
+
+
+content_type = "text/plain; version=0.0.4"
+
+# (name, type, help, key in a host's stats dict)
+host_counters = [
+    ("mantrid_requests_total", "counter", "Requests completed, by matched host.", "completed_requests"),
+    ("mantrid_open_requests", "gauge", "Requests currently being handled, by matched host.", "open_requests"),
+    ("mantrid_bytes_received_total", "counter", "Bytes received from clients, by matched host.", "bytes_received"),
+    ("mantrid_bytes_sent_total", "counter", "Bytes sent to clients, by matched host.", "bytes_sent"),
+    ("mantrid_shed_requests_total", "counter", "Requests turned away over the host's connection limit.", "shed_requests"),
+    ("mantrid_connect_timeouts_total", "counter", "Backend connections that timed out, by matched host.", "connect_timeouts"),
+    ("mantrid_idle_timeouts_total", "counter", "Proxied requests that went idle for too long, by matched host.", "idle_timeouts"),
+    ("mantrid_request_timeouts_total", "counter", "Proxied requests that took too long overall, by matched host.", "request_timeouts"),
+]
+
+# (name, type, help, key in a backend's stats dict)
+backend_counters = [
+    ("mantrid_backend_up", "gauge", "Whether the backend is in selection.", "up"),
+    ("mantrid_backend_in_flight", "gauge", "Requests currently proxied to the backend.", "in_flight"),
+    ("mantrid_backend_requests_total", "counter", "Requests proxied to the backend.", "requests"),
+    ("mantrid_backend_connect_failures_total", "counter", "Failed connections to the backend.", "total_failures"),
+]
+
+# (name, type, help, key in the balancer's own stats dict)
+balancer_counters = [
+    ("mantrid_generation", "gauge", "Changes made to the hosts table.", "generation"),
+    ("mantrid_workers", "gauge", "Worker processes serving requests.", "workers"),
+    ("mantrid_host_cache_entries", "gauge", "Entries in the host lookup cache.", "host_cache_entries"),
+    ("mantrid_host_cache_hits_total", "counter", "Host lookups answered from the cache.", "host_cache_hits"),
+    ("mantrid_host_cache_misses_total", "counter", "Host lookups that missed the cache.", "host_cache_misses"),
+    ("mantrid_open_connections", "gauge", "Client connections currently open.", "open_connections"),
+    ("mantrid_shed_connections_total", "counter", "Client connections turned away over max_connections.", "shed_connections"),
+    ("mantrid_header_timeouts_total", "counter", "Client connections that didn't send a request head in time.", "header_timeouts"),
+    ("mantrid_leader_generation", "gauge", "Leader's generation a replicating balancer has caught up to.", "leader_generation"),
+    ("mantrid_spinning_requests", "gauge", "Requests held by spin rules waiting for a change.", "spinning_requests"),
+    ("mantrid_accept_queue", "gauge", "Connections waiting in the listening sockets' accept queues.", "accept_queue"),
+    ("mantrid_accept_queue_limit", "gauge", "Size limit of the listening sockets' accept queues.", "accept_queue_limit"),
+]
+
+# (name, help, key in a host's latency histograms)
+host_histograms = [
+    ("mantrid_request_duration_seconds", "Time taken to handle whole requests, by matched host.", "total"),
+    ("mantrid_ttfb_seconds", "Time until the backend started responding, by matched host.", "ttfb"),
+]
+
+
+def escape(value):
+    "Escapes a label value"
+    return unicode(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n").encode("utf8")
+
+
+def header(name, kind, help):
+    return "# HELP %s %s\n# TYPE %s %s\n" % (name, help, name, kind)
+
+
+def number(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def histogram_lines(name, labels, raw):
+    """
+    Yields the sample lines for one histogram. Only buckets that hold
+    something are listed, as listing every bound for every host would
+    multiply the output by the number of buckets.
+    """
+    bounds = Histogram.bounds
+    cumulative = 0
+    for index, count in sorted((int(index), count) for index, count in raw['buckets'].items()):
+        cumulative += count
+        if index < len(bounds):
+            yield '%s_bucket{%s,le="%r"} %i\n' % (name, labels, bounds[index], cumulative)
+    yield '%s_bucket{%s,le="+Inf"} %i\n' % (name, labels, raw['count'])
+    yield '%s_sum{%s} %r\n' % (name, labels, raw['sum'])
+    yield '%s_count{%s} %i\n' % (name, labels, raw['count'])
+
+
+def metric_lines(balancer):
+    """
+    Yields the lines of the exposition, one metric family at a time.
+    Only the names are listed up front; each value is read from the live
+    stats (or, with workers, their last reported totals) as it is written,
+    so nothing is copied per host.
+    """
+    if balancer.supervisor is not None:
+        host_table = balancer.supervisor.host_stats
+        backend_table = balancer.supervisor.backend_stats
+        counter = lambda stats, key: stats.get(key, 0)
+        host_histogram = lambda stats, which: stats['latency'][which]
+        backend_histogram = lambda stats: stats['ttfb']
+    else:
+        host_table = balancer.stats
+        backend_table = dict(("%s:%s" % address, backend) for address, backend in balancer.backends.items())
+        counter = lambda stats, key: getattr(stats, key)
+        host_histogram = lambda stats, which: getattr(stats, which).to_dict()
+        backend_histogram = lambda stats: stats.ttfb.to_dict()
+    hosts = sorted(host_table.keys())
+    for name, kind, help, key in host_counters:
+        yield header(name, kind, help)
+        for host in hosts:
+            # Hosts can go away between yields
+            stats = host_table.get(host)
+            if stats is not None:
+                yield '%s{host="%s"} %s\n' % (name, escape(host), number(counter(stats, key)))
+    for name, help, which in host_histograms:
+        yield header(name, "histogram", help)
+        for host in hosts:
+            stats = host_table.get(host)
+            if stats is not None:
+                for line in histogram_lines(name, 'host="%s"' % escape(host), host_histogram(stats, which)):
+                    yield line
+    backends = sorted(backend_table.keys())
+    for name, kind, help, key in backend_counters:
+        yield header(name, kind, help)
+        for backend in backends:
+            yield '%s{backend="%s"} %s\n' % (name, escape(backend), number(counter(backend_table[backend], key)))
+    yield header("mantrid_backend_ttfb_seconds", "histogram", "Time until the backend started responding.")
+    for backend in backends:
+        for line in histogram_lines("mantrid_backend_ttfb_seconds", 'backend="%s"' % escape(backend), backend_histogram(backend_table[backend])):
+            yield line
+    own_stats = balancer.balancer_stats()
+    for name, kind, help, key in balancer_counters:
+        if key in own_stats:
+            yield header(name, kind, help)
+            yield "%s %s\n" % (name, number(own_stats[key]))
+
+
+def render(balancer, lines_per_chunk=500):
+    """
+    Renders the exposition as a series of chunks, so the whole of it is
+    never held in memory at once. Other greenthreads get to run between
+    chunks, as with the JSON listings.
+    """
+    chunk = []
+    for line in metric_lines(balancer):
+        chunk.append(line)
+        if len(chunk) >= lines_per_chunk:
+            yield "".join(chunk)
+            chunk = []
+            eventlet.sleep(0)
+    if chunk:
+        yield "".join(chunk)
@@ -0,0 +1,90 @@
+import select
+import time
+import eventlet
+from eventlet.green import socket
+
+
+class PooledConnection(object):
+    "A connection to a backend, remembering where and when it was opened."
+
+    __slots__ = ["address", "sock", "created", "reused"]
+
+    def __init__(self, address, sock, created, reused=False):
+        self.address = address
+        self.sock = sock
+        self.created = created
+        self.reused = reused
+
+
+class ConnectionPool(object):
+    """
+    Keeps idle keep-alive connections to backends so they can be reused
+    by later requests, keyed by (host, port).
+    """
+
+    def __init__(self, max_idle=8, max_age=60):
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.idle = {}
+
+    @staticmethod
+    def healthy(sock):
+        """
+        Checks an idle connection is still usable. An idle socket should
+        have nothing to read; if it does, the backend has either closed it
+        or sent something we can't match to a request.
+        """
+        try:
+            readable, _, _ = select.select([sock.fileno()], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+    def get(self, address):
+        """
+        Returns a connection to the backend, reusing an idle one if possible.
+        Raises socket.error if a new connection cannot be made.
+        """
+        idle = self.idle.get(address)
+        now = time.time()
+        while idle:
+            conn = idle.pop()
+            if now - conn.created < self.max_age and self.healthy(conn.sock):
+                conn.reused = True
+                return conn
+            conn.sock.close()
+        return self.connect(address)
+
+    def connect(self, address):
+        "Opens a brand new connection to the backend."
+        sock = eventlet.connect(address)
+        # Heads and bodies go out as separate writes; don't let Nagle
+        # hold the second back waiting for an ACK
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return PooledConnection(address, sock, time.time())
+
+    def release(self, conn):
+        "Returns a connection whose last response was fully read to the pool."
+        idle = self.idle.setdefault(conn.address, [])
+        if len(idle) >= self.max_idle or time.time() - conn.created >= self.max_age:
+            conn.sock.close()
+        else:
+            idle.append(conn)
+
+    def reap(self):
+        """
+        Closes idle connections that are past max_age or have been closed
+        by the backend, so quiet backends aren't left with them open.
+        """
+        now = time.time()
+        for address, idle in self.idle.items():
+            keep = []
+            for conn in idle:
+                if now - conn.created < self.max_age and self.healthy(conn.sock):
+                    keep.append(conn)
+                else:
+                    conn.sock.close()
+            if keep:
+                idle[:] = keep
+            else:
+                del self.idle[address]
@@ -0,0 +1,68 @@
+import logging
+import eventlet
+from .client import MantridClient, httplib2
+from .management import ManagementApp, HttpBadRequest
+
+
+class Replicator(object):
+    """
+    Keeps a follower balancer's hosts table in step with a leader's, by
+    long-polling the leader's /watch/ endpoint. Changes the leader still
+    has in its changelog come across one generation at a time; anything
+    older (or a fresh start) gets a full copy of the table instead.
+    """
+
+    retry_interval = 5
+    watch_timeout = 30
+
+    def __init__(self, balancer, leader_url):
+        self.balancer = balancer
+        self.leader_url = leader_url
+        self.client = MantridClient(leader_url)
+        self.app = ManagementApp(balancer)
+        # The leader's generation we have caught up to, if any
+        self.generation = None
+        self.full_syncs = 0
+
+    def apply(self, result):
+        """
+        Applies one /watch/ result from the leader, through the same
+        handlers (and so the same stats clean-up and worker replay) as
+        changes made through our own management API.
+        """
+        if result['reset']:
+            handler_name, body = "set_all", result['hosts']
+            self.full_syncs += 1
+        else:
+            handler_name, body = "patch_all", {
+                "set": dict(
+                    (hostname, details)
+                    for hostname, details in result['hosts'].items()
+                    if details is not None
+                ),
+                "delete": [
+                    hostname
+                    for hostname, details in result['hosts'].items()
+                    if details is None
+                ],
+            }
+        getattr(self.app, handler_name)("/hostname/", body)
+        if self.balancer.supervisor is not None:
+            self.balancer.supervisor.broadcast(handler_name, "/hostname/", body)
+        self.generation = result['generation']
+
+    def loop(self):
+        "Follows the leader, reconnecting from where it left off on errors."
+        while self.balancer.running:
+            try:
+                for result in self.client.watch(self.generation, self.watch_timeout):
+                    self.apply(result)
+                    if not self.balancer.running:
+                        return
+            except (IOError, ValueError, HttpBadRequest, httplib2.HttpLib2Error), e:
+                logging.warning("Cannot replicate from %s: %s" % (self.leader_url, e))
+                # Start from scratch next time, in case what failed was
+                # a change we only half understood
+                if isinstance(e, HttpBadRequest):
+                    self.generation = None
+                eventlet.sleep(self.retry_interval)
@@ -0,0 +1,147 @@
+"""
+Compiled routing table used to match Host headers to actions.
+"""
+
+from .actions import Unknown, NoHosts
+
+
+class Route(object):
+    """
+    A single compiled host entry. Builds its action once and then
+    hands out copies bound to the requested host.
+    """
+
+    __slots__ = ["balancer", "matched_host", "action_class", "kwargs", "allow_subs", "prototype"]
+
+    def __init__(self, balancer, matched_host, action_class, kwargs, allow_subs):
+        self.balancer = balancer
+        self.matched_host = matched_host
+        self.action_class = action_class
+        self.kwargs = kwargs
+        self.allow_subs = allow_subs
+        self.prototype = None
+
+    def action(self, host):
+        "Returns the action for this route, bound to the given host"
+        if self.prototype is None:
+            self.prototype = self.action_class(
+                balancer = self.balancer,
+                host = self.matched_host,
+                matched_host = self.matched_host,
+                **self.kwargs
+            )
+            # Copies made by for_host share the prototype's stats
+            self.prototype.host_stats()
+        return self.prototype.for_host(host)
+
+
+class Node(object):
+    "One label in the reversed-label trie."
+
+    __slots__ = ["children", "routes"]
+
+    def __init__(self):
+        self.children = {}
+        self.routes = {}
+
+
+class HostRouter(object):
+    """
+    Reversed-label trie over the hosts table. "www.example.com" is stored
+    under com -> example -> www, so finding the most specific entry for a
+    host is a single walk from the top-level domain downwards.
+    Protocol-specific entries ("https://example.com") live on the same node
+    as the bare entry, keyed by their protocol.
+    """
+
+    def __init__(self, balancer, hosts):
+        self.balancer = balancer
+        self.root = Node()
+        self.size = 0
+        self.unknown = Unknown(balancer, None, "unknown")
+        self.no_hosts = NoHosts(balancer, None, "unknown")
+        for hostname, details in hosts.items():
+            self.add(hostname, details)
+
+    @staticmethod
+    def split(hostname):
+        "Splits a host key into its protocol (or '') and reversed labels"
+        if "://" in hostname:
+            protocol, hostname = hostname.split("://", 1)
+        else:
+            protocol = ""
+        labels = hostname.split(".")
+        labels.reverse()
+        return protocol, labels
+
+    def add(self, hostname, details):
+        "Adds or replaces the entry for a host key"
+        action, kwargs, allow_subs = details
+        protocol, labels = self.split(hostname)
+        node = self.root
+        for label in labels:
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = Node()
+            node = child
+        if protocol not in node.routes:
+            self.size += 1
+        node.routes[protocol] = Route(
+            self.balancer,
+            hostname,
+            self.balancer.action_mapping[action],
+            kwargs,
+            allow_subs,
+        )
+
+    def remove(self, hostname):
+        "Removes the entry for a host key, pruning empty nodes"
+        protocol, labels = self.split(hostname)
+        path = [self.root]
+        for label in labels:
+            node = path[-1].children.get(label)
+            if node is None:
+                return
+            path.append(node)
+        if path[-1].routes.pop(protocol, None) is None:
+            return
+        self.size -= 1
+        for label in reversed(labels):
+            node = path.pop()
+            if node.routes or node.children:
+                break
+            del path[-1].children[label]
+
+    def lookup(self, host, protocol="http"):
+        """
+        Returns the most specific Route matching the host, or None.
+        Deeper matches win; on the same node a protocol-specific entry
+        beats a bare one. Entries only match subdomains if they allow it.
+        """
+        labels = host.split(".")
+        depth = len(labels)
+        node = self.root
+        found = None
+        for i in range(depth - 1, -1, -1):
+            node = node.children.get(labels[i])
+            if node is None:
+                break
+            if node.routes:
+                for key in (protocol, ""):
+                    route = node.routes.get(key)
+                    if route is not None and (route.allow_subs or i == 0):
+                        found = route
+                        break
+        return found
+
+    def action_for(self, route, host):
+        "Returns an action for the host, given the Route lookup() found"
+        if route is None:
+            if not self.size:
+                return self.no_hosts.for_host(host)
+            return self.unknown.for_host(host)
+        return route.action(host)
+
+    def resolve(self, host, protocol="http"):
+        "Returns an action for the host"
+        return self.action_for(self.lookup(host, protocol), host)
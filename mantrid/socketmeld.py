@@ -1,6 +1,11 @@
+import errno
+import os
+import time
 import eventlet
 import greenlet
 from eventlet.green import socket
+from eventlet.hubs import trampoline
+from .stats_socket import StatsSocket
 
 
 class SocketMelder(object):
@@ -8,16 +13,41 @@ class SocketMelder(object):
     Takes two sockets and directly connects them together.
     """
 
-    def __init__(self, client, server):
+    # Try to get splice() using ctypes; otherwise, fall back
+    try:
+        import ctypes
+        _splice = ctypes.CDLL("libc.so.6", use_errno=True).splice
+        _splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+        _splice.restype = ctypes.c_ssize_t
+        _get_errno = staticmethod(ctypes.get_errno)
+    except Exception:
+        _splice = None
+
+    SPLICE_F_MOVE = 1
+    SPLICE_F_NONBLOCK = 2
+    chunk_size = 32768
+    pipe_size = 65536
+
+    def __init__(self, client, server, splice=False, idle_timeout=None):
         self.client = client
         self.server = server
+        self.splice = splice and self._splice is not None
+        self.idle_timeout = idle_timeout
         self.data_handled = 0
+        self.first_byte = None
+        self.last_activity = None
+        self.timed_out = False
 
     def piper(self, in_sock, out_sock, out_addr, onkill):
         "Worker thread for data reading"
         try:
+            if self.splice and self.splice_piper(in_sock, out_sock, onkill):
+                return
             while True:
-                written = in_sock.recv(32768)
+                written = in_sock.recv(self.chunk_size)
+                self.last_activity = time.time()
+                if self.first_byte is None and in_sock is self.server:
+                    self.first_byte = time.time()
                 if not written:
                     try:
                         out_sock.shutdown(socket.SHUT_WR)
@@ -32,19 +62,114 @@ class SocketMelder(object):
         except greenlet.GreenletExit:
             return
 
+    def splice_call(self, fd_in, fd_out, length, wait_fd, wait_read):
+        """
+        Moves up to length bytes between two file descriptors inside the
+        kernel, waiting on the hub while wait_fd is not ready.
+        Returns the number of bytes moved, or raises OSError.
+        """
+        while True:
+            moved = self._splice(fd_in, None, fd_out, None, length, self.SPLICE_F_MOVE | self.SPLICE_F_NONBLOCK)
+            if moved >= 0:
+                return moved
+            error = self._get_errno()
+            if error == errno.EINTR:
+                continue
+            if error != errno.EAGAIN:
+                raise OSError(error, os.strerror(error))
+            if wait_read:
+                trampoline(wait_fd, read=True)
+            else:
+                trampoline(wait_fd, write=True)
+
+    def splice_piper(self, in_sock, out_sock, onkill):
+        """
+        Relays data with splice() through a pipe, so it never gets copied
+        into Python. Returns False if splice() can't be used on these
+        sockets and nothing has been relayed, so the caller can fall back.
+        If out_sock fails, the thread relaying the other way is killed.
+        """
+        try:
+            in_fd = in_sock.fileno()
+            out_fd = out_sock.fileno()
+        except AttributeError:
+            return False
+        pipe_read, pipe_write = os.pipe()
+        moved_any = False
+        try:
+            while True:
+                try:
+                    moved = self.splice_call(in_fd, pipe_write, self.pipe_size, in_fd, True)
+                except OSError, e:
+                    if e.errno == errno.EINVAL and not moved_any:
+                        return False
+                    moved = 0
+                if not moved:
+                    try:
+                        out_sock.shutdown(socket.SHUT_WR)
+                    except socket.error:
+                        self.threads[onkill].kill()
+                    return True
+                moved_any = True
+                self.last_activity = time.time()
+                if self.first_byte is None and in_sock is self.server:
+                    self.first_byte = time.time()
+                # Splice doesn't go through StatsSocket, so count for it
+                if isinstance(in_sock, StatsSocket):
+                    in_sock.bytes_received += moved
+                self.data_handled += moved
+                left = moved
+                while left:
+                    try:
+                        left -= self.splice_call(pipe_read, out_fd, left, out_fd, False)
+                    except OSError:
+                        # The other end has gone; stop relaying both ways
+                        self.threads[onkill].kill()
+                        return True
+                if isinstance(out_sock, StatsSocket):
+                    out_sock.bytes_sent += moved
+        finally:
+            os.close(pipe_read)
+            os.close(pipe_write)
+
+    def watchdog(self):
+        "Stops relaying once nothing has moved either way for idle_timeout"
+        while True:
+            idle = time.time() - self.last_activity
+            if idle >= self.idle_timeout:
+                self.timed_out = True
+                for thread in self.threads.values():
+                    thread.kill()
+                return
+            eventlet.sleep(self.idle_timeout - idle)
+
     def run(self):
+        self.last_activity = time.time()
         self.threads = {
             "ctos": eventlet.spawn(self.piper, self.server, self.client, "client", "stoc"),
             "stoc": eventlet.spawn(self.piper, self.client, self.server, "server", "ctos"),
         }
+        watchdog = self.idle_timeout and eventlet.spawn(self.watchdog)
+        finished = False
         try:
-            self.threads['stoc'].wait()
-        except (greenlet.GreenletExit, socket.error):
-            pass
-        try:
-            self.threads['ctos'].wait()
-        except (greenlet.GreenletExit, socket.error):
-            pass
-        self.server.close()
-        self.client.close()
+            try:
+                self.threads['stoc'].wait()
+            except (greenlet.GreenletExit, socket.error):
+                pass
+            try:
+                self.threads['ctos'].wait()
+            except (greenlet.GreenletExit, socket.error):
+                pass
+            finished = True
+        finally:
+            # Make sure nothing is left relaying if we were interrupted
+            if watchdog:
+                watchdog.kill()
+            for thread in self.threads.values():
+                thread.kill()
+            self.server.close()
+            # If we timed out or were interrupted, the client is left open
+            # so it can be told why
+            if finished and not self.timed_out:
+                self.client.close()
         return self.data_handled
@@ -4,28 +4,49 @@ class StatsSocket(object):
     have been sent and received.
     """
 
+    __slots__ = ["sock", "bytes_sent", "bytes_received"]
+
     def __init__(self, sock):
         self.sock = sock
         self.bytes_sent = 0
         self.bytes_received = 0
 
     def __getattr__(self, attr):
+        # Only reached for the rarely-used calls not forwarded below
         return getattr(self.sock, attr)
-    
+
     def sendall(self, data):
         self.bytes_sent += len(data)
         self.sock.sendall(data)
-    
+
     def send(self, data):
         sent = self.sock.send(data)
         self.bytes_sent += sent
         return sent
-    
+
     def recv(self, length):
         recvd = self.sock.recv(length)
         self.bytes_received += len(recvd)
         return recvd
 
+    def fileno(self):
+        return self.sock.fileno()
+
+    def shutdown(self, how):
+        return self.sock.shutdown(how)
+
+    def close(self):
+        return self.sock.close()
+
+    def settimeout(self, timeout):
+        return self.sock.settimeout(timeout)
+
+    def setsockopt(self, *args):
+        return self.sock.setsockopt(*args)
+
+    def getsockopt(self, *args):
+        return self.sock.getsockopt(*args)
+
     def makefile(self, *args, **kwargs):
         fh = self.sock.makefile(*args, **kwargs)
         fh._sock = self
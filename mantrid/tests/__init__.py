@@ -1,3 +1,8 @@
 from .actions import ActionTests, LiveActionTests
 from .loadbalancer import BalancerTests
 from .client import ClientTests
+from .socketmeld import SocketMelderTests
+from .framing import FramingTests
+from .histogram import HistogramTests
+from .metrics import MetricsTests
+from .replication import ReplicationTests
@@ -8,6 +8,10 @@ httplib2 = eventlet.import_patched("httplib2")
 from eventlet.timeout import Timeout
 from ..loadbalancer import Balancer
 from ..actions import Empty, Static, Unknown, NoHosts, Redirect, Proxy, Spin
+from ..framing import SocketReader, HeadParser, FramingError, parse_head, content_length, is_chunked
+from ..backends import Backend
+from ..pool import PooledConnection
+from ..host_stats import HostStats
 
 
 class MockBalancer(object):
@@ -16,10 +20,26 @@ class MockBalancer(object):
     def __init__(self, fixed_action=None):
         self.fixed_action = None
         self.static_dir = "/tmp/"
+        self.backends = {}
+        self.max_body_size = 0
+        self.connect_timeout = 0
+        self.idle_timeout = 0
+        self.request_timeout = 0
+        self.stats = {}
 
     def resolve_host(self, host):
         return self.fixed_action
 
+    def wait_for_change(self, host, timeout=None):
+        eventlet.sleep(timeout)
+        return False
+
+    def backend(self, address):
+        return self.backends.setdefault(address, Backend(address))
+
+    def host_stats(self, host):
+        return self.stats.setdefault(host, HostStats())
+
 
 class MockSocket(object):
     "Fake Socket class that remembers what was sent. Doesn't implement sendfile."
@@ -34,10 +54,46 @@ class MockSocket(object):
     def sendall(self, data):
         self.data += data
 
+    def settimeout(self, timeout):
+        pass
+
     def close(self):
         pass
 
 
+class MockBackendSocket(MockSocket):
+    """
+    Fake backend socket that gives each recv() the next of its replies,
+    raising any that are exceptions, then EOF.
+    """
+
+    def __init__(self, replies):
+        super(MockBackendSocket, self).__init__()
+        self.replies = list(replies)
+
+    def recv(self, size):
+        if not self.replies:
+            return ""
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+
+class MockPool(object):
+    "Fake ConnectionPool that hands out the backend sockets it is given"
+
+    def __init__(self, socks=()):
+        self.socks = list(socks)
+        self.released = []
+
+    def connect(self, address):
+        return PooledConnection(address, self.socks.pop(0), time.time())
+
+    def release(self, conn):
+        self.released.append(conn)
+
+
 class MockErrorSocket(object):
     "Fake Socket class that raises a specific error message on use."
 
@@ -48,6 +104,12 @@ class MockErrorSocket(object):
         raise socket.error(self.error_code, os.strerror(self.error_code))
     sendall = _error
 
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        pass
+
 
 class ActionTests(unittest.TestCase):
     "Tests the various actions"
@@ -72,6 +134,30 @@ class ActionTests(unittest.TestCase):
             sock.data,
         )
 
+    def test_static_reload(self):
+        "Tests that static pages are only reread when they change"
+        path = "/tmp/mantrid-test-page.http"
+        with open(path, "w") as fh:
+            fh.write("HTTP/1.0 200 OK\r\n\r\nfirst")
+        os.utime(path, (1000, 1000))
+        action = Static(MockBalancer(), "kittens.net", "kittens.net", type="mantrid-test-page")
+        sock = MockSocket()
+        action.handle(sock, "", "/", {})
+        self.assertEqual("HTTP/1.0 200 OK\r\n\r\nfirst", sock.data)
+        # Changed content is ignored until the next check is due
+        with open(path, "w") as fh:
+            fh.write("HTTP/1.0 200 OK\r\n\r\nsecond")
+        os.utime(path, (2000, 2000))
+        sock = MockSocket()
+        action.handle(sock, "", "/", {})
+        self.assertEqual("HTTP/1.0 200 OK\r\n\r\nfirst", sock.data)
+        # An explicit reload picks it up
+        Static.reload()
+        sock = MockSocket()
+        action.handle(sock, "", "/", {})
+        self.assertEqual("HTTP/1.0 200 OK\r\n\r\nsecond", sock.data)
+        os.unlink(path)
+
     def test_unknown(self):
         "Tests the Unknown action"
         action = Unknown(MockBalancer(), "firefly.org", "firefly.org")
@@ -141,6 +227,161 @@ class ActionTests(unittest.TestCase):
         )
         # TODO: launch local server, proxy to that
 
+    def test_proxy_strategies(self):
+        "Tests the Proxy backend selection strategies"
+        backends = [["10.0.0.1", 80], ["10.0.0.2", 80], ["10.0.0.3", 80]]
+        balancer = MockBalancer()
+        # Unknown strategies are rejected
+        self.assertRaises(
+            ValueError,
+            lambda: Proxy(balancer, "ep.io", "ep.io", backends=backends, strategy="bogo"),
+        )
+        self.assertEqual(
+            "host_strategy_invalid:bogo",
+            Proxy.kwargs_errors({"backends": backends, "strategy": "bogo"}),
+        )
+        # Round robin goes through them in order
+        action = Proxy(balancer, "ep.io", "ep.io", backends=backends, strategy="round_robin")
+        self.assertEqual(
+            [("10.0.0.1", 80), ("10.0.0.2", 80), ("10.0.0.3", 80), ("10.0.0.1", 80)],
+            [action.for_host("www.ep.io").choose_backend().address for i in range(4)],
+        )
+        # Least connections and power of two choices avoid busy backends
+        balancer.backend(("10.0.0.1", 80)).in_flight = 5
+        balancer.backend(("10.0.0.3", 80)).in_flight = 3
+        action = Proxy(balancer, "ep.io", "ep.io", backends=backends, strategy="least_conn")
+        self.assertEqual(("10.0.0.2", 80), action.choose_backend().address)
+        action = Proxy(balancer, "ep.io", "ep.io", backends=backends[:2], strategy="power_of_two")
+        self.assertEqual(("10.0.0.2", 80), action.choose_backend().address)
+        # Weighted choice never picks a backend with a tiny weight share
+        action = Proxy(balancer, "ep.io", "ep.io", backends=[["10.0.0.1", 80, 1e-9], ["10.0.0.2", 80, 1e9]], strategy="weighted")
+        self.assertEqual(
+            set([("10.0.0.2", 80)]),
+            set(action.choose_backend().address for i in range(20)),
+        )
+
+    def test_proxy_health(self):
+        "Tests that failing backends are taken out of selection"
+        balancer = MockBalancer()
+        backends = [["10.0.0.1", 80], ["10.0.0.2", 80]]
+        action = Proxy(balancer, "ep.io", "ep.io", backends=backends)
+        dead = balancer.backend(("10.0.0.1", 80))
+        dead.configure([Proxy.health_settings({"max_failures": 2, "backoff": 60})])
+        dead.record_failure()
+        self.assert_(dead.up)
+        dead.record_failure()
+        self.assert_(not dead.up)
+        self.assertEqual(
+            set([("10.0.0.2", 80)]),
+            set(action.choose_backend().address for i in range(20)),
+        )
+        # Retries avoid backends already tried, unless there's nothing else
+        self.assertEqual(("10.0.0.1", 80), action.choose_backend([balancer.backend(("10.0.0.2", 80))]).address)
+        # A success brings it straight back
+        dead.record_success()
+        self.assert_(dead.up)
+        self.assertEqual({
+            "up": True,
+            "in_flight": 0,
+            "requests": 0,
+            "failures": 0,
+            "total_failures": 2,
+            "ttfb": {"count": 0, "sum": 0.0, "buckets": {}},
+        }, dead.to_dict())
+
+    def test_proxy_shedding(self):
+        "Tests that requests over a host's max_connections are turned away"
+        balancer = MockBalancer()
+        self.assertEqual(
+            "host_max_connections_invalid",
+            Proxy.kwargs_errors({"backends": [["10.0.0.1", 80]], "max_connections": -1}),
+        )
+        action = Proxy(balancer, "ep.io", "ep.io", backends=[["10.0.0.1", 80]], max_connections=1)
+        # The balancer has already counted the request being handled
+        action.host_stats().open_requests = 2
+        sock = MockSocket()
+        action.handle(sock, "", "/", {})
+        self.assert_(sock.data.startswith("HTTP/1.0 503 Service Unavailable\r\n"))
+        self.assert_("Retry-After: 1\r\n" in sock.data)
+        self.assertEqual(1, balancer.stats["ep.io"].shed_requests)
+
+    def test_proxy_parse_request(self):
+        "Tests that the balancer's parsed head is reused, changing only hop-by-hop headers"
+        parser = HeadParser()
+        parser.feed("POST /x HTTP/1.1\r\nHost: ep.io\r\nKeep-Alive: 300\r\nConnection: keep-alive\r\nContent-Length: 4\r\nX-Thing: a\r\n\r\n")
+        action = Proxy(MockBalancer(), "ep.io", "ep.io", backends=[["10.0.0.1", 80]], keepalive=True)
+        # The head in read_data isn't looked at again, just the first line
+        read_data = parser.first_line + "(head)" + "bodyGET"
+        request = action.parse_request(read_data, parser.headers, len(read_data) - 7)
+        self.assertEqual(
+            "POST /x HTTP/1.1\r\nHost: ep.io\r\nContent-Length: 4\r\nX-Thing: a\r\nConnection: keep-alive\r\n\r\n",
+            request['head'],
+        )
+        self.assertEqual("body", request['body'])
+        self.assertEqual("POST", request['method'])
+        # Without them, the head is parsed from read_data
+        request = action.parse_request("GET / HTTP/1.1\r\nHost: ep.io\r\n\r\n")
+        self.assertEqual("GET / HTTP/1.1\r\nHost: ep.io\r\nConnection: keep-alive\r\n\r\n", request['head'])
+        self.assertEqual(None, action.parse_request("GET / HTTP/1.1\r\nHost : ep.io\r\n\r\n"))
+
+    def test_proxy_stale_connections(self):
+        "Tests that requests are only resent if a reused connection closed unused"
+        balancer = MockBalancer()
+        action = Proxy(balancer, "ep.io", "ep.io", backends=[["10.0.0.1", 80]], keepalive=True)
+        request = action.parse_request("GET / HTTP/1.1\r\nHost: ep.io\r\n\r\n")
+        response = "HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+        # Closed or reset before anything came back: resent on a new connection
+        for reply in ["", socket.error(errno.ECONNRESET, "Connection reset")]:
+            fresh = MockBackendSocket([response])
+            balancer.backend_pool = MockPool([fresh])
+            stale = PooledConnection(("10.0.0.1", 80), MockBackendSocket([reply]), time.time(), True)
+            sock = MockSocket()
+            action.relay(sock, stale, request)
+            self.assert_(fresh.data.startswith("GET / HTTP/1.1\r\n"))
+            self.assert_(sock.data.startswith("HTTP/1.1 200 OK\r\n"))
+            self.assert_(sock.data.endswith("\r\n\r\nok"))
+        # Requests that aren't safe to repeat get a 502 instead
+        balancer.backend_pool = MockPool([MockBackendSocket([response])])
+        stale = PooledConnection(("10.0.0.1", 80), MockBackendSocket([""]), time.time(), True)
+        sock = MockSocket()
+        post = action.parse_request("POST / HTTP/1.1\r\nHost: ep.io\r\nContent-Length: 4\r\n\r\nbody")
+        self.assertEqual(False, action.relay(sock, stale, post))
+        self.assert_(sock.data.startswith("HTTP/1.0 502 Bad Gateway\r\n"))
+        self.assertEqual(1, len(balancer.backend_pool.socks))
+        # As do ones that can't get a new connection
+        balancer.backend_pool = MockPool([])
+        balancer.backend_pool.connect = lambda address: MockErrorSocket(errno.ECONNREFUSED).sendall()
+        stale = PooledConnection(("10.0.0.1", 80), MockBackendSocket([""]), time.time(), True)
+        sock = MockSocket()
+        self.assertEqual(False, action.relay(sock, stale, request))
+        self.assert_(sock.data.startswith("HTTP/1.0 502 Bad Gateway\r\n"))
+        # A slow backend may be running the request, so it isn't resent
+        balancer.backend_pool = MockPool([MockBackendSocket([response])])
+        slow = PooledConnection(("10.0.0.1", 80), MockBackendSocket([socket.timeout("timed out")]), time.time(), True)
+        self.assertRaises(socket.timeout, action.relay, MockSocket(), slow, request)
+        self.assertEqual(1, len(balancer.backend_pool.socks))
+        # Nor is one that closed partway through its response
+        partial = PooledConnection(("10.0.0.1", 80), MockBackendSocket(["HTTP/1.1 200 OK\r\n"]), time.time(), True)
+        sock = MockSocket()
+        self.assertEqual(False, action.relay(sock, partial, request))
+        self.assertEqual(1, len(balancer.backend_pool.socks))
+        self.assert_(sock.data.startswith("HTTP/1.0 502 Bad Gateway\r\n"))
+        # Bodies still being read can't be resent, but the client still
+        # hears that the backend went away, whether it closed or reset
+        partial_post = action.parse_request("POST / HTTP/1.1\r\nHost: ep.io\r\nContent-Length: 8\r\n\r\nbody")
+        for backend_sock in [MockBackendSocket([""]), MockErrorSocket(errno.ECONNRESET)]:
+            stale = PooledConnection(("10.0.0.1", 80), backend_sock, time.time(), True)
+            sock = MockBackendSocket(["more"])
+            self.assertEqual(False, action.relay(sock, stale, partial_post))
+            self.assert_(sock.data.startswith("HTTP/1.0 502 Bad Gateway\r\n"))
+        self.assertEqual(1, len(balancer.backend_pool.socks))
+        # A client that doesn't send all of its body gets a 400
+        fresh = PooledConnection(("10.0.0.1", 80), MockBackendSocket([response]), time.time())
+        sock = MockSocket()
+        sock.recv = lambda size: ""
+        self.assertEqual(False, action.relay(sock, fresh, partial_post))
+        self.assert_(sock.data.startswith("HTTP/1.0 400 Bad Request\r\n"))
+
     def test_spin(self):
         "Tests the Spin action"
         # Set the balancer up to return a Spin
@@ -195,6 +436,54 @@ class ActionTests(unittest.TestCase):
             self.assertEqual(cm.exception.errno, errno.EBADF)
 
 
+class KeepAliveBackend(object):
+    """
+    Tiny HTTP/1.1 server that keeps connections open and counts them.
+    Paths starting with /chunked/ get a chunked response.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.connections = 0
+        self.requests = []
+        self.sock = eventlet.listen(("127.0.0.1", port))
+        self.thread = eventlet.spawn(eventlet.serve, self.sock, self.handle)
+
+    def handle(self, sock, address):
+        self.connections += 1
+        reader = SocketReader(sock)
+        while True:
+            head = reader.read_head()
+            if head is None:
+                break
+            words, headers = parse_head(head)
+            if is_chunked(headers):
+                content = MockSocket()
+                try:
+                    reader.relay_chunked(content)
+                except FramingError:
+                    # The balancer gave up on this body
+                    break
+                body = content.data
+            else:
+                content = MockSocket()
+                try:
+                    reader.relay_exact(content_length(headers) or 0, content)
+                except FramingError:
+                    break
+                body = content.data
+            self.requests.append((words[1], body))
+            if words[1].startswith("/chunked/"):
+                sock.sendall("HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n")
+            else:
+                sock.sendall("HTTP/1.1 200 OK\r\nContent-Length: %i\r\n\r\n%s" % (len(words[1]), words[1]))
+        sock.close()
+
+    def stop(self):
+        self.thread.kill()
+        self.sock.close()
+
+
 class LiveActionTests(unittest.TestCase):
     """
     Tests that the client/API work correctly.
@@ -204,6 +493,10 @@ class LiveActionTests(unittest.TestCase):
 
     def setUp(self):
         self.__class__.next_port += 3
+        # Start from an empty state, without a previous run's journal
+        for path in ["/tmp/mantrid-test-state-2", "/tmp/mantrid-test-state-2.journal"]:
+            if os.path.exists(path):
+                os.unlink(path)
         self.balancer = Balancer(
             [(("0.0.0.0", self.next_port), socket.AF_INET)],
             [(("0.0.0.0", self.next_port + 1), socket.AF_INET)],
@@ -239,3 +532,242 @@ class LiveActionTests(unittest.TestCase):
             expected_content,
             content,
         )
+
+    def test_max_connections(self):
+        "Tests that connections over the balancer's limit are shed"
+        self.balancer.max_connections = 1
+        # Hold one connection open with half a request
+        held = eventlet.connect(("127.0.0.1", self.next_port))
+        held.sendall("GET / HTTP/1.1\r\n")
+        eventlet.sleep(0.1)
+        try:
+            h = httplib2.Http()
+            resp, content = h.request(
+                "http://127.0.0.1:%i" % self.next_port,
+                "GET",
+                headers = {"Host": "test-host.com"},
+            )
+            self.assertEqual('503', resp['status'])
+            self.assertEqual('1', resp['retry-after'])
+            stats = self.balancer.balancer_stats()
+            self.assertEqual(1, stats['shed_connections'])
+            self.assertEqual(1, stats['open_connections'])
+        finally:
+            held.close()
+
+    def test_proxy_keepalive(self):
+        "Tests that keep-alive proxies reuse their backend connections"
+        backend = KeepAliveBackend(self.next_port + 1000)
+        try:
+            self.balancer.hosts = {
+                "test-host.com": ["proxy", {"backends": [["127.0.0.1", backend.port]], "keepalive": True}, True],
+            }
+            for path in ["/one/", "/two/", "/chunked/"]:
+                h = httplib2.Http()
+                resp, content = h.request(
+                    "http://127.0.0.1:%i%s" % (self.next_port, path),
+                    "POST",
+                    body = "kittens",
+                    headers = {"Host": "test-host.com"},
+                )
+                self.assertEqual('200', resp['status'])
+                self.assertEqual(
+                    "hello world" if path == "/chunked/" else path,
+                    content,
+                )
+            self.assertEqual(
+                [("/one/", "kittens"), ("/two/", "kittens"), ("/chunked/", "kittens")],
+                backend.requests,
+            )
+            self.assertEqual(1, backend.connections)
+            # Both paths time the request and the backend's first byte
+            stats = self.balancer.host_stats("test-host.com")
+            self.assertEqual(3, stats.total.count)
+            self.assertEqual(3, stats.ttfb.count)
+            self.assertEqual(3, self.balancer.backend(("127.0.0.1", backend.port)).ttfb.count)
+        finally:
+            backend.stop()
+
+    def test_client_keepalive(self):
+        "Tests that keep-alive clients can send several requests on one connection"
+        backend = KeepAliveBackend(self.next_port + 1000)
+        self.balancer.client_keepalive = True
+        try:
+            self.balancer.hosts = {
+                "test-host.com": ["proxy", {"backends": [["127.0.0.1", backend.port]], "keepalive": True}, True],
+            }
+            # Pipeline two requests and a third that asks to close
+            client = eventlet.connect(("127.0.0.1", self.next_port))
+            client.sendall(
+                "GET /one/ HTTP/1.1\r\nHost: test-host.com\r\n\r\n"
+                "POST /two/ HTTP/1.1\r\nHost: test-host.com\r\nContent-Length: 4\r\n\r\nbody"
+                "GET /chunked/ HTTP/1.1\r\nHost: test-host.com\r\nConnection: close\r\n\r\n"
+            )
+            reader = SocketReader(client)
+            for expected in ["/one/", "/two/", "5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n"]:
+                with Timeout(2):
+                    words, headers = parse_head(reader.read_head())
+                    self.assertEqual("200", words[1])
+                    content = MockSocket()
+                    reader.relay_body(headers, content)
+                self.assertEqual(expected, content.data)
+            self.assertEqual("close", headers['connection'])
+            with Timeout(2):
+                self.assertEqual("", client.recv(1))
+            self.assertEqual(
+                [("/one/", ""), ("/two/", "body"), ("/chunked/", "")],
+                backend.requests,
+            )
+            self.assertEqual(3, self.balancer.stats["test-host.com"].completed_requests)
+            # A body that arrives later, with the next request behind it,
+            # doesn't take that request with it
+            client = eventlet.connect(("127.0.0.1", self.next_port))
+            client.sendall("POST /three/ HTTP/1.1\r\nHost: test-host.com\r\nContent-Length: 4\r\n\r\n")
+            eventlet.sleep(0.05)
+            client.sendall("bodyGET /four/ HTTP/1.1\r\nHost: test-host.com\r\nConnection: close\r\n\r\n")
+            reader = SocketReader(client)
+            for expected in ["/three/", "/four/"]:
+                with Timeout(2):
+                    words, headers = parse_head(reader.read_head())
+                    self.assertEqual("200", words[1])
+                    content = MockSocket()
+                    reader.relay_body(headers, content)
+                self.assertEqual(expected, content.data)
+            self.assertEqual([("/three/", "body"), ("/four/", "")], backend.requests[3:])
+            del backend.requests[3:]
+            # A negative length can't be used to eat into the next request
+            client = eventlet.connect(("127.0.0.1", self.next_port))
+            client.sendall("POST /one/ HTTP/1.1\r\nHost: test-host.com\r\nContent-Length: -5\r\n\r\nbodyGET /two/ HTTP/1.1\r\n\r\n")
+            with Timeout(2):
+                words, headers = parse_head(SocketReader(client).read_head())
+            self.assertEqual("400", words[1])
+            self.assertEqual(3, len(backend.requests))
+        finally:
+            backend.stop()
+
+    def test_chunked_upload(self):
+        "Tests that chunked request bodies are streamed through, up to a limit"
+        backend = KeepAliveBackend(self.next_port + 1000)
+        try:
+            self.balancer.hosts = {
+                "test-host.com": ["proxy", {"backends": [["127.0.0.1", backend.port]], "max_body_size": 10}, True],
+            }
+            for chunks, status in [("5\r\nhello\r\n0\r\n\r\n", "200"), ("6\r\nhello \r\n5\r\nworld\r\n0\r\n\r\n", "413")]:
+                client = eventlet.connect(("127.0.0.1", self.next_port))
+                client.sendall("POST /upload/ HTTP/1.1\r\nHost: test-host.com\r\nTransfer-Encoding: chunked\r\n\r\n")
+                eventlet.sleep(0.05)
+                client.sendall(chunks)
+                with Timeout(2):
+                    words, headers = parse_head(SocketReader(client).read_head())
+                self.assertEqual(status, words[1])
+                client.close()
+            self.assertEqual([("/upload/", "5\r\nhello\r\n0\r\n\r\n")], backend.requests)
+            # Clients waiting for 100 Continue (as curl does) get it from
+            # us, and are still held to the limit
+            for chunks, status in [("5\r\nhello\r\n0\r\n\r\n", "200"), ("6\r\nhello \r\n5\r\nworld\r\n0\r\n\r\n", "413")]:
+                client = eventlet.connect(("127.0.0.1", self.next_port))
+                client.sendall("POST /upload/ HTTP/1.1\r\nHost: test-host.com\r\nTransfer-Encoding: chunked\r\nExpect: 100-continue\r\n\r\n")
+                reader = SocketReader(client)
+                with Timeout(2):
+                    words, headers = parse_head(reader.read_head())
+                self.assertEqual("100", words[1])
+                client.sendall(chunks)
+                with Timeout(2):
+                    words, headers = parse_head(reader.read_head())
+                self.assertEqual(status, words[1])
+                client.close()
+            self.assertEqual([("/upload/", "5\r\nhello\r\n0\r\n\r\n")] * 2, backend.requests)
+            # Declared lengths are checked before connecting
+            h = httplib2.Http()
+            resp, content = h.request(
+                "http://127.0.0.1:%i/" % self.next_port,
+                "POST",
+                body = "far too many kittens",
+                headers = {"Host": "test-host.com"},
+            )
+            self.assertEqual('413', resp['status'])
+            self.assertEqual(2, len(backend.requests))
+        finally:
+            backend.stop()
+
+    def test_spin_release(self):
+        "Tests that spinning requests are let go as soon as the rule changes"
+        self.balancer.hosts = {
+            "test-host.com": ["spin", {"check_interval": 60}, True],
+        }
+        def host_changer():
+            eventlet.sleep(0.2)
+            self.balancer.set_host("test-host.com", ["empty", {"code": 402}, True])
+        eventlet.spawn(host_changer)
+        start = time.time()
+        h = httplib2.Http(timeout=2)
+        resp, content = h.request(
+            "http://127.0.0.1:%i/" % self.next_port,
+            "GET",
+            headers = {"Host": "www.test-host.com"},
+        )
+        self.assertEqual('402', resp['status'])
+        self.assert_(time.time() - start < 1, "Spin wasn't woken by the change")
+
+    def test_timeouts(self):
+        "Tests the header, idle and total request timeouts"
+        # Clients have to send their whole head within header_timeout
+        self.balancer.header_timeout = 0.2
+        client = eventlet.connect(("127.0.0.1", self.next_port))
+        client.sendall("GET / HTTP/1.1\r\nHost: test")
+        with Timeout(2):
+            words, headers = parse_head(SocketReader(client).read_head())
+        self.assertEqual("408", words[1])
+        client.close()
+        self.assertEqual(1, self.balancer.balancer_stats()['header_timeouts'])
+        # A backend that accepts connections but never answers
+        stalled = eventlet.listen(("127.0.0.1", self.next_port + 1000))
+        try:
+            for kwargs, counter in [
+                ({"idle_timeout": 0.2}, "idle_timeouts"),
+                ({"idle_timeout": 0.2, "keepalive": True}, "idle_timeouts"),
+                ({"request_timeout": 0.2}, "request_timeouts"),
+            ]:
+                kwargs['backends'] = [["127.0.0.1", self.next_port + 1000]]
+                self.balancer.hosts = {"test-host.com": ["proxy", kwargs, True]}
+                stats = self.balancer.host_stats("test-host.com")
+                before = getattr(stats, counter)
+                h = httplib2.Http(timeout=2)
+                resp, content = h.request(
+                    "http://127.0.0.1:%i/" % self.next_port,
+                    "GET",
+                    headers = {"Host": "test-host.com"},
+                )
+                self.assertEqual('502', resp['status'])
+                self.assertEqual(before + 1, getattr(stats, counter))
+        finally:
+            stalled.close()
+
+    def test_proxy_failover(self):
+        "Tests that proxying retries on, and then avoids, a dead backend"
+        backend = KeepAliveBackend(self.next_port + 1000)
+        dead_port = self.next_port + 1001
+        try:
+            self.balancer.hosts = {
+                "test-host.com": ["proxy", {
+                    "backends": [["127.0.0.1", dead_port], ["127.0.0.1", backend.port]],
+                    "strategy": "round_robin",
+                    "attempts": 2,
+                    "delay": 0,
+                }, True],
+            }
+            # Round robin sends every other request to the dead backend
+            # first, so the third of those takes it down
+            for i in range(8):
+                h = httplib2.Http()
+                resp, content = h.request(
+                    "http://127.0.0.1:%i/" % self.next_port,
+                    "GET",
+                    headers = {"Host": "test-host.com"},
+                )
+                self.assertEqual('200', resp['status'])
+            dead = self.balancer.backend(("127.0.0.1", dead_port))
+            self.assert_(not dead.up)
+            self.assertEqual(3, dead.total_failures)
+        finally:
+            backend.stop()
@@ -1,8 +1,12 @@
+import os
+import json
 import unittest
 import eventlet
 import socket
 from ..loadbalancer import Balancer
-from ..client import MantridClient
+from ..client import MantridClient, MultiClient
+from ..management import ManagementApp
+from ..host_stats import HostStats
 
 
 class MockSocket(object):
@@ -28,6 +32,10 @@ class ClientTests(unittest.TestCase):
 
     def setUp(self):
         self.__class__.next_port += 3
+        # Start from an empty state, without a previous run's journal
+        for path in ["/tmp/mantrid-test-state", "/tmp/mantrid-test-state.journal"]:
+            if os.path.exists(path):
+                os.unlink(path)
         self.balancer = Balancer(
             [(("0.0.0.0", self.next_port), socket.AF_INET)],
             [(("0.0.0.0", self.next_port + 1), socket.AF_INET)],
@@ -42,6 +50,15 @@ class ClientTests(unittest.TestCase):
         self.balancer.running = False
         eventlet.sleep(0.1)
 
+    empty = HostStats().counts()
+
+    def stats_counts(self):
+        "Returns the balancer's per-host counters as plain dicts"
+        return dict(
+            (host, stats.counts())
+            for host, stats in self.balancer.stats.items()
+        )
+
     def test_set_single(self):
         "Sets a single host"
         # Check we start empty
@@ -51,7 +68,7 @@ class ClientTests(unittest.TestCase):
         )
         self.assertEqual(
             {},
-            self.balancer.stats,
+            self.stats_counts(),
         )
         # Add a single host
         self.client.set("test-host.com", ["spin", {}, False])
@@ -61,8 +78,8 @@ class ClientTests(unittest.TestCase):
             self.balancer.hosts,
         )
         self.assertEqual(
-            {"test-host.com": {}},
-            self.balancer.stats,
+            {"test-host.com": self.empty},
+            self.stats_counts(),
         )
         # Override with new settings
         self.client.set("test-host.com", ["unknown", {}, True])
@@ -71,14 +88,18 @@ class ClientTests(unittest.TestCase):
             self.balancer.hosts,
         )
         self.assertEqual(
-            {"test-host.com": {}},
-            self.balancer.stats,
+            {"test-host.com": self.empty},
+            self.stats_counts(),
         )
         # Try a wrong setting
         self.assertRaises(
             IOError,
             self.client.set, "test-host.com", ["do-da-be-dee", {}, "bruce"],
         )
+        self.assertRaises(
+            IOError,
+            self.client.set, "test-host.com", ["proxy", {"backends": [["127.0.0.1", 80]], "strategy": "bogo"}, False],
+        )
         # Delete it
         self.client.delete("test-host.com")
         self.assertEqual(
@@ -87,8 +108,146 @@ class ClientTests(unittest.TestCase):
         )
         self.assertEqual(
             {},
-            self.balancer.stats,
+            self.stats_counts(),
+        )
+
+    def test_patch(self):
+        "Sets and deletes several hosts in one change"
+        self.client.set_all({
+            "kittens.com": ["spin", {}, False],
+            "khaaaaaaaaaan.com": ["unknown", {}, True],
+        })
+        self.balancer.host_stats("kittens.com").completed_requests = 3
+        generation = self.balancer.generation
+        result = self.client.patch(
+            {"kittens.com": ["empty", {"code": 402}, False], "ceilingcat.net": ["spin", {}, False]},
+            ["khaaaaaaaaaan.com"],
+        )
+        self.assertEqual({"ok": True, "generation": generation + 1}, result)
+        self.assertEqual(
+            {
+                "kittens.com": ["empty", {"code": 402}, False],
+                "ceilingcat.net": ["spin", {}, False],
+            },
+            self.balancer.hosts,
+        )
+        # Changed hosts keep their stats; deleted ones lose them
+        self.assertEqual(3, self.balancer.stats["kittens.com"].completed_requests)
+        self.assertEqual(
+            set(["kittens.com", "ceilingcat.net"]),
+            set(self.stats_counts()),
+        )
+        # Nothing is changed if any of the batch is invalid
+        for set_hosts, delete_hosts in [
+            ({"kittens.com": ["spin", {}, False], "bad.com": ["do-da-be-dee", {}, False]}, []),
+            ({"kittens.com": ["spin", {}, False]}, ["kittens.com"]),
+            ({}, [None]),
+        ]:
+            self.assertRaises(IOError, self.client.patch, set_hosts, delete_hosts)
+        self.assertEqual(generation + 1, self.balancer.generation)
+        self.assertEqual(["empty", {"code": 402}, False], self.balancer.hosts["kittens.com"])
+
+    def test_pagination(self):
+        "Lists hosts and stats a page at a time"
+        hosts = dict(
+            ("%s%i.example.com" % (prefix, i), ["spin", {}, False])
+            for prefix in ("api", "www")
+            for i in range(5)
+        )
+        self.client.set_all(hosts)
+        self.assertEqual(hosts, self.client.get_all())
+        self.assertEqual(hosts, self.client.get_all(page_size=3))
+        self.assertEqual(
+            sorted(host for host in hosts if host.startswith("api")),
+            sorted(self.client.get_all(prefix="api", page_size=2)),
+        )
+        # Pages come in key order, with a cursor for the next one
+        resp, page = self.client._request_with_headers("/hostname/?limit=4&cursor=api2.example.com", "GET")
+        self.assertEqual(["api3.example.com", "api4.example.com", "www0.example.com", "www1.example.com"], sorted(page))
+        self.assertEqual("www1.example.com", resp['x-next-cursor'])
+        self.assertEqual("chunked", resp['transfer-encoding'])
+        # Stats are paged the same way, with only hostnames as keys
+        stats = self.client.stats(page_size=4)
+        self.assertEqual(set(hosts), set(stats))
+        self.assert_("generation" in self.client.balancer_stats())
+        self.assertEqual(["www3.example.com"], list(self.client.stats(prefix="www3", page_size=1)))
+        self.assertRaises(IOError, self.client._request, "/hostname/?limit=0", "GET")
+        # A page shows the table as it was when it was asked for
+        chunks = ManagementApp(self.balancer).get_all("/hostname/", None, {"limit": "2"}).body
+        self.balancer.delete_host("api0.example.com")
+        self.balancer.set_host("api1.example.com", ["empty", {"code": 402}, False])
+        self.assertEqual(
+            {"api0.example.com": ["spin", {}, False], "api1.example.com": ["spin", {}, False]},
+            json.loads("".join(chunks)),
         )
+        # Stats are copied up front but summarised as they are sent, with
+        # other greenthreads getting to run in between
+        for i in range(2000):
+            self.balancer.stats["load%i.example.com" % i] = HostStats({"completed_requests": 1})
+        chunks = ManagementApp(self.balancer).get_all_stats("/stats/", None, {}).body
+        self.balancer.stats["load0.example.com"].completed_requests = 2
+        ticks = []
+        eventlet.spawn(ticks.append, True)
+        received = [chunks.next(), chunks.next()]
+        self.assertEqual([True], ticks)
+        stats = json.loads("".join(received + list(chunks)))
+        self.assertEqual(1, stats["load0.example.com"]['completed_requests'])
+        self.assertEqual(2010, len(stats))
+
+    def test_watch(self):
+        "Watches the hosts table for changes"
+        self.client.set("kittens.com", ["spin", {}, False])
+        watcher = self.client.watch(timeout=0.2)
+        first = watcher.next()
+        self.assertEqual(True, first['reset'])
+        self.assertEqual({"kittens.com": ["spin", {}, False]}, first['hosts'])
+        self.assertEqual(self.balancer.generation, first['generation'])
+        # Later results only have what changed
+        def changer():
+            eventlet.sleep(0.3)
+            self.client.patch({"ceilingcat.net": ["spin", {}, False]}, ["kittens.com"])
+        eventlet.spawn(changer)
+        second = watcher.next()
+        self.assertEqual(False, second['reset'])
+        self.assertEqual({"ceilingcat.net": ["spin", {}, False], "kittens.com": None}, second['hosts'])
+        self.assertEqual(first['generation'] + 1, second['generation'])
+
+    def test_batch(self):
+        "Sends several changes in one request, over one connection"
+        self.client.set("kittens.com", ["spin", {}, False])
+        generation = self.balancer.generation
+        with self.client.batch() as batch:
+            batch.set("ceilingcat.net", ["spin", {}, False])
+            batch.set("khaaaaaaaaaan.com", ["spin", {}, False])
+            batch.delete("khaaaaaaaaaan.com")
+            batch.delete("kittens.com")
+            batch.set("kittens.com", ["unknown", {}, True])
+            self.assertEqual(generation, self.balancer.generation)
+        self.assertEqual(generation + 1, self.balancer.generation)
+        self.assertEqual(
+            {
+                "ceilingcat.net": ["spin", {}, False],
+                "kittens.com": ["unknown", {}, True],
+            },
+            self.balancer.hosts,
+        )
+        # Nothing to send does nothing
+        self.assertEqual(None, self.client.batch().send())
+        # Every request so far went over the same connection
+        self.assertEqual(1, len(self.client.idle_http))
+        self.assertEqual(1, len(self.client.idle_http[0].connections))
+
+    def test_multi_client(self):
+        "Sends the same change to several balancers"
+        dead_url = "http://127.0.0.1:%i" % (self.next_port + 1000)
+        multi = MultiClient([self.client.base_url, dead_url])
+        results = multi.set("kittens.com", ["spin", {}, False])
+        self.assertEqual({"ok": True}, results[self.client.base_url])
+        self.assert_(isinstance(results[dead_url], IOError))
+        self.assertEqual({"kittens.com": ["spin", {}, False]}, self.balancer.hosts)
+        with multi.batch() as batch:
+            batch.delete("kittens.com")
+        self.assertEqual({}, self.balancer.hosts)
 
     def test_set_multiple(self):
         "Sets a single host"
@@ -99,7 +258,7 @@ class ClientTests(unittest.TestCase):
         )
         self.assertEqual(
             {},
-            self.balancer.stats,
+            self.stats_counts(),
         )
         # Add multiple hosts
         hosts = {
@@ -112,8 +271,8 @@ class ClientTests(unittest.TestCase):
             self.balancer.hosts,
         )
         self.assertEqual(
-            {"kittens.com": {}, "khaaaaaaaaaan.com": {}},
-            self.balancer.stats,
+            {"kittens.com": self.empty, "khaaaaaaaaaan.com": self.empty},
+            self.stats_counts(),
         )
         # Change to a different set of hosts
         hosts = {
@@ -126,6 +285,6 @@ class ClientTests(unittest.TestCase):
             self.balancer.hosts,
         )
         self.assertEqual(
-            {"ceilingcat.net": {}, "khaaaaaaaaaan.com": {}},
-            self.balancer.stats,
+            {"ceilingcat.net": self.empty, "khaaaaaaaaaan.com": self.empty},
+            self.stats_counts(),
         )
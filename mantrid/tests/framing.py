@@ -0,0 +1,90 @@
+from unittest import TestCase
+from ..framing import HeadParser, Headers, SocketReader, FramingError, HeadTooLarge, BodyTooLarge
+
+
+class MockSocket(object):
+    "Fake socket that has nothing more to read and remembers what was sent"
+
+    def __init__(self):
+        self.data = ""
+
+    def recv(self, size):
+        return ""
+
+    def sendall(self, data):
+        self.data += data
+
+
+class FramingTests(TestCase):
+    "Tests the HTTP message framing helpers"
+
+    def test_head_parser(self):
+        "Tests that heads are parsed as they arrive"
+        parser = HeadParser()
+        self.assert_(not parser.feed("\r\nGET /foo HTTP/1.1\r\nHo"))
+        self.assert_(not parser.feed("st: ep.io\r\nX-Thing: a\r\n"))
+        self.assert_(parser.feed("x-thing: b\r\n\r\nbody"))
+        self.assertEqual(["GET", "/foo", "HTTP/1.1"], parser.words)
+        self.assertEqual("body", parser.rest())
+        headers = parser.headers
+        self.assertEqual("ep.io", headers['HOST'])
+        self.assertEqual("a, b", headers.get("X-Thing"))
+        self.assert_("host" in headers)
+        self.assert_("Content-Length" not in headers)
+        self.assertEqual(None, headers.get("Content-Length"))
+        self.assertRaises(KeyError, lambda: headers['Content-Length'])
+
+    def test_headers_render(self):
+        "Tests that changed headers are re-emitted with the rest untouched"
+        headers = Headers([
+            "Host: ep.io\r\n",
+            "Connection: keep-alive\r\n",
+            "X-Forwarded-For: 10.0.0.1\r\n",
+        ])
+        headers['connection'] = "close"
+        headers['X-Forwarded-For'] = "127.0.0.1"
+        del headers['Host']
+        del headers['Not-There']
+        self.assertEqual(
+            "connection: close\r\nX-Forwarded-For: 127.0.0.1\r\n\r\n",
+            headers.render(),
+        )
+        self.assertEqual("close", headers['Connection'])
+
+    def test_head_limits(self):
+        "Tests that limits on head size and header count are enforced"
+        parser = HeadParser(max_headers=2)
+        self.assertRaises(
+            HeadTooLarge,
+            parser.feed,
+            "GET / HTTP/1.1\r\nA: 1\r\nB: 2\r\nC: 3\r\n\r\n",
+        )
+        parser = HeadParser(max_size=100)
+        parser.feed("GET / HTTP/1.1\r\n")
+        self.assertRaises(HeadTooLarge, parser.feed, "X-Long: " + "a" * 100)
+        # Malformed and folded lines are refused
+        self.assertRaises(FramingError, HeadParser().feed, "GET / HTTP/1.1\r\nNo colon here\r\n\r\n")
+        self.assertRaises(FramingError, HeadParser().feed, "GET / HTTP/1.1\r\nA: 1\r\n folded\r\n\r\n")
+        # As are empty names and whitespace before the colon (RFC 7230 3.2.4)
+        self.assertRaises(FramingError, HeadParser().feed, "GET / HTTP/1.1\r\n: x\r\n\r\n")
+        self.assertRaises(FramingError, HeadParser().feed, "GET / HTTP/1.1\r\nHost : ep.io\r\n\r\n")
+        self.assertRaises(FramingError, HeadParser().feed, "GET / HTTP/1.1\r\nHost\t: ep.io\r\n\r\n")
+
+    def test_relay_chunked(self):
+        "Tests that chunked bodies are relayed, and bad chunk sizes refused"
+        out = MockSocket()
+        body = "5;ext=1\r\nhello\r\nA\r\n0123456789\r\n0\r\nTrailer: x\r\n\r\n"
+        reader = SocketReader(MockSocket(), body + "next")
+        reader.relay_chunked(out)
+        self.assertEqual(body, out.data)
+        self.assertEqual("next", reader.buffer)
+        self.assertRaises(BodyTooLarge, SocketReader(MockSocket(), body).relay_chunked, MockSocket(), 10)
+        # Signs, prefixes and empty sizes are refused before anything is sent
+        for size in ["-5", "+a", "0x10", "", " "]:
+            out = MockSocket()
+            reader = SocketReader(MockSocket(), "%s\r\nhello\r\n0\r\n\r\n" % size)
+            self.assertRaises(FramingError, reader.relay_chunked, out, 100)
+            self.assertEqual("", out.data)
+        # A negative size can't be used to get under the limit
+        reader = SocketReader(MockSocket(), "8\r\n12345678\r\n-5\r\n0\r\n\r\n")
+        self.assertRaises(FramingError, reader.relay_chunked, MockSocket(), 10)
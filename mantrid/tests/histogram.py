@@ -0,0 +1,34 @@
+from unittest import TestCase
+from ..histogram import Histogram, summarise
+from ..workers import merge_stats
+
+
+class HistogramTests(TestCase):
+    "Tests the latency histograms"
+
+    def test_percentiles(self):
+        "Tests that percentiles come out within a bucket of the truth"
+        histogram = Histogram()
+        for i in range(1, 101):
+            histogram.record(i / 1000.0)
+        summary = summarise(histogram.to_dict())
+        self.assertEqual(100, summary['count'])
+        self.assertAlmostEqual(50.5, summary['mean_ms'])
+        for percentile, expected in [(50, 50), (90, 90), (99, 99)]:
+            value = summary['p%i_ms' % percentile]
+            self.assert_(expected <= value <= expected * 1.19, (percentile, value))
+        # Very long durations land in the overflow bucket
+        histogram.record(1000)
+        self.assertEqual(1, histogram.counts[-1])
+        self.assertEqual({"count": 0}, summarise(Histogram().to_dict()))
+
+    def test_merge(self):
+        "Tests that raw histograms from several workers add together"
+        first, second = Histogram(), Histogram()
+        first.record(0.001)
+        second.record(0.001)
+        second.record(0.5)
+        merged = merge_stats([first.to_dict(), second.to_dict()])
+        self.assertEqual(3, merged['count'])
+        self.assertEqual(3, sum(merged['buckets'].values()))
+        self.assertEqual(summarise(merged)['p99_ms'], summarise(second.to_dict())['p99_ms'])
@@ -1,6 +1,11 @@
+import os
+import eventlet
 from unittest import TestCase
 from ..loadbalancer import Balancer
-from ..actions import Empty, Unknown, Redirect, Spin, Proxy
+from ..actions import Empty, Unknown, Redirect, Spin, Proxy, NoHosts
+from ..workers import merge_stats, WorkerSupervisor, Worker
+from ..management import ManagementApp
+from ..pool import ConnectionPool
 
 
 class BalancerTests(TestCase):
@@ -70,3 +75,316 @@ class BalancerTests(TestCase):
             balancer.resolve_host("i-love-bees.com").__class__,
             Unknown,
         )
+
+    def test_resolution_updates(self):
+        "Tests that single host changes reach the routing table"
+        balancer = Balancer(None, None, None, None)
+        balancer.hosts = {
+            "ep.io": ["empty", {"code": 402}, True],
+        }
+        self.assertEqual(
+            balancer.resolve_host("www.ep.io").__class__,
+            Empty,
+        )
+        # A more specific entry takes over its subdomain only
+        balancer.set_host("www.ep.io", ["spin", {}, False])
+        self.assertEqual(
+            balancer.resolve_host("www.ep.io").__class__,
+            Spin,
+        )
+        self.assertEqual(
+            balancer.resolve_host("static.www.ep.io").__class__,
+            Empty,
+        )
+        # Removing it falls back to the wildcard again
+        balancer.delete_host("www.ep.io")
+        self.assertEqual(
+            balancer.resolve_host("www.ep.io").__class__,
+            Empty,
+        )
+        balancer.delete_host("ep.io")
+        self.assertEqual(
+            balancer.resolve_host("www.ep.io").__class__,
+            NoHosts,
+        )
+
+    def test_resolution_reuses_actions(self):
+        "Tests that resolved actions are built once per entry"
+        balancer = Balancer(None, None, None, None)
+        balancer.hosts = {
+            "ep.io": ["redirect", {"redirect_to": "https://www.ep.io"}, True],
+        }
+        first = balancer.resolve_host("ep.io")
+        self.assert_(first is balancer.resolve_host("ep.io"))
+        other = balancer.resolve_host("www.ep.io")
+        self.assertEqual(other.host, "www.ep.io")
+        self.assertEqual(other.matched_host, "ep.io")
+        self.assertEqual(other.redirect_to, "https://www.ep.io")
+        self.assertEqual(first.host, "ep.io")
+
+    def test_resolution_cache(self):
+        "Tests the resolved host cache and its invalidation"
+        balancer = Balancer(None, None, None, None, host_cache_size=2)
+        balancer.hosts = {
+            "ep.io": ["empty", {"code": 402}, False],
+        }
+        # Misses, including unknown hosts, are cached
+        balancer.resolve_host("ep.io")
+        balancer.resolve_host("scanner.example.com")
+        balancer.resolve_host("scanner.example.com")
+        self.assertEqual(balancer.host_cache.misses, 2)
+        self.assertEqual(balancer.host_cache.hits, 1)
+        # Adding a third entry evicts the least recently used one
+        balancer.resolve_host("other.example.com")
+        self.assertEqual(len(balancer.host_cache), 2)
+        self.assertEqual(
+            balancer.resolve_host("ep.io").__class__,
+            Empty,
+        )
+        self.assertEqual(balancer.host_cache.misses, 4)
+        # A change to the table invalidates the cached negative result
+        balancer.set_host("scanner.example.com", ["spin", {}, False])
+        self.assertEqual(
+            balancer.resolve_host("scanner.example.com").__class__,
+            Spin,
+        )
+        self.assertEqual(len(balancer.host_cache), 1)
+        # With the cache turned off, lookups aren't counted as misses
+        balancer = Balancer(None, None, None, None, host_cache_size=0)
+        balancer.resolve_host("scanner.example.com")
+        self.assertEqual(balancer.host_cache.misses, 0)
+
+    def test_wait_for_change(self):
+        "Tests that waiting requests are woken by changes that affect them"
+        balancer = Balancer(None, None, None, None)
+        balancer.hosts = {"ep.io": ["spin", {}, True]}
+        woken = []
+        def waiter(host):
+            woken.append((host, balancer.wait_for_change(host, 1)))
+        for host in ["www.ep.io", "ep.io", "aeracode.org"]:
+            eventlet.spawn(waiter, host)
+        eventlet.sleep(0)
+        self.assertEqual(3, balancer.balancer_stats()['spinning_requests'])
+        # Only the changed entry and its subdomains are woken
+        balancer.set_host("https://ep.io", ["empty", {"code": 402}, True])
+        eventlet.sleep(0)
+        self.assertEqual(
+            [("ep.io", True), ("www.ep.io", True)],
+            sorted(woken),
+        )
+        # Replacing the whole table wakes everyone
+        balancer.hosts = {}
+        eventlet.sleep(0)
+        self.assertEqual(("aeracode.org", True), woken[-1])
+        self.assertEqual({}, balancer.host_waiters)
+        # Otherwise, they give up after the timeout
+        self.assertEqual(False, balancer.wait_for_change("ep.io", 0.01))
+        self.assertEqual({}, balancer.host_waiters)
+
+    def test_changes_since(self):
+        "Tests working out which entries changed after a generation"
+        balancer = Balancer(None, None, None, None)
+        balancer.hosts = {"ep.io": ["spin", {}, True], "aeracode.org": ["spin", {}, True]}
+        start = balancer.generation
+        self.assertEqual({}, balancer.changes_since(start))
+        balancer.set_host("ep.io", ["empty", {"code": 402}, True])
+        balancer.delete_host("aeracode.org")
+        balancer.patch_hosts({"www.ep.io": ["spin", {}, False]}, ["ep.io"])
+        self.assertEqual(
+            {"ep.io": None, "aeracode.org": None, "www.ep.io": ["spin", {}, False]},
+            balancer.changes_since(start),
+        )
+        self.assertEqual(
+            {"ep.io": None, "www.ep.io": ["spin", {}, False]},
+            balancer.changes_since(start + 2),
+        )
+        # Replacements, generations from the future and ones that have
+        # fallen out of the changelog all need the full table
+        self.assertEqual(None, balancer.changes_since(start - 1))
+        self.assertEqual(None, balancer.changes_since(balancer.generation + 5))
+        while balancer.changelog[0][0] <= start + 1:
+            balancer.changelog.popleft()
+        self.assertEqual(None, balancer.changes_since(start))
+        # Waiting returns as soon as the generation moves on
+        eventlet.spawn_after(0.05, balancer.set_host, "ep.io", ["spin", {}, True])
+        self.assertEqual(True, balancer.wait_for_generation(balancer.generation, 1))
+        self.assertEqual(False, balancer.wait_for_generation(balancer.generation, 0.01))
+
+    def test_backend_settings(self):
+        "Tests that backend health settings follow all the live rules using them"
+        balancer = Balancer(None, None, None, None)
+        address = ("10.0.0.1", 80)
+        self.assertEqual("host_max_failures_invalid", Proxy.kwargs_errors({"backends": [list(address)], "max_failures": 0}))
+        self.assertEqual("host_health_check_invalid", Proxy.kwargs_errors({"backends": [list(address)], "health_check": "often"}))
+        # Settings apply as soon as a rule is added, without any requests
+        balancer.set_host("ep.io", ["proxy", {"backends": [list(address)], "max_failures": 5, "health_check": 10}, False])
+        backend = balancer.backend(address)
+        self.assertEqual((5, 10, 10.0), (backend.max_failures, backend.backoff, backend.probe_interval))
+        # Where rules sharing a backend disagree, the strictest wins
+        balancer.patch_hosts({
+            "www.ep.io": ["proxy", {"backends": [list(address)], "max_failures": "2", "backoff": 30, "health_check": 20}, False],
+            "api.ep.io": ["proxy", {"backends": [["10.0.0.2", 80]], "health_check": 1}, False],
+        }, [])
+        self.assertEqual((2, 30.0, 10.0), (backend.max_failures, backend.backoff, backend.probe_interval))
+        # Removing a rule takes its settings away again
+        balancer.delete_host("www.ep.io")
+        self.assertEqual((5, 10, 10.0), (backend.max_failures, backend.backoff, backend.probe_interval))
+        balancer.set_host("ep.io", ["spin", {}, False])
+        self.assertEqual((3, 10, None), (backend.max_failures, backend.backoff, backend.probe_interval))
+        self.assertEqual(1.0, balancer.backend(("10.0.0.2", 80)).probe_interval)
+        # Replacing the table recomputes everything
+        balancer.hosts = {"ep.io": ["proxy", {"backends": [list(address)], "backoff": 1}, False]}
+        self.assertEqual((3, 1.0, None), (backend.max_failures, backend.backoff, backend.probe_interval))
+        self.assertEqual(None, balancer.backend(("10.0.0.2", 80)).probe_interval)
+        self.assertEqual({address: {"ep.io": (None, 1.0, None)}}, balancer.backend_settings)
+
+    def test_pool_reap(self):
+        "Tests that idle backend connections are closed once they expire"
+        listener = eventlet.listen(("127.0.0.1", 0))
+        address = listener.getsockname()
+        try:
+            pool = ConnectionPool(max_idle=8, max_age=60)
+            fresh, old, closed = [pool.connect(address) for i in range(3)]
+            old.created -= 120
+            accepted = [listener.accept()[0] for i in range(3)]
+            # The backend closes the third one
+            accepted[2].close()
+            eventlet.sleep(0.05)
+            pool.idle[address] = [fresh, old, closed]
+            pool.reap()
+            self.assertEqual([fresh], pool.idle[address])
+            # Nothing left for an address means it's dropped altogether
+            fresh.created -= 120
+            pool.reap()
+            self.assertEqual({}, pool.idle)
+        finally:
+            listener.close()
+
+    def test_merge_worker_stats(self):
+        "Tests adding together stats reported by worker processes"
+        self.assertEqual(
+            merge_stats([
+                {"ep.io": {"open_requests": 1, "completed_requests": 10}},
+                {"ep.io": {"open_requests": 2}, "localhost": {"bytes_sent": 5}},
+                {},
+            ]),
+            {
+                "ep.io": {"open_requests": 3, "completed_requests": 10},
+                "localhost": {"bytes_sent": 5},
+            },
+        )
+
+    def test_stale_worker_reports(self):
+        "Tests that a report from before a host was deleted doesn't bring it back"
+        balancer = Balancer(None, None, None, None)
+        balancer.set_host("ep.io", ["empty", {"code": 402}, True])
+        supervisor = balancer.supervisor = WorkerSupervisor(balancer, 2)
+        supervisor.workers = [Worker(0, 0, None, None), Worker(1, 0, None, None)]
+        for worker in supervisor.workers:
+            worker.generation = balancer.generation
+            worker.stats = {"ep.io": {"completed_requests": 2}, "unknown": {"completed_requests": 1}}
+        supervisor.merge_reports()
+        self.assertEqual(4, balancer.stats["ep.io"].completed_requests)
+        self.assertEqual(2, balancer.stats["unknown"].completed_requests)
+        ManagementApp(balancer).delete_single("/hostname/ep.io/", None)
+        self.assert_("ep.io" not in balancer.stats)
+        # One worker has caught up; the other hasn't yet
+        supervisor.workers[0].generation = balancer.generation
+        supervisor.workers[0].stats = {"unknown": {"completed_requests": 1}}
+        supervisor.merge_reports()
+        self.assert_("ep.io" not in balancer.stats)
+        self.assertEqual(2, balancer.stats["unknown"].completed_requests)
+        # Once both have, new hosts are taken on again
+        supervisor.workers[1].generation = balancer.generation
+        supervisor.workers[1].stats = {"unknown": {"completed_requests": 1}, "other": {"completed_requests": 1}}
+        supervisor.merge_reports()
+        self.assert_("ep.io" not in balancer.stats)
+        self.assertEqual(1, balancer.stats["other"].completed_requests)
+
+    def test_save_load(self):
+        "Tests that state is saved atomically and only marked dirty by changes"
+        state_file = "/tmp/mantrid-test-state-save"
+        for path in [state_file, state_file + ".tmp"]:
+            if os.path.exists(path):
+                os.unlink(path)
+        balancer = Balancer(None, None, None, state_file)
+        balancer.load()
+        self.assert_(not balancer.dirty)
+        balancer.set_host("ep.io", ["empty", {"code": 402}, True])
+        balancer.host_stats("ep.io").completed_requests = 4
+        self.assert_(balancer.dirty)
+        balancer.save()
+        self.assert_(not os.path.exists(state_file + ".tmp"))
+        # Load it into a fresh balancer
+        balancer = Balancer(None, None, None, state_file)
+        balancer.load()
+        self.assertEqual({"ep.io": ["empty", {"code": 402}, True]}, balancer.hosts)
+        self.assertEqual(
+            {"completed_requests": 4, "open_requests": 0, "bytes_sent": 0, "bytes_received": 0, "shed_requests": 0, "connect_timeouts": 0, "idle_timeouts": 0, "request_timeouts": 0},
+            balancer.stats["ep.io"].counts(),
+        )
+        self.assert_(not balancer.dirty)
+        self.assertEqual(balancer.resolve_host("ep.io").__class__, Empty)
+        os.unlink(state_file)
+
+    def test_journal(self):
+        "Tests that changes are journalled, replayed and compacted away"
+        state_file = "/tmp/mantrid-test-state-journal"
+        for path in [state_file, state_file + ".journal"]:
+            if os.path.exists(path):
+                os.unlink(path)
+        balancer = Balancer(None, None, None, state_file)
+        balancer.load()
+        balancer.open_journal()
+        balancer.set_host("ep.io", ["empty", {"code": 402}, True])
+        balancer.save()
+        self.assertEqual(0, os.path.getsize(state_file + ".journal"))
+        balancer.set_host("www.ep.io", ["spin", {}, False])
+        balancer.set_host("test.ep.io", ["static", {"type": "test"}, True])
+        balancer.delete_host("ep.io")
+        generation = balancer.generation
+        balancer.patch_hosts({"api.ep.io": ["empty", {"code": 200}, False]}, ["test.ep.io"])
+        self.assertEqual(generation + 1, balancer.generation)
+        # Changes are queued, then written together
+        self.assertEqual(0, os.path.getsize(state_file + ".journal"))
+        balancer.flush_journal()
+        self.assertEqual(4, len(open(state_file + ".journal").readlines()))
+        # A crash partway through writing an entry leaves a partial line
+        balancer.journal.write('[5, "set", "bad.ep.io"')
+        balancer.journal.close()
+        # Replay it into a fresh balancer
+        restarted = Balancer(None, None, None, state_file)
+        restarted.load()
+        self.assertEqual({
+            "www.ep.io": ["spin", {}, False],
+            "api.ep.io": ["empty", {"code": 200}, False],
+        }, restarted.hosts)
+        self.assertEqual(balancer.generation, restarted.generation)
+        self.assert_(restarted.dirty)
+        self.assertEqual(restarted.resolve_host("www.ep.io").__class__, Spin)
+        # Saving compacts the journal away
+        restarted.open_journal()
+        restarted.save()
+        self.assertEqual(0, os.path.getsize(state_file + ".journal"))
+        restarted = Balancer(None, None, None, state_file)
+        restarted.load()
+        self.assertEqual(2, len(restarted.hosts))
+        self.assert_(not restarted.dirty)
+        # Replacing the table saves a snapshot rather than journalling it,
+        # and anything queued with it is covered by that snapshot
+        restarted.open_journal()
+        restarted.set_host("www.ep.io", ["spin", {}, True])
+        restarted.hosts = {"ep.io": ["spin", {}, False]}
+        restarted.set_host("api.ep.io", ["spin", {}, False])
+        restarted.flush_journal()
+        self.assertEqual(0, os.path.getsize(state_file + ".journal"))
+        self.assertEqual([], restarted.journal_entries)
+        restarted.delete_host("ep.io")
+        restarted.flush_journal()
+        self.assertEqual(1, len(open(state_file + ".journal").readlines()))
+        reloaded = Balancer(None, None, None, state_file)
+        reloaded.load()
+        self.assertEqual({"api.ep.io": ["spin", {}, False]}, reloaded.hosts)
+        self.assertEqual(restarted.generation, reloaded.generation)
+        os.unlink(state_file)
+        os.unlink(state_file + ".journal")
@@ -0,0 +1,96 @@
+import re
+from unittest import TestCase
+from ..loadbalancer import Balancer
+from ..management import ManagementApp, RawResponse
+from ..host_stats import HostStats
+from ..workers import WorkerSupervisor
+from .. import metrics
+
+
+class MetricsTests(TestCase):
+    "Tests the Prometheus metrics output"
+
+    sample_regex = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+    label_regex = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+    def parse(self, text):
+        """
+        Parses the exposition format into {(name, labels): value} and
+        {name: type}, failing on any line that doesn't fit it.
+        """
+        samples = {}
+        types = {}
+        for line in text.splitlines():
+            if line.startswith("# TYPE "):
+                name, kind = line[7:].split()
+                self.assert_(name not in types, "Family %s listed twice" % name)
+                types[name] = kind
+            elif line.startswith("#"):
+                continue
+            else:
+                match = self.sample_regex.match(line)
+                self.assert_(match, "Invalid sample line: %r" % line)
+                name, labels, value = match.groups()
+                labels = tuple(self.label_regex.findall(labels or ""))
+                family = re.sub(r"_(bucket|sum|count)$", "", name)
+                self.assert_(name in types or family in types, "Sample %s has no TYPE" % name)
+                samples[name, labels] = float(value)
+        return samples, types
+
+    def test_metrics(self):
+        "Tests that the metrics parse and carry the right values"
+        balancer = Balancer(None, None, None, None)
+        balancer.hosts = {
+            "ep.io": ["proxy", {"backends": [["127.0.0.1", 8000]]}, True],
+        }
+        balancer.stats = {
+            "ep.io": HostStats({"completed_requests": 3, "open_requests": 1, "bytes_sent": 100, "bytes_received": 20}),
+            'odd"name': HostStats(),
+        }
+        for duration in [0.001, 0.002, 0.5]:
+            balancer.stats["ep.io"].total.record(duration)
+        backend = balancer.backend(("127.0.0.1", 8000))
+        backend.requests = 3
+        backend.record_failure()
+        response = ManagementApp(balancer).get_metrics("/metrics", None, {})
+        self.assert_(isinstance(response, RawResponse))
+        samples, types = self.parse("".join(metrics.render(balancer, lines_per_chunk=3)))
+        host = (("host", "ep.io"), )
+        self.assertEqual(3, samples["mantrid_requests_total", host])
+        self.assertEqual(1, samples["mantrid_open_requests", host])
+        self.assertEqual(100, samples["mantrid_bytes_sent_total", host])
+        self.assertEqual(0, samples["mantrid_requests_total", (("host", 'odd\\"name'), )])
+        # Histogram buckets are cumulative and end with +Inf
+        self.assertEqual("histogram", types["mantrid_request_duration_seconds"])
+        buckets = sorted(
+            (float(labels[1][1]), value)
+            for (name, labels), value in samples.items()
+            if name == "mantrid_request_duration_seconds_bucket" and labels[0] == host[0]
+        )
+        self.assertEqual([1, 2, 3, 3], [value for bound, value in buckets])
+        self.assertEqual(float("inf"), buckets[-1][0])
+        self.assertEqual(3, samples["mantrid_request_duration_seconds_count", host])
+        # Backends and the balancer itself
+        backend_labels = (("backend", "127.0.0.1:8000"), )
+        self.assertEqual(1, samples["mantrid_backend_up", backend_labels])
+        self.assertEqual(3, samples["mantrid_backend_requests_total", backend_labels])
+        self.assertEqual(1, samples["mantrid_backend_connect_failures_total", backend_labels])
+        self.assertEqual(balancer.generation, samples["mantrid_generation", ()])
+        # Hosts are looked up as they are written, so ones that go away
+        # partway through are left out rather than breaking the output
+        lines = metrics.metric_lines(balancer)
+        head = [lines.next(), lines.next()]
+        del balancer.stats["ep.io"]
+        samples, types = self.parse("".join(head + list(lines)))
+        self.assertEqual(3, samples["mantrid_requests_total", host])
+        self.assert_(("mantrid_open_requests", host) not in samples)
+        self.assert_(("mantrid_request_duration_seconds_count", host) not in samples)
+        # With workers, their last reported totals are used
+        balancer.supervisor = WorkerSupervisor(balancer, 2)
+        balancer.supervisor.host_stats = {"ep.io": HostStats({"completed_requests": 7}).to_dict()}
+        balancer.supervisor.backend_stats = {"127.0.0.1:8000": backend.to_dict()}
+        samples, types = self.parse("".join(metrics.render(balancer)))
+        self.assertEqual(7, samples["mantrid_requests_total", host])
+        self.assertEqual(0, samples["mantrid_request_duration_seconds_count", host])
+        self.assertEqual(3, samples["mantrid_backend_requests_total", backend_labels])
+        self.assertEqual(0, samples["mantrid_workers", ()])
@@ -0,0 +1,152 @@
+import os
+import time
+import unittest
+import eventlet
+import socket
+from ..loadbalancer import Balancer
+from ..client import MantridClient
+from ..replication import Replicator
+
+
+class ReplicationTests(unittest.TestCase):
+    """
+    Tests that followers keep up with a leader, on loopback.
+    """
+
+    next_port = 30500
+
+    def setUp(self):
+        self.old_watch_timeout = Replicator.watch_timeout
+        Replicator.watch_timeout = 0.5
+        self.balancers = []
+        self.leader, self.leader_client = self.start("leader")
+
+    def tearDown(self):
+        for balancer, thread in self.balancers:
+            balancer.running = False
+            thread.kill()
+        Replicator.watch_timeout = self.old_watch_timeout
+        eventlet.sleep(0.1)
+
+    def start(self, name, replicate_from=None, clean=True):
+        "Starts a balancer with just a management port, and a client for it"
+        self.__class__.next_port += 1
+        state_file = "/tmp/mantrid-test-replication-%s" % name
+        # Start from an empty state, without a previous run's journal
+        if clean:
+            for path in [state_file, state_file + ".journal"]:
+                if os.path.exists(path):
+                    os.unlink(path)
+        balancer = Balancer(
+            [],
+            [],
+            [(("127.0.0.1", self.next_port), socket.AF_INET)],
+            state_file,
+            replicate_from = replicate_from,
+        )
+        thread = eventlet.spawn(balancer.run)
+        self.balancers.append((balancer, thread))
+        eventlet.sleep(0.1)
+        return balancer, MantridClient("http://127.0.0.1:%i" % self.next_port)
+
+    def start_follower(self, name, clean=True):
+        return self.start(name, self.leader_client.base_url, clean)
+
+    def wait_for(self, condition, timeout=5):
+        "Waits for condition() to become true, failing if it doesn't"
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                self.fail("Timed out waiting for replication")
+            eventlet.sleep(0.05)
+
+    def in_sync(self, follower):
+        "Returns a condition that is true once follower matches the leader"
+        return lambda: (
+            follower.replicator.generation == self.leader.generation and
+            follower.hosts == self.leader.hosts
+        )
+
+    def test_snapshot_and_changes(self):
+        "A new follower copies the whole table, then follows each change"
+        self.leader_client.set_all({
+            "kittens.com": ["spin", {}, False],
+            "khaaaaaaaaaan.com": ["unknown", {}, True],
+        })
+        follower, follower_client = self.start_follower("follower")
+        self.wait_for(self.in_sync(follower))
+        self.assertEqual(1, follower.replicator.full_syncs)
+        self.assertEqual(self.leader.generation, follower_client.balancer_stats()['leader_generation'])
+        # Later changes come across on their own, without another copy
+        follower.host_stats("kittens.com").completed_requests = 5
+        self.leader_client.set("ceilingcat.net", ["spin", {}, False])
+        self.wait_for(self.in_sync(follower))
+        self.leader_client.patch({"kittens.com": ["unknown", {}, True]}, ["khaaaaaaaaaan.com"])
+        self.wait_for(self.in_sync(follower))
+        self.leader_client.delete("ceilingcat.net")
+        self.wait_for(self.in_sync(follower))
+        self.assertEqual({"kittens.com": ["unknown", {}, True]}, follower.hosts)
+        self.assertEqual(1, follower.replicator.full_syncs)
+        # Stats are kept for hosts that were only changed
+        self.assertEqual(5, follower.host_stats("kittens.com").completed_requests)
+        self.assert_("khaaaaaaaaaan.com" not in follower.stats)
+        # A second follower sees the same table
+        other, other_client = self.start_follower("other")
+        self.wait_for(self.in_sync(other))
+        self.assertEqual(follower.hosts, other_client.get_all())
+
+    def test_read_only(self):
+        "Followers refuse changes to the hosts table"
+        follower, follower_client = self.start_follower("follower")
+        self.wait_for(self.in_sync(follower))
+        try:
+            follower_client.set("kittens.com", ["spin", {}, False])
+        except IOError, e:
+            self.assert_("403" in str(e))
+            self.assert_("replica_read_only" in str(e))
+        else:
+            self.fail("Follower accepted a change")
+        self.assertEqual({}, follower.hosts)
+        # Reads still work
+        self.assertEqual({}, follower_client.get_all())
+
+    def test_catch_up(self):
+        "A follower that fell behind catches up from where it got to"
+        self.leader_client.set("kittens.com", ["spin", {}, False])
+        # Follow by hand, so we can fall behind on purpose
+        follower = Balancer(None, None, None, None)
+        replicator = Replicator(follower, self.leader_client.base_url)
+        replicator.apply(replicator.client.watch().next())
+        self.assertEqual(self.leader.hosts, follower.hosts)
+        self.assertEqual(1, replicator.full_syncs)
+        self.leader_client.set("ceilingcat.net", ["spin", {}, False])
+        self.leader_client.set("khaaaaaaaaaan.com", ["spin", {}, False])
+        self.leader_client.delete("kittens.com")
+        # The missed changes come as one batch, not a copy of everything
+        result = replicator.client.watch(replicator.generation).next()
+        self.assertEqual(False, result['reset'])
+        replicator.apply(result)
+        self.assertEqual(self.leader.hosts, follower.hosts)
+        self.assertEqual(self.leader.generation, replicator.generation)
+        self.assertEqual(1, replicator.full_syncs)
+        # Too far behind for the leader's changelog gets a copy instead
+        self.leader_client.set("kittens.com", ["spin", {}, False])
+        self.leader.changelog.clear()
+        self.leader_client.set("lions.net", ["spin", {}, False])
+        replicator.apply(replicator.client.watch(replicator.generation).next())
+        self.assertEqual(self.leader.hosts, follower.hosts)
+        self.assertEqual(2, replicator.full_syncs)
+
+    def test_restart(self):
+        "A follower that was down for changes catches up when it restarts"
+        self.leader_client.set("kittens.com", ["spin", {}, False])
+        follower, follower_client = self.start_follower("follower")
+        self.wait_for(self.in_sync(follower))
+        follower.running = False
+        self.balancers[-1][1].kill()
+        eventlet.sleep(0.1)
+        self.leader_client.patch({"ceilingcat.net": ["spin", {}, False]}, ["kittens.com"])
+        # It comes back up with its own saved table, then gets the leader's
+        follower, follower_client = self.start_follower("follower", clean=False)
+        self.wait_for(self.in_sync(follower))
+        self.assertEqual({"ceilingcat.net": ["spin", {}, False]}, follower_client.get_all())
@@ -0,0 +1,68 @@
+import unittest
+import eventlet
+from eventlet.green import socket
+from eventlet.timeout import Timeout
+from ..socketmeld import SocketMelder
+from ..stats_socket import StatsSocket
+
+
+class SocketMelderTests(unittest.TestCase):
+    "Tests the socket melder with both relay engines"
+
+    def meld(self, splice):
+        # client_end <-> client ... melder ... server <-> server_end
+        client_end, client = socket.socketpair()
+        server, server_end = socket.socketpair()
+        client = StatsSocket(client)
+        melder = SocketMelder(client, server, splice=splice)
+        thread = eventlet.spawn(melder.run)
+        payload = "x" * 200000
+        client_end.sendall("GET / HTTP/1.0\r\n\r\n")
+        client_end.shutdown(socket.SHUT_WR)
+        received = ""
+        with Timeout(5):
+            while len(received) < 18:
+                received += server_end.recv(4096)
+            server_end.sendall(payload)
+            server_end.shutdown(socket.SHUT_WR)
+            response = ""
+            while True:
+                data = client_end.recv(65536)
+                if not data:
+                    break
+                response += data
+            handled = thread.wait()
+        self.assertEqual("GET / HTTP/1.0\r\n\r\n", received)
+        self.assertEqual(payload, response)
+        self.assertEqual(len(payload) + 18, handled)
+        self.assertEqual(len(payload), client.bytes_sent)
+        self.assertEqual(18, client.bytes_received)
+        client_end.close()
+        server_end.close()
+
+    def test_copy(self):
+        "Tests relaying through Python"
+        self.meld(splice=False)
+
+    def test_splice(self):
+        "Tests relaying with splice(), where it's available"
+        if SocketMelder._splice is None:
+            self.skipTest("splice() is not available")
+        self.meld(splice=True)
+
+    def test_splice_output_closed(self):
+        "Tests that a failed splice() write stops the other direction too"
+        if SocketMelder._splice is None:
+            self.skipTest("splice() is not available")
+        client_end, client = socket.socketpair()
+        server, server_end = socket.socketpair()
+        melder = SocketMelder(client, server, splice=True)
+        other = eventlet.spawn(eventlet.sleep, 10)
+        melder.threads = {"stoc": other}
+        # Anything relayed to the client now fails
+        client_end.close()
+        server_end.sendall("HTTP/1.0 200 OK\r\n\r\n")
+        with Timeout(5):
+            melder.piper(server, client, "client", "stoc")
+        self.assert_(other.dead)
+        server_end.close()
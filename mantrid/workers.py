@@ -0,0 +1,194 @@
+"""
+Support for running the balancer as several worker processes.
+"""
+
+import json
+import logging
+import os
+import signal
+import eventlet
+from eventlet.greenio import GreenPipe
+from .management import ManagementApp
+
+
+def merge_stats(snapshots):
+    """
+    Adds together stats dicts from several workers. Numbers are summed
+    and nested dicts merged; anything else keeps the last value seen.
+    """
+    merged = {}
+    for snapshot in snapshots:
+        for key, value in snapshot.items():
+            if isinstance(value, dict):
+                merged[key] = merge_stats([merged.get(key, {}), value])
+            elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                merged[key] = merged.get(key, 0) + value
+            else:
+                merged[key] = value
+    return merged
+
+
+class Worker(object):
+    "The supervisor's handle on one worker process."
+
+    def __init__(self, index, pid, commands, reports):
+        self.index = index
+        self.pid = pid
+        self.commands = commands
+        self.reports = reports
+        self.stats = {}
+        self.balancer_stats = {}
+        self.backend_stats = {}
+        # The hosts table generation the worker had reached when it reported
+        self.generation = None
+        self.alive = True
+
+
+class WorkerSupervisor(object):
+    """
+    Forks worker processes that share the balancer's listening sockets.
+    The supervising process keeps the management API; every change made
+    through it is replayed in each worker, and the workers periodically
+    report their stats back to be added together.
+    """
+
+    report_interval = 1
+
+    def __init__(self, balancer, count):
+        self.balancer = balancer
+        self.count = count
+        self.workers = []
+        self.host_stats = {}
+        self.backend_stats = {}
+
+    def start(self):
+        """
+        Forks the workers. Returns the worker's index in each worker
+        process, and None in the supervising process.
+        """
+        for index in range(self.count):
+            command_read, command_write = os.pipe()
+            report_read, report_write = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                for worker in self.workers:
+                    worker.commands.close()
+                    worker.reports.close()
+                os.close(command_write)
+                os.close(report_read)
+                self.workers = []
+                self.commands = GreenPipe(command_read, "r")
+                self.reports = GreenPipe(report_write, "w")
+                # Only the first worker carries on the saved counters,
+                # so the totals aren't counted once per worker.
+                if index:
+                    for stats in self.balancer.stats.values():
+                        stats.reset()
+                return index
+            os.close(command_read)
+            os.close(report_write)
+            self.workers.append(Worker(
+                index,
+                pid,
+                GreenPipe(command_write, "w"),
+                GreenPipe(report_read, "r"),
+            ))
+            logging.info("Started worker %i (pid %i)" % (index, pid))
+        return None
+
+    def stop(self):
+        "Terminates all the workers."
+        for worker in self.workers:
+            try:
+                os.kill(worker.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    ### Supervisor side ###
+
+    def broadcast(self, handler_name, path, body):
+        "Replays a management API change in every worker."
+        line = json.dumps([handler_name, path, body]) + "\n"
+        for worker in self.workers:
+            if worker.alive:
+                worker.commands.write(line)
+                worker.commands.flush()
+
+    def read_reports(self, worker):
+        "Reads one worker's stats reports until it exits."
+        while True:
+            line = worker.reports.readline()
+            if not line:
+                break
+            report = json.loads(line)
+            worker.stats = report['stats']
+            worker.balancer_stats = report['balancer']
+            worker.backend_stats = report['backends']
+            worker.generation = report.get('generation')
+        worker.alive = False
+        logging.critical("Worker %i (pid %i) exited" % (worker.index, worker.pid))
+
+    def supervise(self):
+        """
+        Keeps the balancer's stats up to date with the workers' reports.
+        Returns (stopping the balancer) if any worker exits.
+        """
+        for worker in self.workers:
+            eventlet.spawn(self.read_reports, worker)
+        while self.balancer.running:
+            eventlet.sleep(self.report_interval)
+            if not all(worker.alive for worker in self.workers):
+                return
+            self.merge_reports()
+
+    def merge_reports(self):
+        "Adds together the workers' last reports."
+        self.host_stats = merge_stats([worker.stats for worker in self.workers])
+        self.backend_stats = merge_stats([worker.backend_stats for worker in self.workers])
+        # Keep the totals in our own counters too, so they get saved. A
+        # report from before a change can still have a host it deleted,
+        # so only up-to-date reports may add hosts we have no entry for.
+        current = all(worker.generation >= self.balancer.generation for worker in self.workers)
+        for host, counts in self.host_stats.items():
+            if current or host in self.balancer.stats:
+                self.balancer.host_stats(host).update(counts)
+
+    def balancer_stats(self):
+        "Returns the workers' balancer-wide stats added together."
+        stats = merge_stats([worker.balancer_stats for worker in self.workers])
+        stats.pop("generation", None)
+        # The workers share the listening sockets, so they'd each report
+        # the same accept queue; ours is the one to use
+        stats.pop("accept_queue", None)
+        stats.pop("accept_queue_limit", None)
+        stats['workers'] = len(self.workers)
+        return stats
+
+    ### Worker side ###
+
+    def report_loop(self):
+        "Sends this worker's stats to the supervisor."
+        while self.balancer.running:
+            eventlet.sleep(self.report_interval)
+            self.reports.write(json.dumps({
+                "generation": self.balancer.generation,
+                "stats": self.balancer.stats_snapshot(),
+                "balancer": self.balancer.balancer_stats(),
+                "backends": self.balancer.backend_stats(),
+            }) + "\n")
+            self.reports.flush()
+
+    def worker_loop(self):
+        """
+        Applies management changes sent by the supervisor. Returns
+        (stopping the worker) when the supervisor goes away.
+        """
+        app = ManagementApp(self.balancer)
+        eventlet.spawn(self.report_loop)
+        while True:
+            line = self.commands.readline()
+            if not line:
+                logging.info("Supervisor has exited; stopping worker")
+                return
+            handler_name, path, body = json.loads(line)
+            getattr(app, handler_name)(path, body)